@@ -13,5 +13,8 @@ setup(name='skeleton_synapses',
       author_email='bergs@janelia.hhmi.org',
       url='https://github.com/ilastik/catmaid_tools',
       packages=['skeleton_synapses'],
-      entry_points={ 'console_scripts': ['locate_synapses = skeleton_synapses.locate_synapses:main'] }
+      entry_points={ 'console_scripts': ['locate_synapses = skeleton_synapses.locate_synapses:main',
+                                         'locate_synapses_batch = skeleton_synapses.locate_synapses_batch:main',
+                                         'snapshot_volume = skeleton_synapses.snapshot_volume:main',
+                                         'postprocess_detections = skeleton_synapses.postprocess_detections:main'] }
      )
@@ -0,0 +1,54 @@
+import os
+import errno
+import cPickle as pickle
+import collections
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Everything needed to resume an interrupted run after the last committed node:
+# - skeleton_id, skeleton_node_count: Used to verify that we're resuming the same job
+# - node_overall_index: The index of the last node whose outputs were committed
+# - csv_offset: The size of the CSV file after the last committed node
+# - stack_lengths: A dict of { stack_name : num_slices } for the HDF5 output stacks
+# - relabeler_class: The name of the relabeler's class (SynapseSliceRelabeler or GlobalSynapseRelabeler)
+# - relabeler_state: The relabeler's state (see SynapseSliceRelabeler.state())
+Checkpoint = collections.namedtuple( 'Checkpoint', 'skeleton_id skeleton_node_count node_overall_index '
+                                                   'csv_offset stack_lengths relabeler_class relabeler_state' )
+
+def checkpoint_path(output_dir):
+    return os.path.join(output_dir, 'checkpoint.pkl')
+
+def save_checkpoint(output_dir, checkpoint):
+    """
+    Atomically replace the checkpoint file in the given directory.
+    """
+    path = checkpoint_path(output_dir)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(checkpoint._asdict(), f, pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_path, path)
+
+def load_checkpoint(output_dir):
+    """
+    Load the checkpoint file from the given directory, or return None if there isn't one.
+    """
+    try:
+        with open(checkpoint_path(output_dir), 'rb') as f:
+            return Checkpoint(**pickle.load(f))
+    except IOError as ex:
+        if ex.errno != errno.ENOENT:
+            raise
+        return None
+
+def remove_checkpoint(output_dir):
+    """
+    Delete the checkpoint file from the given directory (if any).
+    """
+    try:
+        os.unlink(checkpoint_path(output_dir))
+    except OSError as ex:
+        if ex.errno != errno.ENOENT:
+            raise
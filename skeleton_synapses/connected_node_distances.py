@@ -1,5 +1,5 @@
-import csv
-from skeleton_utils import parse_connectors, parse_skeleton_json, CSV_FORMAT
+from skeleton_utils import parse_connectors, parse_skeleton_json
+from detection_table import read_detections, write_detections, iter_rows, table_from_rows
 
 def connected_node_distances( skeleton_json_path,
                               raw_detection_csv_path,
@@ -18,25 +18,41 @@ def connected_node_distances( skeleton_json_path,
         given merged detections file, which lists the minimum "membrane distance" for each synapse.    
     """
     connector_infos, _ = parse_connectors( skeleton_json_path )
-    node_infos = parse_skeleton_json( skeleton_json_path, 4.0, 4.0, 45.0 )
+    _, node_infos = parse_skeleton_json( skeleton_json_path, 4.0, 4.0, 45.0 )
+
+    output_detections, nodes_without_detections = \
+        connected_node_distance_table( connector_infos,
+                                       node_infos,
+                                       read_detections( raw_detection_csv_path ),
+                                       read_detections( merged_detection_csv_path ) )
+    write_detections( output_csv_path, output_detections )
+
+    return len(connector_infos), nodes_without_detections
+
+def connected_node_distance_table( connector_infos, node_infos, raw_detections, merged_detections ):
+    """
+    Like connected_node_distances(), but for the given ConnectorInfos, NodeInfos,
+    and raw and merged detection tables (see detection_table).
+
+    Returns: The output detection table (with the merged table's columns),
+             and a list of (node_id, connector_id) for each connected node without a detection.
+    """
     node_info_dict = { n.id : n for n in node_infos }
+    output_columns = list(merged_detections.dtype.names)
 
-    raw_detections, _ = _load_raw_detections( raw_detection_csv_path )
-    merged_detections, output_columns = _load_merged_detections( merged_detection_csv_path )
+    raw_detections = _raw_detections_by_node( raw_detections )
+    merged_detections = _merged_detections_by_synapse( merged_detections )
 
     nodes_without_detections = []
-    with open( output_csv_path, 'w' ) as output_csv:
-        csv_writer = csv.DictWriter(output_csv, output_columns, **CSV_FORMAT)
-        csv_writer.writeheader()
+    output_rows = []
+    for connector_info in connector_infos:
+        output_row = _get_row_dict( node_info_dict, raw_detections, merged_detections, output_columns, connector_info )
+        if output_row["synapse_id"] == -1:
+            nodes_without_detections.append( ( output_row["node_id"], output_row["nearest_connector_id"] ) )
+            #nodes_without_detections.append( output_row["node_id"] )
+        output_rows.append( output_row )
 
-        for connector_info in connector_infos:
-            output_row = _get_row_dict( node_info_dict, raw_detections, merged_detections, output_columns, connector_info )
-            if output_row["synapse_id"] == -1:
-                nodes_without_detections.append( ( output_row["node_id"], output_row["nearest_connector_id"] ) )
-                #nodes_without_detections.append( output_row["node_id"] )
-            csv_writer.writerow( output_row )
-
-    return len(connector_infos), nodes_without_detections
+    return table_from_rows(output_rows, output_columns), nodes_without_detections
 
 def _get_row_dict( node_info_dict, raw_detections, merged_detections, output_columns, connector_info ):
     """
@@ -60,8 +76,8 @@ def _get_row_dict( node_info_dict, raw_detections, merged_detections, output_col
     except KeyError:
         output_row["node_id"] = connected_node_id
         output_row["node_x_px"] = node_info_dict[connected_node_id].x_px
-        output_row["node_y_px"] = node_info_dict[connected_node_id].x_px
-        output_row["node_z_px"] = node_info_dict[connected_node_id].x_px
+        output_row["node_y_px"] = node_info_dict[connected_node_id].y_px
+        output_row["node_z_px"] = node_info_dict[connected_node_id].z_px
         # We have no synapse, but as a convenience for navigation in catmaid, 
         #  replace the synapse coordinates with node coordinates.
         output_row["x_px"] = node_info_dict[connected_node_id].x_px
@@ -70,7 +86,7 @@ def _get_row_dict( node_info_dict, raw_detections, merged_detections, output_col
         output_row["nearest_connector_distance_nm"] = -1
         
     else:
-        synapse_id = int(raw_row["synapse_id"])
+        synapse_id = raw_row["synapse_id"]
         merged_row = merged_detections[synapse_id]
         output_row.update(merged_row)
         output_row.update(raw_row)
@@ -85,38 +101,29 @@ def _get_row_dict( node_info_dict, raw_detections, merged_detections, output_col
     output_row["nearest_connector_z_nm"] = connector_info.z_nm
     return output_row
 
-def _load_raw_detections( raw_detection_csv_path ):
+def _raw_detections_by_node( detections ):
     """
-    Read raw detections into a dict, indexed by node_id.
-    Returns: raw_detections dict and output_columns from the csv file
+    Convert the given raw detection table into a dict of rows, indexed by node_id.
     """
     raw_detections = {}
-    with open( raw_detection_csv_path, 'r' ) as raw_detection_file:
-        raw_csv_reader = csv.DictReader(raw_detection_file, **CSV_FORMAT)
-        for row in raw_csv_reader:
-            node_id = int(row["node_id"])
-            if node_id not in raw_detections:
+    for row in iter_rows(detections):
+        node_id = row["node_id"]
+        if node_id not in raw_detections:
+            raw_detections[node_id] = row
+        else:
+            # More than one synapse, keep the "closest" one.
+            old_distance = raw_detections[node_id]["nearest_connector_distance_nm"]
+            new_distance = row["nearest_connector_distance_nm"]
+            if new_distance < old_distance:
                 raw_detections[node_id] = row
-            else:
-                # More than one synapse, keep the "closest" one.
-                old_distance = float(raw_detections[node_id]["nearest_connector_distance_nm"])
-                new_distance = float(row["nearest_connector_distance_nm"])
-                if new_distance < old_distance:
-                    raw_detections[node_id] = row
 
-    return raw_detections, raw_csv_reader.fieldnames
+    return raw_detections
 
-def _load_merged_detections( merged_detection_csv_path ):
+def _merged_detections_by_synapse( detections ):
     """
-    Read merged detections into a dict, indexed by synapse_id.
+    Convert the given merged detection table into a dict of rows, indexed by synapse_id.
     """
-    merged_detections = {}
-    with open( merged_detection_csv_path, 'r' ) as merged_detection_file:
-        merged_csv_reader = csv.DictReader(merged_detection_file, **CSV_FORMAT)
-        for row in merged_csv_reader:
-            synapse_id = int(row["synapse_id"])
-            merged_detections[synapse_id] = row
-    return merged_detections, merged_csv_reader.fieldnames
+    return { row["synapse_id"] : row for row in iter_rows(detections) }
 
 if __name__ == "__main__":
     import sys
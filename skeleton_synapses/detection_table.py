@@ -0,0 +1,335 @@
+"""
+Read and write synapse detection tables, either as the usual tab-separated CSV files
+or in a typed, columnar form:
+
+- HDF5 (.h5, .hdf5): A single 'detections' dataset with a compound dtype (one field per column).
+- NumPy (.npy): A structured array, which is memory-mapped when it is read.
+
+In memory, a detection table is a numpy structured array, with one field per column
+(in the same order as the CSV columns).  Columns with well-known names (e.g. those of
+locate_synapses.OUTPUT_COLUMNS) always get the same dtype.  The dtype of any other column
+is inferred from its values when it is read from a CSV file.
+
+A boolean column may also hold the 'no value' sentinel -1 (MISSING_BOOL), as in the
+connected node distances for nodes without a detection.  Such a column is stored as
+int8 instead (1, 0 or -1), and is still written as "true"/"false"/"-1" in CSV files.
+"""
+import os
+import csv
+import shutil
+import itertools
+import collections
+
+import numpy
+import h5py
+
+from skeleton_utils import CSV_FORMAT
+
+# The dtypes of all columns that are written by locate_synapses and the post-processing tools.
+DETECTION_COLUMN_DTYPES = collections.OrderedDict([
+    ("synapse_id", numpy.int64),
+    ("overlaps_node_segment", numpy.bool_),
+    ("x_px", numpy.int64),
+    ("y_px", numpy.int64),
+    ("z_px", numpy.int64),
+    ("size_px", numpy.int64),
+    ("tile_x_px", numpy.int64),
+    ("tile_y_px", numpy.int64),
+    ("tile_index", numpy.int64),
+    ("distance_to_node_px", numpy.float64),
+    ("detection_uncertainty", numpy.float64),
+    ("node_id", numpy.int64),
+    ("node_x_px", numpy.int64),
+    ("node_y_px", numpy.int64),
+    ("node_z_px", numpy.int64),
+    ("node_count", numpy.int64),
+    ("distance", numpy.float64),
+    ("distance_hessian", numpy.float64),
+    ("distance_raw_probs", numpy.float64),
+    ("nearest_connector_id", numpy.int64),
+    ("nearest_connector_distance_nm", numpy.float64),
+    ("nearest_connector_x_nm", numpy.float64),
+    ("nearest_connector_y_nm", numpy.float64),
+    ("nearest_connector_z_nm", numpy.float64),
+])
+
+# The sentinel for a missing value in a boolean column (see above).
+MISSING_BOOL = -1
+
+HDF5_EXTENSIONS = ('.h5', '.hdf5')
+NPY_EXTENSIONS = ('.npy',)
+
+# The default number of rows per chunk for iter_detection_chunks()
+DEFAULT_CHUNK_SIZE = 100000
+
+def is_columnar_path(path):
+    """
+    Return True if the given path names a columnar (HDF5 or NumPy) detection file, rather than a CSV file.
+    """
+    return os.path.splitext(path)[1].lower() in HDF5_EXTENSIONS + NPY_EXTENSIONS
+
+def read_detections(path):
+    """
+    Read the detection table at the given path (CSV, HDF5, or NumPy, according to its extension),
+    and return it as a structured array.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension in HDF5_EXTENSIONS:
+        with h5py.File(path, 'r') as f:
+            return f['detections'][()]
+    if extension in NPY_EXTENSIONS:
+        return numpy.load(path, mmap_mode='r')
+
+    with open(path, 'r') as f:
+        csv_reader = csv.reader(f, **CSV_FORMAT)
+        column_names = next(csv_reader)
+        return _table_from_csv_rows( column_names, list(csv_reader) )
+
+def iter_detection_chunks(path, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Read the detection table at the given path (CSV, HDF5, or NumPy) in chunks of
+    (up to) chunk_size rows, so that only one chunk needs to be held in memory at a time.
+    Yields a structured array for each chunk (at least one, even if the table is empty).
+
+    For CSV files, the types of any columns not listed in DETECTION_COLUMN_DTYPES
+    are inferred from the first chunk, and all subsequent chunks must match them.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension in HDF5_EXTENSIONS:
+        with h5py.File(path, 'r') as f:
+            dataset = f['detections']
+            for start in range(0, max(len(dataset), 1), chunk_size):
+                yield dataset[start:start+chunk_size]
+        return
+    if extension in NPY_EXTENSIONS:
+        detections = numpy.load(path, mmap_mode='r')
+        for start in range(0, max(len(detections), 1), chunk_size):
+            yield numpy.array( detections[start:start+chunk_size] )
+        return
+
+    with open(path, 'r') as f:
+        csv_reader = csv.reader(f, **CSV_FORMAT)
+        column_names = next(csv_reader)
+        dtype = None
+        while True:
+            rows = list( itertools.islice(csv_reader, chunk_size) )
+            if not rows and dtype is not None:
+                return
+            chunk = _table_from_csv_rows( column_names, rows, dtype )
+            dtype = chunk.dtype
+            yield chunk
+
+def write_detections(path, detections):
+    """
+    Write the given detection table (a structured array) to the given path,
+    in the format indicated by its extension (CSV, HDF5, or NumPy).
+    """
+    writer = DetectionWriter(path)
+    try:
+        writer.append(detections)
+    finally:
+        writer.close()
+
+class DetectionWriter(object):
+    """
+    Writes a detection table to the given path (CSV, HDF5, or NumPy, according to its extension)
+    one chunk at a time, so the whole table needn't be held in memory.
+
+    All chunks must have the same columns.  They are stored with the dtype of the first chunk.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.dtype = None
+        self._extension = os.path.splitext(path)[1].lower()
+        self._file = None
+        self._length = 0
+
+    def __len__(self):
+        """
+        The number of rows written so far.
+        """
+        return self._length
+
+    def append(self, detections):
+        """
+        Append the given chunk (a structured array) to the end of the table.
+        """
+        if self.dtype is None:
+            self._start(detections.dtype)
+        if detections.dtype.names != self.dtype.names:
+            raise ValueError("Chunk columns {} don't match the table's columns {}"
+                             .format( detections.dtype.names, self.dtype.names ))
+
+        if self._extension in HDF5_EXTENSIONS:
+            dataset = self._file['detections']
+            dataset.resize( (self._length + len(detections),) )
+            dataset[self._length:] = numpy.asarray(detections, dtype=self.dtype)
+        elif self._extension in NPY_EXTENSIONS:
+            self._file.write( numpy.ascontiguousarray(detections, dtype=self.dtype).tobytes() )
+        else:
+            column_strings = [ _format_column(name, detections[name]) for name in self.dtype.names ]
+            self._csv_writer.writerows( zip(*column_strings) )
+        self._length += len(detections)
+
+    def close(self):
+        """
+        Finish writing the table.  (Nothing is written if no chunks were appended.)
+        """
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+
+        if self._extension in NPY_EXTENSIONS:
+            # Now that the length is known, write the header, followed by the rows.
+            rows_path = self.path + '.rows'
+            with open(self.path, 'wb') as f, open(rows_path, 'rb') as rows_file:
+                header = { 'descr' : numpy.lib.format.dtype_to_descr(self.dtype),
+                           'fortran_order' : False,
+                           'shape' : (self._length,) }
+                numpy.lib.format.write_array_header_1_0(f, header)
+                shutil.copyfileobj(rows_file, f)
+            os.unlink(rows_path)
+
+    def _start(self, dtype):
+        self.dtype = dtype
+        if self._extension in HDF5_EXTENSIONS:
+            self._file = h5py.File(self.path, 'w')
+            self._file.create_dataset( 'detections', shape=(0,), maxshape=(None,), dtype=dtype, chunks=True )
+        elif self._extension in NPY_EXTENSIONS:
+            self._file = open(self.path + '.rows', 'wb')
+        else:
+            self._file = open(self.path, 'w')
+            self._csv_writer = csv.writer(self._file, **CSV_FORMAT)
+            self._csv_writer.writerow( dtype.names )
+
+def table_from_columns(column_names, column_values, dtype=None):
+    """
+    Construct a detection table from the given column names and a sequence of values for each column.
+    Values may be strings (as read from a CSV file) or numbers.
+    If a (structured) dtype is given, the columns are converted to its field types.
+    Otherwise, see _column_array().
+    """
+    columns = [ _column_array(name, values, None if dtype is None else dtype[name])
+                for name, values in zip(column_names, column_values) ]
+    num_rows = len(columns[0]) if columns else 0
+    table = numpy.zeros( num_rows, dtype=[ (str(name), column.dtype) for name, column in zip(column_names, columns) ] )
+    for name, column in zip(column_names, columns):
+        table[str(name)] = column
+    return table
+
+def table_from_rows(rows, column_names):
+    """
+    Construct a detection table from a list of dicts (e.g. rows from a csv.DictReader).
+    """
+    return table_from_columns( column_names, [ [ row[name] for row in rows ] for name in column_names ] )
+
+def iter_rows(detections):
+    """
+    Yield each row of the given detection table as a dict of { column_name : python value }.
+    """
+    column_names = detections.dtype.names
+    for values in detections.tolist():
+        yield dict( zip(column_names, values) )
+
+def select_columns(detections, column_names):
+    """
+    Return a copy of the given detection table with only the given columns (in the given order).
+    """
+    return table_from_columns( column_names, [ detections[name] for name in column_names ] )
+
+def append_columns(detections, column_names, column_values):
+    """
+    Return a copy of the given detection table with the given columns appended (or replaced, if they already exist).
+    """
+    new_columns = collections.OrderedDict( (name, detections[name]) for name in detections.dtype.names )
+    new_columns.update( zip(column_names, column_values) )
+    return table_from_columns( new_columns.keys(), new_columns.values() )
+
+def _table_from_csv_rows(column_names, rows, dtype=None):
+    if rows:
+        column_values = zip(*rows)
+    else:
+        column_values = [()] * len(column_names)
+    return table_from_columns( column_names, column_values, dtype )
+
+def _column_array(name, values, dtype=None):
+    """
+    Convert the given column values to an array of the given dtype.
+    By default, the column's dtype from DETECTION_COLUMN_DTYPES is used,
+    or (for other columns) the dtype is inferred from the values: int, float, or string.
+    Raises ValueError if the values can't be converted to the column's dtype.
+    """
+    if isinstance(values, numpy.ndarray) and values.dtype != object and values.dtype.kind not in 'SU':
+        if dtype is None:
+            dtype = DETECTION_COLUMN_DTYPES.get(name, values.dtype)
+            if dtype == numpy.bool_ and values.dtype.kind == 'i' and (values == MISSING_BOOL).any():
+                dtype = numpy.int8
+        return values.astype(dtype)
+
+    values = list(values)
+    if dtype is None and name in DETECTION_COLUMN_DTYPES:
+        dtype = DETECTION_COLUMN_DTYPES[name]
+        if dtype == numpy.bool_ and any( _is_missing_bool(v) for v in values ):
+            dtype = numpy.int8
+    if dtype is not None:
+        try:
+            if _is_nullable_bool(name, dtype):
+                return numpy.array( [ MISSING_BOOL if _is_missing_bool(v) else _parse_bool(v) for v in values ],
+                                    dtype=dtype )
+            return _convert_values(values, dtype)
+        except (ValueError, TypeError) as ex:
+            raise ValueError( "Column '{}' can't be converted to {}: {}"
+                              .format( name, numpy.dtype(dtype).name, ex ) )
+
+    for dtype in (numpy.int64, numpy.float64):
+        try:
+            return _convert_values(values, dtype)
+        except (ValueError, TypeError):
+            pass
+
+    # Not numeric: store as strings
+    return numpy.array( map(str, values) )
+
+def _convert_values(values, dtype):
+    dtype = numpy.dtype(dtype)
+    if dtype == numpy.bool_:
+        return numpy.array( [ _parse_bool(v) for v in values ], dtype=numpy.bool_ )
+    if dtype.kind in 'iu':
+        # Parse with int() (not via float), so that large ids stay exact.
+        return numpy.array( map(int, values), dtype=dtype )
+    if dtype.kind == 'f':
+        return numpy.array( map(float, values), dtype=dtype )
+    return numpy.array( map(str, values), dtype=dtype )
+
+def _parse_bool(value):
+    if isinstance(value, basestring):
+        if value.lower() in ('true', '1'):
+            return True
+        if value.lower() in ('false', '0'):
+            return False
+        raise ValueError("Not a boolean: {}".format( value ))
+    return bool(value)
+
+def _is_missing_bool(value):
+    if isinstance(value, basestring):
+        return value.strip() == str(MISSING_BOOL)
+    return value == MISSING_BOOL
+
+def _is_nullable_bool(name, dtype):
+    """
+    True if the given column is a boolean column with missing values (stored as int8).
+    """
+    return DETECTION_COLUMN_DTYPES.get(name) == numpy.bool_ and numpy.dtype(dtype).kind == 'i'
+
+def _format_column(name, column):
+    """
+    Convert the given column to a list of strings for a CSV file.
+    """
+    if column.dtype == numpy.bool_:
+        return [ {True: "true", False: "false"}[value] for value in column.tolist() ]
+    if _is_nullable_bool(name, column.dtype):
+        return [ {1: "true", 0: "false", MISSING_BOOL: str(MISSING_BOOL)}[value] for value in column.tolist() ]
+    if column.dtype.kind == 'f':
+        return map(repr, column.tolist())
+    return map(str, column.tolist())
@@ -1,27 +1,19 @@
 import os
-import csv
 import numpy
 import matplotlib.pyplot as plt
-from skeleton_utils import CSV_FORMAT
+from detection_table import read_detections
 
 def distance_histogram( detection_csv_path, column, include_negative_distances=False ):
-    distances = []
-    uncertainties = []
+    detections = read_detections( detection_csv_path )
+    distances = detections[column].astype(numpy.float64)
+    uncertainties = detections["detection_uncertainty"]
     missing = 0
-    with open( detection_csv_path, 'r' ) as detection_file:
-        csv_reader = csv.DictReader(detection_file, **CSV_FORMAT)
-        for row in csv_reader:
-            distance = float( row[column] )
-            if (distance >= 0.0 and distance <= 0.02) or include_negative_distances:
-                distances.append( distance )
-            elif not include_negative_distances:
-                missing += 1
-            
-            uncertainty = float( row["detection_uncertainty"] )
-            if uncertainty >= 0.0 or include_negative_distances:
-                uncertainties.append( uncertainty )
-
-    distances = numpy.asarray( distances, dtype=numpy.float32 )
+    if not include_negative_distances:
+        in_range = (distances >= 0.0) & (distances <= 0.02)
+        missing = len(distances) - in_range.sum()
+        distances = distances[in_range]
+        uncertainties = uncertainties[uncertainties >= 0.0]
+    distances = distances.astype(numpy.float32)
     
     plt.figure(0)
     n, bins, patches = plt.hist(distances, bins=20, normed=1, facecolor='green', alpha=0.5)
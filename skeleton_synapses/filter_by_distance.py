@@ -1,20 +1,18 @@
-import csv
-from skeleton_utils import CSV_FORMAT
+from detection_table import read_detections, write_detections
 
 def filter_by_distance( synapse_detections_csv, output_csv, max_distance, column_name ):
-    with open(synapse_detections_csv, 'r') as detections_file, \
-         open(output_csv, 'w') as output_file:
+    """
+    Copy the detections whose value in the given column is at least max_distance.
+    Input and output may be CSV or columnar (.h5/.npy) detection files.
+    """
+    detections = read_detections(synapse_detections_csv)
+    write_detections( output_csv, filter_detections(detections, column_name, max_distance) )
 
-        csv_reader = csv.DictReader(detections_file, **CSV_FORMAT)
-    
-        output_columns = csv_reader.fieldnames
-        csv_writer = csv.DictWriter(output_file, output_columns, **CSV_FORMAT)
-        csv_writer.writeheader()
-
-        for row in csv_reader:
-            distance = float(row[column_name])
-            if distance >= max_distance:
-                csv_writer.writerow(row)
+def filter_detections( detections, column_name, max_distance ):
+    """
+    Return the rows of the given detection table whose value in the given column is at least max_distance.
+    """
+    return detections[ detections[column_name] >= max_distance ]
 
 if __name__ == "__main__":
     import argparse
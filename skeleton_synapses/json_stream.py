@@ -0,0 +1,156 @@
+"""
+A minimal incremental JSON reader, for walking large files without loading them entirely.
+
+The caller navigates the document's structure (objects and arrays) explicitly,
+and decodes only the values it needs (e.g. the small per-node objects of a skeleton export)
+with the standard json decoder.  Only a small window of the file is held in memory at once.
+"""
+import json
+
+WHITESPACE = ' \t\n\r'
+
+class JsonStream(object):
+    """
+    Reads a JSON document from a file, one token (or one complete value) at a time.
+
+    Example:
+
+        stream = JsonStream(f)
+        for key in stream.iter_object():
+            if key == 'wanted':
+                value = stream.read_value()
+            else:
+                stream.skip_value()
+    """
+    def __init__(self, f, chunk_size=2**20):
+        self._file = f
+        self._chunk_size = chunk_size
+        self._buffer = ''
+        self._pos = 0
+        self._consumed = 0 # The number of bytes discarded from the buffer so far
+        self._eof = False
+        self._decoder = json.JSONDecoder()
+
+    def peek(self):
+        """
+        Skip whitespace and return the next character (without consuming it),
+        or '' at the end of the file.
+        """
+        while True:
+            while self._pos < len(self._buffer) and self._buffer[self._pos] in WHITESPACE:
+                self._pos += 1
+            if self._pos < len(self._buffer) or not self._fill():
+                return self._buffer[self._pos:self._pos+1]
+
+    def expect(self, token):
+        """
+        Consume the given (single-character) token, which must be next in the file.
+        """
+        c = self.peek()
+        if c != token:
+            raise ValueError( "Expected '{}' at offset {}, found '{}'".format( token, self._offset(), c ) )
+        self._pos += 1
+
+    def read_value(self):
+        """
+        Decode and return the next complete value (of any type).
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except ValueError:
+                # Probably cut off at the end of the buffer
+                if self._fill():
+                    continue
+                raise
+            if end == len(self._buffer) and self._fill():
+                # A number might continue in the next chunk
+                continue
+            self._pos = end
+            return value
+
+    def skip_value(self):
+        """
+        Consume the next value without keeping it.
+        Objects and arrays are skipped member by member, so they needn't fit in memory.
+        """
+        c = self.peek()
+        if c == '{':
+            for _ in self.iter_object():
+                self.skip_value()
+        elif c == '[':
+            for _ in self.iter_array():
+                self.skip_value()
+        else:
+            self.read_value()
+
+    def iter_object(self):
+        """
+        Consume an object, yielding each of its keys.
+        After each key, the caller must consume the corresponding value
+        (with read_value(), skip_value(), or another iter_* call) before advancing the iterator.
+        """
+        self.expect('{')
+        if self.peek() == '}':
+            self._pos += 1
+            return
+        while True:
+            key = self.read_value()
+            if not isinstance(key, basestring):
+                raise ValueError("Expected an object key at offset {}".format( self._offset() ))
+            self.expect(':')
+            yield key
+            if not self._end_of_member('}'):
+                return
+
+    def iter_array(self):
+        """
+        Consume an array, yielding its index for each element.
+        As with iter_object(), the caller must consume each element before advancing the iterator.
+        """
+        self.expect('[')
+        if self.peek() == ']':
+            self._pos += 1
+            return
+        index = 0
+        while True:
+            yield index
+            index += 1
+            if not self._end_of_member(']'):
+                return
+
+    def _end_of_member(self, closing_token):
+        """
+        Consume the separator after an object or array member.
+        Return True if another member follows, or False if the closing token was found.
+        """
+        c = self.peek()
+        self._pos += 1
+        if c == ',':
+            return True
+        if c == closing_token:
+            return False
+        raise ValueError( "Expected ',' or '{}' at offset {}, found '{}'".format( closing_token, self._offset()-1, c ) )
+
+    def _fill(self):
+        """
+        Discard the consumed part of the buffer and append the next chunk of the file.
+        Return False if the end of the file was already reached.
+        """
+        if self._eof:
+            return False
+        chunk = self._file.read(self._chunk_size)
+        if not chunk:
+            self._eof = True
+            return False
+        self._consumed += self._pos
+        self._buffer = self._buffer[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def _offset(self):
+        """
+        The current position in the file (for error messages).
+        """
+        return self._consumed + self._pos
@@ -2,13 +2,17 @@ import os
 import sys
 import csv
 import errno
+import shutil
 import signal
 import logging
+import multiprocessing
+from Queue import Empty
 import argparse
 import tempfile
 import warnings
-from itertools import starmap
-from collections import OrderedDict
+from functools import partial
+from itertools import starmap, izip, chain, count
+from collections import namedtuple, deque
 
 # Don't warn about duplicate python bindings for opengm
 # (We import opengm twice, as 'opengm' 'opengm_with_cplex'.)
@@ -25,6 +29,7 @@ from vigra.analysis import unique
 from scipy.spatial.distance import euclidean
 
 from lazyflow.graph import Graph
+from lazyflow.request import Request, RequestLock
 from lazyflow.utility import PathComponents, isUrl, Timer
 from lazyflow.utility.io_util import TiledVolume
 
@@ -38,8 +43,18 @@ from ilastik.applets.edgeTrainingWithMulticut.opEdgeTrainingWithMulticut import
 from ilastik.workflows.newAutocontext.newAutocontextWorkflow import NewAutocontextWorkflowBase
 from ilastik.workflows.edgeTrainingWithMulticut import EdgeTrainingWithMulticutWorkflow
 
-from skeleton_synapses.skeleton_utils import Skeleton, roi_around_node
+from skeleton_synapses.skeleton_utils import Skeleton, rois_around_nodes
 from skeleton_synapses.progress_server import ProgressInfo, ProgressServer
+from skeleton_synapses.sharding import STACK_NAMES, shard_branches, merge_shards
+from skeleton_synapses.roi_planning import coalesce_rois_by_slice, group_overlapping_rois
+from skeleton_synapses.prediction_cache import PredictionCache
+from skeleton_synapses.checkpoint import Checkpoint, save_checkpoint, load_checkpoint, remove_checkpoint
+from skeleton_synapses.tile_cache import TileCache, TileSource, TilePrefetcher, create_session, install_tile_cache
+from skeleton_synapses.synapse_identity import GlobalSynapseRelabeler, rewrite_synapse_ids, rewritten_path, \
+                                               replace_rewritten_files
+from skeleton_synapses.detection_table import read_detections, write_detections
+from skeleton_synapses.output_writers import StackWriter, BackgroundWriter, StackOptions, DEFAULT_STACK_OPTIONS, \
+                                             COMPRESSION_CHOICES, dataset_options
 from skeleton_utils import CSV_FORMAT
 
 # Import requests in advance so we can silence its log messages.
@@ -56,6 +71,8 @@ SYNAPSE_CHANNEL = 2
 
 INFINITE_DISTANCE = 99999.0 
 
+DETECTION_TABLE_FORMATS = ['h5', 'npy']
+
 OUTPUT_COLUMNS = [ "synapse_id", "overlaps_node_segment",
                    "x_px", "y_px", "z_px", "size_px",
                    "tile_x_px", "tile_y_px", "tile_index",
@@ -63,11 +80,15 @@ OUTPUT_COLUMNS = [ "synapse_id", "overlaps_node_segment",
                    "detection_uncertainty",
                    "node_id", "node_x_px", "node_y_px", "node_z_px" ]
 
+# The images computed for a single node, before they are committed to the output files.
+NodeResult = namedtuple('NodeResult', 'node_info roi_xyz raw_xyc predictions_xyc synapse_cc_xy segmentation_xy')
+
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument('--roi-radius-px', default=150,
-                        help='The radius (in pixels) around each skeleton node to search for synapses')
+    add_locate_arguments(parser)
+    parser.add_argument('--skeleton-id',
+                        help='Which skeleton to process, if the skeleton file contains more than one.')
     parser.add_argument('skeleton_json',
                         help="A 'treenode and connector geometry' file exported from CATMAID")
     parser.add_argument('autocontext_project',
@@ -87,174 +108,884 @@ def main():
     # Read the volume resolution
     volume_description = TiledVolume.readDescription(args.volume_description)
     z_res, y_res, x_res = volume_description.resolution_zyx
+
+    locate_kwargs = locate_kwargs_from_args(parser, args, volume_description)
     
-    skeleton = Skeleton(args.skeleton_json, (x_res, y_res, z_res))
+    skeleton = Skeleton(args.skeleton_json, (x_res, y_res, z_res), args.skeleton_id)
     
     # Name the output directory with the skeleton id
     output_dir = args.output_dir + "/{}".format(skeleton.skeleton_id)
     mkdir_p(output_dir)
-    
+
     progress_server = None
     progress_callback = lambda p: None
     if args.progress_port:
         # Start a server for others to poll progress.
         progress_server = ProgressServer.create_and_start( "localhost", args.progress_port )
         progress_callback = progress_server.update_progress
+
     try:
-        locate_synapses( args.autocontext_project,
-                         args.multicut_project,
-                         args.volume_description,
-                         output_dir,
-                         skeleton,
-                         args.roi_radius_px,
-                         progress_callback )
+        if args.processes > 1:
+            locate_synapses_sharded( args.autocontext_project,
+                                     args.multicut_project,
+                                     args.volume_description,
+                                     output_dir,
+                                     skeleton,
+                                     args.roi_radius_px,
+                                     args.processes,
+                                     progress_callback,
+                                     **locate_kwargs )
+        else:
+            locate_synapses( args.autocontext_project,
+                             args.multicut_project,
+                             args.volume_description,
+                             output_dir,
+                             skeleton,
+                             args.roi_radius_px,
+                             progress_callback,
+                             **locate_kwargs )
     finally:
         if progress_server:
             progress_server.shutdown()
 
 
+def add_locate_arguments(parser):
+    """
+    Add the options that control the processing of each skeleton to the given ArgumentParser.
+    (Shared by the single-skeleton and batch entry points.)
+    """
+    parser.add_argument('--roi-radius-px', type=int, default=150,
+                        help='The radius (in pixels) around each skeleton node to search for synapses')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='How many nodes to process concurrently. '
+                             'If 0, nodes are processed one at a time. '
+                             'The output is identical either way.  '
+                             'Each worker segments its nodes in its own lane of the multicut project.')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='Split the skeleton branches into this many shards, '
+                             'each of which is processed in a separate process. '
+                             'The shard outputs are merged at the end.')
+    parser.add_argument('--prediction-batch-size', type=int, default=1,
+                        help='Request predictions for this many consecutive nodes at once. '
+                             'Nodes in the same z-slice are combined into a single request '
+                             'for their bounding box (if that does not increase the number of predicted pixels).')
+    parser.add_argument('--merge-overlapping-rois', type=float, default=None, metavar='MIN_OVERLAP',
+                        help='If given, nodes in the same prediction batch and z-slice whose rois overlap '
+                             'by at least this fraction are processed as a single merged tile, '
+                             'from which each node\'s outputs are cut out.')
+    parser.add_argument('--prediction-cache-dir',
+                        help='A directory in which to cache the predictions for each tile, '
+                             'to avoid recomputing them in subsequent runs.')
+    parser.add_argument('--prediction-cache-size-mb', type=float, default=10000,
+                        help='The max size of the prediction cache.  '
+                             'When full, the least recently used tiles are evicted.')
+    parser.add_argument('--tile-cache-size-mb', type=float, default=1000,
+                        help='The max size of the in-memory cache of decoded raw data tiles.  '
+                             'If 0, the tiles are not cached.  '
+                             '(Not allowed for volumes with file:// tile urls, e.g. snapshots.)')
+    parser.add_argument('--tile-cache-spill-dir',
+                        help='A directory in which to keep the raw data tiles that are evicted from the tile cache.')
+    parser.add_argument('--http-connections', type=int, default=10,
+                        help='How many (keep-alive) connections to keep open to the tile server.')
+    parser.add_argument('--prefetch-distance', type=int, default=20,
+                        help='Fetch the raw data tiles for this many upcoming nodes in the background.  '
+                             'If 0 (or if the tile cache is disabled), nothing is prefetched.')
+    parser.add_argument('--prefetch-threads', type=int, default=4,
+                        help='How many raw data tiles to prefetch concurrently.')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue an interrupted run from its last checkpoint, '
+                             'rather than starting over.')
+    parser.add_argument('--flush-interval', type=int, default=10,
+                        help='How often (in nodes) to flush the output files to disk and record a checkpoint.  '
+                             'The image stacks are closed at each checkpoint (and reopened for the next node).')
+    parser.add_argument('--max-pending-writes', type=int, default=10,
+                        help='The output files are written in a background thread. '
+                             'This many nodes may be waiting to be written before processing is paused.')
+    parser.add_argument('--disable-output', action='append', default=[], choices=STACK_NAMES, metavar='NAME',
+                        help='Don\'t write the given image stack ({}).  May be given more than once.'
+                             .format( ", ".join(STACK_NAMES) ))
+    parser.add_argument('--compression', action='append', default=[], metavar='[NAME=]CODEC',
+                        help='Compress the image stacks with the given codec ({}).  '
+                             'Use NAME=CODEC to choose the codec for a single stack.  '
+                             'Blosc requires the hdf5plugin package.'.format( ", ".join(COMPRESSION_CHOICES) ))
+    parser.add_argument('--export-segmentation', action='store_true',
+                        help='Compute the multicut segmentation for every node and write segmentation.h5.  '
+                             'By default, the segmentation is only computed for nodes with synapse detections, '
+                             'and it is not written.')
+    parser.add_argument('--quantize-predictions', action='store_true',
+                        help='Store the predictions as uint8 (probability * 255) instead of float32.')
+    parser.add_argument('--min-synapse-overlap', type=float, default=None, metavar='FRACTION',
+                        help='A detection is only considered the same synapse as a detection in the previous '
+                             'node\'s tile if at least this fraction of its pixels overlap it.  '
+                             'By default, any overlap is sufficient.')
+    parser.add_argument('--global-synapse-ids', action='store_true',
+                        help='Link overlapping detections from all nodes (not just consecutive ones) '
+                             'into a single synapse id.  The ids are finalized at the end of the run.  '
+                             'Not supported with --processes.')
+    parser.add_argument('--detection-table', choices=DETECTION_TABLE_FORMATS,
+                        help='When the skeleton is finished, also write its detections as a typed, columnar table '
+                             'in the given format (next to the csv file), which the post-processing tools '
+                             'can load much faster than the csv.')
+
+
+def locate_kwargs_from_args(parser, args, volume_description):
+    """
+    Validate the options added by add_locate_arguments(), set up the caches they ask for,
+    and return the corresponding keyword arguments for locate_synapses().
+    """
+    if args.global_synapse_ids and args.processes > 1:
+        parser.error("--global-synapse-ids can't be combined with --processes")
+    if args.tile_cache_size_mb <= 0 and volume_description.tile_url_format.startswith('file://'):
+        # TiledVolume itself can't read file:// urls (e.g. the tiles of a snapshot_volume snapshot).
+        parser.error("Volumes with file:// tile urls can only be read through the tile cache.  "
+                     "Use a nonzero --tile-cache-size-mb.")
+
+    # Storage options for each (enabled) output stack
+    compression = dict.fromkeys(STACK_NAMES, 'none')
+    for setting in args.compression:
+        names, codec = STACK_NAMES, setting
+        if '=' in setting:
+            name, codec = setting.split('=', 1)
+            names = [name]
+        if not set(names).issubset(STACK_NAMES) or codec not in COMPRESSION_CHOICES:
+            parser.error("Invalid --compression setting: {}".format( setting ))
+        for name in names:
+            compression[name] = codec
+
+    stack_options = {}
+    disabled_outputs = set(args.disable_output)
+    if not args.export_segmentation:
+        disabled_outputs.add("segmentation")
+    for name in STACK_NAMES:
+        if name not in disabled_outputs:
+            quantize = (name == "predictions" and args.quantize_predictions)
+            stack_options[name] = StackOptions(compression[name], quantize)
+            try:
+                dataset_options(stack_options[name])
+            except RuntimeError as ex:
+                parser.error(str(ex))
+
+    prefetch_source = None
+    if args.tile_cache_size_mb > 0:
+        # All raw data reads (for both the classifier and the raw output) go through the shared tile cache.
+        auth = None
+        if getattr(volume_description, 'username', None):
+            auth = (volume_description.username, volume_description.password)
+        tile_cache = TileCache(args.tile_cache_size_mb, args.tile_cache_spill_dir)
+        tile_session = create_session(args.http_connections, auth)
+        install_tile_cache(tile_cache, tile_session)
+        # The prefetcher shares the installed cache, including its record of the tiles
+        # being fetched, so a tile that is being prefetched isn't downloaded again by TiledVolume.
+        prefetch_source = TileSource(volume_description, tile_cache, tile_session)
+
+    prediction_cache = None
+    if args.prediction_cache_dir:
+        prediction_cache = PredictionCache( args.prediction_cache_dir,
+                                            args.autocontext_project,
+                                            args.volume_description,
+                                            args.prediction_cache_size_mb )
+
+    return dict( num_workers=args.workers,
+                 prediction_batch_size=args.prediction_batch_size,
+                 min_tile_overlap=args.merge_overlapping_rois,
+                 prediction_cache=prediction_cache,
+                 resume=args.resume,
+                 flush_interval=args.flush_interval,
+                 max_pending_writes=args.max_pending_writes,
+                 stack_options=stack_options,
+                 min_synapse_overlap=args.min_synapse_overlap,
+                 global_synapse_ids=args.global_synapse_ids,
+                 prefetch_source=prefetch_source,
+                 prefetch_distance=args.prefetch_distance,
+                 prefetch_threads=args.prefetch_threads,
+                 detection_table=args.detection_table )
+
+
 def locate_synapses( autocontext_project_path, 
                      multicut_project,
                      input_filepath,
                      output_dir, 
                      skeleton,
                      roi_radius_px,
-                     progress_callback=lambda p: None ):
+                     progress_callback=lambda p: None,
+                     num_workers=0,
+                     prediction_batch_size=1,
+                     min_tile_overlap=None,
+                     prediction_cache=None,
+                     resume=False,
+                     flush_interval=10,
+                     max_pending_writes=10,
+                     stack_options=None,
+                     min_synapse_overlap=None,
+                     global_synapse_ids=False,
+                     prefetch_source=None,
+                     prefetch_distance=20,
+                     prefetch_threads=4,
+                     detection_table=None,
+                     projects=None,
+                     branches=None ):
     """
     autocontext_project_path: Path to .ilp file.  Must use axis order 'xytc'.
+    num_workers: How many batches of nodes to process concurrently (via lazyflow requests).
+                 Regardless of this setting, the results are committed to the
+                 output files in the original node order.
+    prediction_batch_size: How many consecutive nodes to request predictions for at once.
+                           (See predictions_for_rois())
+    min_tile_overlap: If given, nodes within the same batch whose rois overlap by at least
+                      this fraction are processed as a single merged tile.
+                      (See roi_planning.group_overlapping_rois())
+    prediction_cache: If given, a PredictionCache to read and write the predictions of each tile.
+    resume: If True, continue after the last node recorded in output_dir's checkpoint file (if any),
+            rather than starting over.
+    flush_interval: How often (in nodes) to flush the output files and record a checkpoint.
+    max_pending_writes: How many nodes' outputs may be waiting to be written before the computation
+                        waits for the (background) writer to catch up.
+    stack_options: A dict of { stack_name : StackOptions } for each image stack to write.
+                   Stacks that aren't listed are not written at all.
+                   If the segmentation stack isn't listed, the segmentation is only computed for
+                   tiles that contain synapse detections.
+                   By default, all stacks in STACK_NAMES are written, uncompressed.
+    min_synapse_overlap: If given, a detection only inherits the synapse id of a detection in the
+                         previous node's tile if at least this fraction of its pixels overlap it.
+    global_synapse_ids: If True, link detections across all tiles (see GlobalSynapseRelabeler),
+                        rather than only between consecutive nodes.
+                        The synapse ids are finalized when all nodes have been processed.
+    prefetch_source: If given, a TileSource (sharing the installed tile cache) with which to prefetch
+                     the raw data tiles for the upcoming nodes.
+    prefetch_distance: How many nodes ahead of the processing to prefetch.
+    prefetch_threads: How many tiles to prefetch concurrently.
+    detection_table: If given ('h5' or 'npy'), also write the final detections in that
+                     columnar format (see write_detection_table()).
+    projects: The LoadedProjects to use (see load_projects()), with at least num_workers multicut lanes.
+              By default, the projects are loaded from the given paths.
+    branches: The branches to process.  By default, all of skeleton.branches.
     """
+    if branches is None:
+        branches = skeleton.branches
+    if stack_options is None:
+        stack_options = dict.fromkeys(STACK_NAMES, DEFAULT_STACK_OPTIONS)
+
     output_path = output_dir + "/skeleton-{}-synapses.csv".format(skeleton.skeleton_id)
-    skeleton_branch_count = len(skeleton.branches)
-    skeleton_node_count = sum( map(len, skeleton.branches) )
+    skeleton_branch_count = len(branches)
+    skeleton_node_count = sum( map(len, branches) )
+
+    if projects is None:
+        projects = load_projects(autocontext_project_path, multicut_project, input_filepath, max(1, num_workers))
+    opPixelClassification = projects.opPixelClassification
+    multicut_lanes = projects.multicut_lanes
+    if len(multicut_lanes) < num_workers:
+        logger.warning("Only {} multicut lanes for {} workers: some workers will wait to segment their nodes."
+                       .format( len(multicut_lanes), num_workers ))
+
+    # Unless the segmentation stack is being written, the (expensive) segmentation
+    # is only computed for tiles that contain at least one detection.
+    export_segmentation = ("segmentation" in stack_options)
+    
+    timing_logger = logging.getLogger(__name__ + '.timing')
+    timing_logger.setLevel(logging.INFO)
 
-    autocontext_shell = open_project(autocontext_project_path, init_logging=True)
-    assert isinstance(autocontext_shell, HeadlessShell)
-    assert isinstance(autocontext_shell.workflow, NewAutocontextWorkflowBase)
+    def process_batch(batch_node_infos):
+        """
+        Compute all images for the given batch of nodes.
+        This may run concurrently with other batches, so it must not touch any output state.
+        Returns: A list of NodeResults
+        """
+        with Timer() as batch_timer:
+            rois_xyz = rois_around_nodes(batch_node_infos, roi_radius_px)
+            if min_tile_overlap is None:
+                tiles = [ (roi_xyz, [node_index]) for node_index, roi_xyz in enumerate(rois_xyz) ]
+            else:
+                tiles = group_overlapping_rois(rois_xyz, min_tile_overlap)
+
+            tile_predictions = predictions_for_rois([tile_roi for tile_roi, _ in tiles], opPixelClassification, prediction_cache)
+
+            node_results = [None] * len(batch_node_infos)
+            for (tile_roi, node_indexes), predictions_xyc in zip(tiles, tile_predictions):
+                # The tile is centered on its first node, unless it's a merged tile.
+                # (In which case the first node is merely used for logging.)
+                node_info = batch_node_infos[node_indexes[0]]
+                skeleton_coord = (node_info.x_px, node_info.y_px, node_info.z_px)
+                logger.debug("skeleton point: {}".format( skeleton_coord ))
+
+                raw_xyc = raw_data_for_node(node_info, tile_roi, opPixelClassification)
+                synapse_cc_xy = labeled_synapses_for_node(node_info, tile_roi, predictions_xyc)
+                if export_segmentation or synapse_cc_xy.any():
+                    segmentation_xy = segmentation_for_node(node_info, tile_roi, multicut_lanes, raw_xyc[...,0], predictions_xyc)
+                else:
+                    # Without any detections, the segmentation isn't needed for the CSV output.
+                    segmentation_xy = np.zeros(raw_xyc.shape[:2], dtype=np.uint32)
+
+                if len(node_indexes) == 1:
+                    node_results[node_indexes[0]] = NodeResult(node_info, tile_roi, raw_xyc, predictions_xyc, synapse_cc_xy, segmentation_xy)
+                    continue
+
+                logger.debug("Computed {} nodes as a single {} tile"
+                             .format( len(node_indexes), tuple(tile_roi[1] - tile_roi[0]) ))
+                for node_index in node_indexes:
+                    roi_xyz = rois_xyz[node_index]
+                    view_slicing = slicing( (roi_xyz - tile_roi[0])[:, :2] )
+                    node_results[node_index] = NodeResult( batch_node_infos[node_index],
+                                                           roi_xyz,
+                                                           raw_xyc[view_slicing],
+                                                           predictions_xyc[view_slicing],
+                                                           synapse_cc_xy[view_slicing],
+                                                           segmentation_xy[view_slicing] )
+
+        timing_logger.info( "NODE TIMER: {}".format( batch_timer.seconds() / len(batch_node_infos) ) )
+        return node_results
+
+    synapse_cc_path = output_dir + "/synapse_cc.h5"
+    if global_synapse_ids:
+        relabeler = GlobalSynapseRelabeler(min_synapse_overlap, output_dir + "/synapse-ids.journal")
+    else:
+        relabeler = SynapseSliceRelabeler(min_synapse_overlap)
+
+    # The output stacks, by name (created as needed)
+    stack_writers = {}
+    first_node_index = 0
+
+    checkpoint = None
+    if resume:
+        checkpoint = load_checkpoint(output_dir)
+        if checkpoint is None:
+            logger.info("No checkpoint found in {}.  Starting from the beginning.".format( output_dir ))
+    else:
+        remove_checkpoint(output_dir)
+
+    if checkpoint is not None:
+        if (checkpoint.skeleton_id, checkpoint.skeleton_node_count) != (skeleton.skeleton_id, skeleton_node_count):
+            raise RuntimeError("Can't resume: The checkpoint in {} was written for skeleton {} ({} nodes)"
+                               .format( output_dir, checkpoint.skeleton_id, checkpoint.skeleton_node_count ))
+        if checkpoint.relabeler_class != type(relabeler).__name__:
+            raise RuntimeError("Can't resume: The checkpoint in {} was written by a {}, not a {}.  "
+                               "(Use the same --global-synapse-ids setting as the interrupted run.)"
+                               .format( output_dir, checkpoint.relabeler_class, type(relabeler).__name__ ))
+
+        relabeler.restore_state(checkpoint.relabeler_state)
+        if global_synapse_ids and relabeler.finalized:
+            # The final ids were written, but they might not have replaced the provisional ones yet.
+            replace_rewritten_files(output_path, synapse_cc_path)
+
+        # Discard anything that was written after the checkpoint.
+        first_node_index = checkpoint.node_overall_index + 1
+        for name, num_slices in checkpoint.stack_lengths.items():
+            if name in stack_options:
+                stack_writers[name] = StackWriter( output_dir + "/" + name + ".h5",
+                                                   resume_length=num_slices,
+                                                   options=stack_options[name] )
+        with open(output_path, "r+") as f:
+            f.truncate(checkpoint.csv_offset)
+        logger.info("Resuming from node {}/{}".format( first_node_index, skeleton_node_count ))
+
+    def write_stack(image_xyc, name, roi_name):
+        if name not in stack_options:
+            return
+        try:
+            writer = stack_writers[name]
+        except KeyError:
+            writer = stack_writers[name] = StackWriter(output_dir + "/" + name + ".h5", options=stack_options[name])
+        writer.append(image_xyc, roi_name)
 
-    append_lane(autocontext_shell.workflow, input_filepath, 'xyt')
+    try:
+        with open(output_path, "a" if checkpoint else "w") as fout:
+            fout.seek(0, os.SEEK_END)
+            csv_writer = csv.DictWriter(fout, OUTPUT_COLUMNS, **CSV_FORMAT)
+            if checkpoint is None:
+                csv_writer.writeheader()
+
+            def write_node_outputs(node_result, synapse_cc_xy, node_overall_index):
+                """
+                Write the given node's images and synapses to the output files.
+                (Runs in the background writer thread.)
+                """
+                roi_name = "x{}-y{}-z{}".format(*node_result.roi_xyz[0])
+                write_stack(node_result.raw_xyc, "raw", roi_name)
+                write_stack(node_result.predictions_xyc, "predictions", roi_name)
+                write_stack(synapse_cc_xy[...,None], "synapse_cc", roi_name)
+                write_stack(node_result.segmentation_xy[:,:,None], "segmentation", roi_name)
+    
+                write_synapses( csv_writer,
+                                skeleton,
+                                node_result.node_info,
+                                node_result.roi_xyz,
+                                synapse_cc_xy,
+                                node_result.predictions_xyc,
+                                node_result.segmentation_xy,
+                                node_overall_index )
+
+            def flush_and_checkpoint(node_overall_index, relabeler_state):
+                """
+                Flush all outputs to disk, and then record a checkpoint for the given node.
+                (Runs in the background writer thread.)
+                The image stacks are closed (see StackWriter.flush()) before the checkpoint is saved,
+                so the checkpoint never refers to a stack that is still open for writing.
+                """
+                for writer in stack_writers.values():
+                    writer.flush()
+                fout.flush()
+                stack_lengths = { name : len(writer) for name, writer in stack_writers.items() }
+                save_checkpoint( output_dir, Checkpoint( skeleton.skeleton_id,
+                                                         skeleton_node_count,
+                                                         node_overall_index,
+                                                         fout.tell(),
+                                                         stack_lengths,
+                                                         type(relabeler).__name__,
+                                                         relabeler_state ) )
+
+            node_infos = [node_info for branch in branches for node_info in branch][first_node_index:]
+            node_positions = [ (branch_index, node_index_in_branch, len(branch))
+                               for branch_index, branch in enumerate(branches)
+                               for node_index_in_branch in range(len(branch)) ][first_node_index:]
+    
+            batches = [ node_infos[i:i+prediction_batch_size] for i in range(0, len(node_infos), prediction_batch_size) ]
+
+            prefetcher = None
+            if prefetch_source is not None and prefetch_distance > 0:
+                # Fetch the raw data tiles for the upcoming nodes in the background.
+                prefetcher = TilePrefetcher( prefetch_source,
+                                             rois_around_nodes(node_infos, roi_radius_px),
+                                             prefetch_distance,
+                                             prefetch_threads )
+                def prefetched_batches():
+                    for batch_index, batch in enumerate(batches):
+                        # Stay ahead of the batches as they are submitted for processing.
+                        prefetcher.advance(batch_index * prediction_batch_size)
+                        yield batch
+                node_results = chain.from_iterable( ordered_request_map(process_batch, prefetched_batches(), num_workers) )
+            else:
+                node_results = chain.from_iterable( ordered_request_map(process_batch, batches, num_workers) )
 
-    # We only use the final stage predictions
-    opPixelClassification = autocontext_shell.workflow.pcApplets[-1].topLevelOperator
+            # All output files are written by a separate thread, so that disk I/O overlaps with computation.
+            background_writer = BackgroundWriter(max_pending_writes)
+            try:
+                for node_overall_index, (node_result, node_position) in enumerate( izip(node_results, node_positions), first_node_index ):
+                    branch_index, node_index_in_branch, branch_node_count = node_position
+        
+                    # The relabeler depends on the previous node's result,
+                    # so it must be applied here, in node order.
+                    synapse_cc_xy = relabeler.normalize_synapse_ids(node_result.synapse_cc_xy, node_result.roi_xyz)
+                    background_writer.submit(write_node_outputs, node_result, synapse_cc_xy, node_overall_index)
+    
+                    if (node_overall_index+1) % flush_interval == 0 or node_overall_index+1 == skeleton_node_count:
+                        # Copy the relabeler state now, since the relabeler will move on to the next node
+                        # before the background writer gets around to saving the checkpoint.
+                        background_writer.submit(flush_and_checkpoint, node_overall_index, relabeler.state())
+        
+                    progress = 100*float(node_overall_index)/skeleton_node_count
+                    logger.debug("PROGRESS: node {}/{} ({:.1f}%) ({} detections)"
+                                 .format(node_overall_index, skeleton_node_count, progress, relabeler.max_label))
+        
+                    # Progress: notify client
+                    progress_callback( ProgressInfo( node_overall_index,
+                                                     skeleton_node_count,
+                                                     branch_index,
+                                                     skeleton_branch_count,
+                                                     node_index_in_branch,
+                                                     branch_node_count,
+                                                     relabeler.max_label ) )
+            except:
+                # Finish writing before the output files are closed,
+                # but don't let a write error replace the original exception.
+                exc_info = sys.exc_info()
+                background_writer.close(raise_errors=False)
+                raise exc_info[0], exc_info[1], exc_info[2]
+            else:
+                # Finish writing (and re-raise any write errors) before the output files are closed.
+                background_writer.close()
+            finally:
+                if prefetcher is not None:
+                    prefetcher.close()
+    finally:
+        for writer in stack_writers.values():
+            writer.close()
+
+    if global_synapse_ids and not relabeler.finalized:
+        logger.info("Assigning global synapse ids...")
+        rewritten_stack_path = synapse_cc_path if "synapse_cc" in stack_writers else None
+        rewrite_synapse_ids(relabeler.final_id_mapping(), output_path, rewritten_stack_path)
+
+        # Record that the rewritten files are complete before they replace the originals,
+        # so a resumed run only finishes replacing them, rather than rewriting the ids a second time.
+        relabeler.finalized = True
+        stack_lengths = { name : len(writer) for name, writer in stack_writers.items() }
+        save_checkpoint( output_dir, Checkpoint( skeleton.skeleton_id,
+                                                 skeleton_node_count,
+                                                 skeleton_node_count-1,
+                                                 os.path.getsize(rewritten_path(output_path)),
+                                                 stack_lengths,
+                                                 type(relabeler).__name__,
+                                                 relabeler.state() ) )
+        replace_rewritten_files(output_path, rewritten_stack_path)
+
+    if detection_table:
+        write_detection_table(output_path, detection_table)
+    logger.info("DONE with skeleton.")
 
-    # Sanity checks
-    assert isinstance(opPixelClassification, OpPixelClassification)
-    assert opPixelClassification.Classifier.ready()
-    assert opPixelClassification.HeadlessPredictionProbabilities[-1].meta.drange == (0.0, 1.0)
 
-    multicut_shell = open_project(multicut_project, init_logging=False)
-    assert isinstance(multicut_shell, HeadlessShell)
-    assert isinstance(multicut_shell.workflow, EdgeTrainingWithMulticutWorkflow)
+def locate_synapses_sharded( autocontext_project_path,
+                             multicut_project,
+                             input_filepath,
+                             output_dir,
+                             skeleton,
+                             roi_radius_px,
+                             num_processes,
+                             progress_callback=lambda p: None,
+                             **kwargs ):
+    """
+    Like locate_synapses(), but the skeleton's branches are split into (up to) num_processes
+    shards, each of which is processed by locate_synapses() in a separate process.
+    Any extra keyword arguments are passed on to locate_synapses().
+    Each process writes its outputs into its own subdirectory of output_dir,
+    and the shard outputs are merged into output_dir when all processes have finished.
+    (See merge_shards() for details on how the synapse ids are renumbered.)
+    """
+    # The table is written from the merged csv, not by each shard.
+    detection_table = kwargs.pop('detection_table', None)
+
+    shards = shard_branches(skeleton.branches, num_processes)
+    shard_dirs = [ output_dir + "/shard-{}".format(shard_index) for shard_index in range(len(shards)) ]
     
-    timing_logger = logging.getLogger(__name__ + '.timing')
-    timing_logger.setLevel(logging.INFO)
+    # Divide the lazyflow threads among the processes, to avoid oversubscribing the machine.
+    threads_per_process = max(1, multiprocessing.cpu_count() // len(shards))
+
+    progress_queue = multiprocessing.Queue()
+    processes = []
+    for shard_index, (shard, shard_dir) in enumerate(zip(shards, shard_dirs)):
+        mkdir_p(shard_dir)
+        args = ( autocontext_project_path, multicut_project, input_filepath, shard_dir, skeleton,
+                 roi_radius_px, shard_index, threads_per_process, progress_queue )
+        shard_kwargs = dict(kwargs, branches=shard)
+        process = multiprocessing.Process(target=_locate_synapses_in_shard, args=args, kwargs=shard_kwargs)
+        process.start()
+        processes.append(process)
+
+    try:
+        # Combine the progress reports from all shards.
+        skeleton_node_count = sum( map(len, skeleton.branches) )
+        shard_progress = [ None ] * len(shards)
+        def report_progress(shard_index, progress):
+            shard_progress[shard_index] = progress
+            reported = filter(None, shard_progress)
+            progress_callback( ProgressInfo( sum(p.node_overall_index+1 for p in reported) - 1,
+                                             skeleton_node_count,
+                                             sum(p.branch_index for p in reported),
+                                             len(skeleton.branches),
+                                             progress.node_index_in_branch,
+                                             progress.branch_node_count,
+                                             sum(p.total_detections for p in reported) ) )
+
+        while any(p.is_alive() for p in processes):
+            failed_shards = [i for i, p in enumerate(processes) if p.exitcode not in (None, 0)]
+            if failed_shards:
+                raise RuntimeError("Shard {} failed. See log for details.".format( failed_shards[0] ))
+            try:
+                report_progress( *progress_queue.get(timeout=1.0) )
+            except Empty:
+                pass
+
+        # Drain any final progress messages
+        while not progress_queue.empty():
+            report_progress( *progress_queue.get() )
+
+        for shard_index, process in enumerate(processes):
+            process.join()
+            if process.exitcode != 0:
+                raise RuntimeError("Shard {} failed. See log for details.".format( shard_index ))
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+
+    logger.info("Merging {} shards...".format( len(shards) ))
+    csv_filename = "skeleton-{}-synapses.csv".format(skeleton.skeleton_id)
+    shard_node_counts = [ sum(map(len, shard)) for shard in shards ]
+    merge_shards(shard_dirs, shard_node_counts, output_dir, csv_filename, kwargs.get('stack_options'))
+    for shard_dir in shard_dirs:
+        shutil.rmtree(shard_dir)
+    if detection_table:
+        write_detection_table(output_dir + "/" + csv_filename, detection_table)
+    logger.info("DONE with skeleton.")
 
-    relabeler = SynapseSliceRelabeler()
 
-    with open(output_path, "w") as fout:
-        csv_writer = csv.DictWriter(fout, OUTPUT_COLUMNS, **CSV_FORMAT)
-        csv_writer.writeheader()
+def write_detection_table(csv_path, table_format):
+    """
+    Write a typed, columnar copy of the given detection csv file (see detection_table),
+    with the same name and the given format's extension.  Returns the new file's path.
+    """
+    table_path = os.path.splitext(csv_path)[0] + "." + table_format
+    write_detections( table_path, read_detections(csv_path) )
+    return table_path
 
-        node_overall_index = -1
-        for branch_index, branch in enumerate(skeleton.branches):
-            for node_index_in_branch, node_info in enumerate(branch):
-                with Timer() as node_timer:
-                    node_overall_index += 1
-                    roi_xyz = roi_around_node(node_info, roi_radius_px)
-                    skeleton_coord = (node_info.x_px, node_info.y_px, node_info.z_px)
-                    logger.debug("skeleton point: {}".format( skeleton_coord ))
 
-                    raw_xy = raw_data_for_node(node_info, roi_xyz, output_dir, opPixelClassification)
-                    predictions_xyc = predictions_for_node(node_info, roi_xyz, output_dir, opPixelClassification)
-                    synapse_cc_xy = labeled_synapses_for_node(node_info, roi_xyz, output_dir, relabeler, predictions_xyc)
-                    segmentation_xy = segmentation_for_node(node_info, roi_xyz, output_dir, multicut_shell.workflow, raw_xy, predictions_xyc)
+def _locate_synapses_in_shard( autocontext_project_path, multicut_project, input_filepath, shard_dir, skeleton,
+                               roi_radius_px, shard_index, num_threads, progress_queue, **kwargs ):
+    """
+    Entry point for each shard process of locate_synapses_sharded().
+    """
+    # The forked process doesn't inherit the parent's worker threads,
+    # so we need a fresh thread pool for our requests.
+    Request.reset_thread_pool(num_threads)
 
-                    write_synapses( csv_writer, skeleton, node_info, roi_xyz, synapse_cc_xy, predictions_xyc, segmentation_xy, node_overall_index )
-                    fout.flush()
+    progress_callback = lambda progress: progress_queue.put( (shard_index, progress) )
+    locate_synapses( autocontext_project_path,
+                     multicut_project,
+                     input_filepath,
+                     shard_dir,
+                     skeleton,
+                     roi_radius_px,
+                     progress_callback,
+                     **kwargs )
 
-                timing_logger.info( "NODE TIMER: {}".format( node_timer.seconds() ) )
 
-                progress = 100*float(node_overall_index)/skeleton_node_count
-                logger.debug("PROGRESS: node {}/{} ({:.1f}%) ({} detections)"
-                             .format(node_overall_index, skeleton_node_count, progress, relabeler.max_label))
+def ordered_request_map(func, items, max_pending):
+    """
+    Like itertools.imap(func, items), but each call is executed in its own lazyflow Request,
+    with up to max_pending calls in flight at any time.
+    The results are yielded in the same order as the items.
+    
+    If max_pending is 0, the calls are made serially in the calling thread.
+    """
+    if max_pending <= 0:
+        for item in items:
+            yield func(item)
+        return
 
-                # Progress: notify client
-                progress_callback( ProgressInfo( node_overall_index,
-                                                 skeleton_node_count,
-                                                 branch_index,
-                                                 skeleton_branch_count,
-                                                 node_index_in_branch,
-                                                 len(branch),
-                                                 relabeler.max_label ) )
-    logger.info("DONE with skeleton.")
+    pending = deque()
+    try:
+        for item in items:
+            req = Request( partial(func, item) )
+            req.submit()
+            pending.append( req )
+            if len(pending) >= max_pending:
+                yield pending.popleft().wait()
+        while pending:
+            yield pending.popleft().wait()
+    finally:
+        # If the caller quit early (e.g. due to an exception), don't leave orphaned work behind.
+        for req in pending:
+            req.cancel()
 
 
-def raw_data_for_node(node_info, roi_xyz, output_dir, opPixelClassification):
-    roi_name = "x{}-y{}-z{}".format(*roi_xyz[0])
+def raw_data_for_node(node_info, roi_xyz, opPixelClassification):
+    """
+    Fetch the raw data around the given node.
+    Returns: raw_xyc
+    """
     raw_xyzc = opPixelClassification.InputImages[-1](list(roi_xyz[0]) + [0], list(roi_xyz[1]) + [1]).wait()
     raw_xyzc = vigra.taggedView(raw_xyzc, 'xyzc')
-    write_output_image(output_dir, raw_xyzc[:,:,0,:], "raw", roi_name)
-    raw_xy = raw_xyzc[:,:,0,0]
-    return raw_xy
+    raw_xyc = raw_xyzc[:,:,0,:]
+    return raw_xyc
 
-# opThreshold is global so we don't waste time initializing it repeatedly.
-opThreshold = OpThresholdTwoLevels(graph=Graph())
-def predictions_for_node(node_info, roi_xyz, output_dir, opPixelClassification):
+def predictions_for_rois(rois_xyz, opPixelClassification, prediction_cache=None):
     """
-    Run classification on the given node with the given operator.
-    Returns: predictions_xyc
+    Run classification on each of the given rois (each a single z-slice) with the given operator.
+    
+    Rois that lie in the same z-slice (and are close enough together)
+    are combined into a single request for their bounding box, and the results are
+    split back out for each roi.  All requests are submitted at once, so the classifier
+    can process them in parallel.  (Since the pixel features are computed with a halo from
+    the full volume, the results are identical to requesting each roi separately.)
+
+    If a PredictionCache is given, rois that are already in the cache aren't computed at all,
+    and the others are added to the cache after they are computed.
+
+    Returns: A list of predictions_xyc, one for each roi (in order).
     """
-    roi_name = "x{}-y{}-z{}".format(*roi_xyz[0])
-    skeleton_coord = (node_info.x_px, node_info.y_px, node_info.z_px)
-    logger.debug("skeleton point: {}".format( skeleton_coord ))
+    all_predictions = [None] * len(rois_xyz)
+    if prediction_cache is not None:
+        for roi_index, roi_xyz in enumerate(rois_xyz):
+            cached_predictions = prediction_cache.get(roi_xyz)
+            if cached_predictions is not None:
+                all_predictions[roi_index] = vigra.taggedView( cached_predictions, "xyc" )
+
+    missing_indexes = [ i for i, predictions in enumerate(all_predictions) if predictions is None ]
+    if not missing_indexes:
+        return all_predictions
 
-    # Predict
     num_classes = opPixelClassification.HeadlessPredictionProbabilities[-1].meta.shape[-1]
-    roi_xyzc = np.append(roi_xyz, [[0],[num_classes]], axis=1)
-    predictions_xyzc = opPixelClassification.HeadlessPredictionProbabilities[-1](*roi_xyzc).wait()
-    predictions_xyzc = vigra.taggedView( predictions_xyzc, "xyzc" )
-    predictions_xyc = predictions_xyzc[:,:,0,:]
-    write_output_image(output_dir, predictions_xyc, "predictions", roi_name)
-    return predictions_xyc
-
-def labeled_synapses_for_node(node_info, roi_xyz, output_dir, relabeler, predictions_xyc):
-    roi_name = "x{}-y{}-z{}".format(*roi_xyz[0])
+    roi_groups = coalesce_rois_by_slice([ rois_xyz[i] for i in missing_indexes ])
+    # Convert group indexes back to indexes into rois_xyz
+    roi_groups = [ (group_roi_xyz, [ missing_indexes[i] for i in group_indexes ])
+                   for group_roi_xyz, group_indexes in roi_groups ]
+
+    requests = []
+    for group_roi_xyz, _roi_indexes in roi_groups:
+        group_roi_xyzc = np.append(group_roi_xyz, [[0],[num_classes]], axis=1)
+        req = opPixelClassification.HeadlessPredictionProbabilities[-1](*group_roi_xyzc)
+        req.submit()
+        requests.append(req)
+
+    for (group_roi_xyz, roi_indexes), req in zip(roi_groups, requests):
+        group_predictions_xyzc = vigra.taggedView( req.wait(), "xyzc" )
+        if len(roi_indexes) > 1:
+            logger.debug("Predicted {} rois in a single {} request"
+                         .format( len(roi_indexes), tuple(group_roi_xyz[1] - group_roi_xyz[0]) ))
+        for roi_index in roi_indexes:
+            roi_within_group = np.asarray(rois_xyz[roi_index]) - group_roi_xyz[0]
+            predictions_xyzc = group_predictions_xyzc[slicing(roi_within_group)]
+            if len(roi_indexes) > 1:
+                # Don't keep the whole group's array alive for the sake of a single roi.
+                predictions_xyzc = predictions_xyzc.copy()
+            all_predictions[roi_index] = predictions_xyzc[:,:,0,:]
+            if prediction_cache is not None:
+                prediction_cache.put(rois_xyz[roi_index], all_predictions[roi_index])
+    return all_predictions
+
+# Threshold operators are kept in a pool so we don't waste time initializing them repeatedly.
+# (Each node that is processed concurrently needs its own operator.)
+_threshold_operators = []
+def labeled_synapses_for_node(node_info, roi_xyz, predictions_xyc):
+    """
+    Threshold the synapse channel of the given predictions and label the connected components.
+    The labels are NOT yet consistent with neighboring nodes (see SynapseSliceRelabeler).
+    Returns: synapse_cc_xy
+    """
     skeleton_coord = (node_info.x_px, node_info.y_px, node_info.z_px)
     logger.debug("skeleton point: {}".format( skeleton_coord ))
 
-    # Threshold synapses
-    opThreshold.Channel.setValue(SYNAPSE_CHANNEL)
-    opThreshold.SingleThreshold.setValue(0.5)
-    opThreshold.SmootherSigma.setValue({'x': 3.0, 'y': 3.0, 'z': 1.0})
-    opThreshold.MinSize.setValue(100)
-    opThreshold.MaxSize.setValue(5000) # This is overshooting a bit.
-    opThreshold.InputImage.setValue(predictions_xyc)
-    opThreshold.InputImage.meta.drange = (0.0, 1.0)
-    synapse_cc_xy = opThreshold.Output[:].wait()[...,0]
-    synapse_cc_xy = vigra.taggedView(synapse_cc_xy, 'xy')
-    
-    # Relabel for consistency with previous slice
-    synapse_cc_xy = relabeler.normalize_synapse_ids(synapse_cc_xy, roi_xyz)
-    write_output_image(output_dir, synapse_cc_xy[...,None], "synapse_cc", roi_name)
+    try:
+        opThreshold = _threshold_operators.pop()
+    except IndexError:
+        opThreshold = OpThresholdTwoLevels(graph=Graph())
+
+    try:
+        # Threshold synapses
+        opThreshold.Channel.setValue(SYNAPSE_CHANNEL)
+        opThreshold.SingleThreshold.setValue(0.5)
+        opThreshold.SmootherSigma.setValue({'x': 3.0, 'y': 3.0, 'z': 1.0})
+        opThreshold.MinSize.setValue(100)
+        opThreshold.MaxSize.setValue(5000) # This is overshooting a bit.
+        opThreshold.InputImage.setValue(predictions_xyc)
+        opThreshold.InputImage.meta.drange = (0.0, 1.0)
+        synapse_cc_xy = opThreshold.Output[:].wait()[...,0]
+        synapse_cc_xy = vigra.taggedView(synapse_cc_xy, 'xy')
+    finally:
+        _threshold_operators.append(opThreshold)
+
     return synapse_cc_xy
 
-def segmentation_for_node(node_info, roi_xyz, output_dir, multicut_workflow, raw_xy, predictions_xyc):
-    roi_name = "x{}-y{}-z{}".format(*roi_xyz[0])
+class MulticutLane(object):
+    """
+    A lane of the multicut workflow that is added once and then reused for every node.
+    
+    Rather than exporting each node with batchProcessingApplet.run_export()
+    (which adds a new lane, rebuilds the export operators, and removes the lane again),
+    we just replace the lane's (preloaded) input arrays and request its export image.
+
+    The lane holds one node's inputs at a time, so it must not be used by several
+    requests at once.  (See MulticutLanePool.)
+    """
+    def __init__(self, multicut_workflow):
+        opEdgeTrainingWithMulticut = multicut_workflow.edgeTrainingWithMulticutApplet.topLevelOperator
+        assert isinstance(opEdgeTrainingWithMulticut, OpEdgeTrainingWithMulticut)
+
+        opDataSelection = multicut_workflow.dataSelectionApplet.topLevelOperator
+        role_names = opDataSelection.DatasetRoles.value
+        self._raw_role = role_names.index("Raw Data")
+        self._probabilities_role = role_names.index("Probabilities")
+
+        # Add a lane
+        self.lane_index = len( opDataSelection.DatasetGroup )
+        opDataSelection.DatasetGroup.resize( self.lane_index+1 )
+        self._dataset_slots = opDataSelection.DatasetGroup[self.lane_index]
+
+        opDataExport = multicut_workflow.dataExportApplet.topLevelOperator
+        opDataExport.OutputAxisOrder.setValue('xy')
+        self._export_slot = opDataExport.getLane(self.lane_index).ImageToExport
+
+    def segment(self, raw_xy, predictions_xyc):
+        """
+        Compute the multicut segmentation of the given images.
+        Returns: segmentation_xy
+        """
+        self._dataset_slots[self._raw_role].setValue( DatasetInfo(preloaded_array=raw_xy) )
+        self._dataset_slots[self._probabilities_role].setValue( DatasetInfo(preloaded_array=predictions_xyc) )
+        return self._export_slot[:].wait()
+
+class MulticutLanePool(object):
+    """
+    A fixed set of MulticutLanes, so that several nodes can be segmented concurrently.
+    
+    All lanes are added up front (adding a lane while others are computing isn't safe),
+    and each call to segment() uses an idle lane.  With one lane per worker, there is always
+    an idle lane, so the workers never wait for each other.
+    """
+    def __init__(self, lanes):
+        assert len(lanes) >= 1
+        self._lanes = [ (lane, RequestLock()) for lane in lanes ]
+        self._turns = count()
+
+    def __len__(self):
+        return len(self._lanes)
+
+    def segment(self, raw_xy, predictions_xyc):
+        """
+        Compute the multicut segmentation of the given images in an idle lane.
+        Returns: segmentation_xy
+        """
+        lane, lock = self._acquire_lane()
+        try:
+            return lane.segment(raw_xy, predictions_xyc)
+        finally:
+            lock.release()
+
+    def _acquire_lane(self):
+        for lane, lock in self._lanes:
+            if lock.acquire(False):
+                return lane, lock
+
+        # All lanes are busy (more requests than lanes): wait for one of them, taking turns.
+        lane, lock = self._lanes[ next(self._turns) % len(self._lanes) ]
+        lock.acquire()
+        return lane, lock
+
+def segmentation_for_node(node_info, roi_xyz, multicut_lanes, raw_xy, predictions_xyc):
+    """
+    Compute a 2D multicut segmentation of the neighborhood around the given node.
+    Returns: segmentation_xy
+    """
     skeleton_coord = (node_info.x_px, node_info.y_px, node_info.z_px)
     logger.debug("skeleton point: {}".format( skeleton_coord ))
 
-    opEdgeTrainingWithMulticut = multicut_workflow.edgeTrainingWithMulticutApplet.topLevelOperator
-    assert isinstance(opEdgeTrainingWithMulticut, OpEdgeTrainingWithMulticut)
+    segmentation_xy = multicut_lanes.segment(raw_xy, predictions_xyc)
+    assert segmentation_xy.shape == raw_xy.shape[:2]
+    return segmentation_xy
 
-    opDataExport = multicut_workflow.dataExportApplet.topLevelOperator
-    opDataExport.OutputAxisOrder.setValue('xy')
 
-    role_data_dict = OrderedDict([ ("Raw Data", [ DatasetInfo(preloaded_array=raw_xy) ]),
-                                   ("Probabilities", [ DatasetInfo(preloaded_array=predictions_xyc) ])]) 
-    batch_results = multicut_workflow.batchProcessingApplet.run_export(role_data_dict, export_to_array=True)
-    assert len(batch_results) == 1
-    segmentation_xy = batch_results[0]
-    write_output_image(output_dir, segmentation_xy[:,:,None], "segmentation", roi_name)
-    return segmentation_xy
+# The ilastik projects used by locate_synapses(), ready for processing:
+# - autocontext_shell, multicut_shell: The HeadlessShells (kept open for as long as the projects are used)
+# - opPixelClassification: The final stage of the autocontext workflow, with a lane for the input volume
+# - multicut_lanes: A MulticutLanePool for the multicut workflow
+LoadedProjects = namedtuple('LoadedProjects', 'autocontext_shell multicut_shell opPixelClassification multicut_lanes')
+
+def load_projects(autocontext_project_path, multicut_project, input_filepath, num_multicut_lanes=1):
+    """
+    Open both project files and add a lane for the given input volume.
+    The result can be passed to any number of locate_synapses() calls (for the same volume).
+    
+    num_multicut_lanes: How many nodes can be segmented concurrently.
+                        (Should be at least the num_workers passed to locate_synapses().)
+    """
+    autocontext_shell = open_project(autocontext_project_path, init_logging=True)
+    assert isinstance(autocontext_shell, HeadlessShell)
+    assert isinstance(autocontext_shell.workflow, NewAutocontextWorkflowBase)
+
+    append_lane(autocontext_shell.workflow, input_filepath, 'xyt')
+
+    # We only use the final stage predictions
+    opPixelClassification = autocontext_shell.workflow.pcApplets[-1].topLevelOperator
+
+    # Sanity checks
+    assert isinstance(opPixelClassification, OpPixelClassification)
+    assert opPixelClassification.Classifier.ready()
+    assert opPixelClassification.HeadlessPredictionProbabilities[-1].meta.drange == (0.0, 1.0)
+
+    multicut_shell = open_project(multicut_project, init_logging=False)
+    assert isinstance(multicut_shell, HeadlessShell)
+    assert isinstance(multicut_shell.workflow, EdgeTrainingWithMulticutWorkflow)
+    multicut_lanes = MulticutLanePool( [ MulticutLane(multicut_shell.workflow) for _ in range(num_multicut_lanes) ] )
+
+    return LoadedProjects(autocontext_shell, multicut_shell, opPixelClassification, multicut_lanes)
 
 
 def open_project( project_path, init_logging=True ):
@@ -310,71 +1041,35 @@ def append_lane(workflow, input_filepath, axisorder=None):
     opDataSelection.DatasetGroup[-1][role_index].setValue( info )
 
 
-initialized_files = set()
-def write_output_image(output_dir, image_xyc, name, name_prefix="", mode="stacked"):
-    """
-    Write the given image to an hdf5 file.
-    
-    If mode is "slices", create a new file for the image.
-    If mode is "stacked", create a new file with 'name' if it doesn't exist yet,
-    or append to it if it does.
-    """
-    global initialized_files
-    if not output_dir:
-        return
-    
-    # Insert a Z-axis
-    image_xyzc = vigra.taggedView(image_xyc[:,:,None,:], 'xyzc')
-    
-    if mode == "slices":
-        slice_name = name
-        if name_prefix:
-            slice_name = name_prefix + '-' + name
-        with h5py.File(output_dir + "/" + slice_name + ".h5", 'w') as f:
-            f.create_dataset("data", data=image_xyzc)
-
-    elif mode == "stacked":
-        # If the file exists from a previous (failed) run,
-        # delete it and start from scratch.
-        filepath = output_dir + "/" + name + ".h5"
-        if filepath not in initialized_files:
-            try:
-                os.unlink(filepath)
-            except OSError as ex:
-                if ex.errno != errno.ENOENT:
-                    raise
-            initialized_files.add(filepath)
-
-        # Also append to an HDF5 stack
-        with h5py.File(filepath) as f:
-            if 'data' in f:
-                # Add room for another z-slice
-                z_size = f['data'].shape[2]
-                f['data'].resize(z_size+1, 2)
-            else:
-                maxshape = np.array(image_xyzc.shape)
-                maxshape[2] = 100000
-                f.create_dataset('data', shape=image_xyzc.shape, maxshape=tuple(maxshape), dtype=image_xyzc.dtype)
-                f['data'].attrs['axistags'] = image_xyzc.axistags.toJSON()
-                f['data'].attrs['slice-names'] = []
-    
-            # Write onto the end of the stack.
-            f['data'][:, :, -1:, :] = image_xyzc
-
-            # Maintain an attribute 'slice-names' to list each slice's name
-            z_size = f['data'].shape[2]
-            names = list(f['data'].attrs['slice-names'])
-            names += ["{}: {}".format(z_size-1, name_prefix)]
-            del f['data'].attrs['slice-names']
-            f['data'].attrs['slice-names'] = names
-
-
 class SynapseSliceRelabeler(object):
-    def __init__(self):
+    def __init__(self, min_overlap_fraction=None):
+        """
+        min_overlap_fraction: If given, an object in the current slice only inherits the id of an
+                              object in the previous slice if at least this fraction of its pixels
+                              overlap it.  By default, a single overlapping pixel is sufficient.
+        """
+        self.min_overlap_fraction = min_overlap_fraction
         self.max_label = 0
         self.previous_slice = None
         self.previous_roi = None
 
+    def state(self):
+        """
+        Return a copy of this relabeler's state (but not its settings), suitable for a checkpoint.
+        """
+        return { 'max_label' : self.max_label,
+                 'previous_slice' : self.previous_slice,
+                 'previous_roi' : self.previous_roi }
+
+    def restore_state(self, state):
+        """
+        Continue from a state returned by state().
+        The relabeler's settings (e.g. min_overlap_fraction) are left as they are.
+        """
+        self.max_label = state['max_label']
+        self.previous_slice = state['previous_slice']
+        self.previous_roi = state['previous_roi']
+
     def normalize_synapse_ids(self, current_slice, current_roi):
         """
         When the same synapse appears in two neighboring slices,
@@ -428,24 +1123,33 @@ class SynapseSliceRelabeler(object):
         prev_intersection_slice = self.previous_slice[slicing(prev_intersection_roi)]
     
         # omit label 0
-        previous_slice_objects = unique(self.previous_slice)[1:]
-        current_slice_objects = unique(current_slice)[1:]
-        max_current_object = max(0, *current_slice_objects)
-        relabel = np.zeros((max_current_object+1,), dtype=np.uint32)
-        
-        for cc in previous_slice_objects:
-            current_labels = unique(current_intersection_slice[prev_intersection_slice==cc])
-            for cur_label in current_labels:
-                relabel[cur_label] = cc
+        current_slice_objects = current_unique_labels[1:]
+        num_current_labels = int(current_slice_objects[-1])+1
+        relabel = np.zeros((num_current_labels,), dtype=np.uint32)
+
+        # Joint histogram of the (previous, current) label pairs in the intersection
+        overlap_mask = (prev_intersection_slice != 0) & (current_intersection_slice != 0)
+        pair_keys = ( prev_intersection_slice[overlap_mask].astype(np.uint64) * num_current_labels
+                      + current_intersection_slice[overlap_mask].astype(np.uint64) )
+        pair_keys, pair_counts = np.unique(pair_keys, return_counts=True)
+        pair_previous = (pair_keys // num_current_labels).astype(np.uint32)
+        pair_current = (pair_keys % num_current_labels).astype(np.intp)
+
+        if self.min_overlap_fraction:
+            current_sizes = np.bincount(np.asarray(current_slice).ravel(), minlength=num_current_labels)
+            sufficient = (pair_counts >= self.min_overlap_fraction * current_sizes[pair_current])
+            pair_previous = pair_previous[sufficient]
+            pair_current = pair_current[sufficient]
+
+        # If an object overlaps several objects from the previous slice, the max previous id wins.
+        np.maximum.at(relabel, pair_current, pair_previous)
         
-        new_max_label = self.max_label
-        for cur_object in current_slice_objects:
-            if relabel[cur_object] == 0:
-                relabel[cur_object] = new_max_label+1
-                new_max_label = new_max_label+1
+        # All other objects get new ids
+        unmatched_objects = current_slice_objects[relabel[current_slice_objects] == 0]
+        new_max_label = self.max_label + len(unmatched_objects)
+        relabel[unmatched_objects] = np.arange( self.max_label+1, new_max_label+1, dtype=np.uint32 )
     
         # Relabel the entire current slice
-        relabel[0] = 0
         relabeled_slice = relabel[current_slice]
     
         self.max_label = new_max_label
@@ -454,6 +1158,43 @@ class SynapseSliceRelabeler(object):
         return relabeled_slice
 
 
+def synapse_features(synapse_cc_xy, predictions_xyc, segmentation_xy, node_segment):
+    """
+    Compute the features of every synapse in the given label image at once.
+
+    Returns a dict of arrays, each with one entry per synapse id (in ascending order):
+        - synapse_id
+        - size_px: The number of pixels in the synapse
+        - x_px, y_px: The synapse centroid (in tile coordinates)
+        - certainty: The mean difference between the highest and second-highest class probability
+        - overlaps_node_segment: True if any of the synapse's pixels lie in the given segment
+    """
+    # Only the labeled pixels are of interest.
+    synapse_mask = (synapse_cc_xy != 0)
+    labels = synapse_cc_xy[synapse_mask]
+    coords_x, coords_y = np.nonzero(synapse_mask)
+    num_bins = int(labels.max())+1 if len(labels) else 1
+
+    sizes = np.bincount(labels, minlength=num_bins)
+    synapse_ids = np.flatnonzero(sizes)
+    sizes = sizes[synapse_ids]
+
+    # What's the difference between the highest and second-highest class?
+    flat_predictions = np.partition(predictions_xyc[synapse_mask], -2, axis=-1)
+    certainties = flat_predictions[:,-1] - flat_predictions[:,-2]
+
+    in_node_segment = (segmentation_xy[synapse_mask] == node_segment)
+
+    def label_sum(weights):
+        return np.bincount(labels, weights, minlength=num_bins)[synapse_ids]
+
+    return { "synapse_id" : synapse_ids,
+             "size_px" : sizes,
+             "x_px" : label_sum(coords_x) / sizes,
+             "y_px" : label_sum(coords_y) / sizes,
+             "certainty" : label_sum(certainties) / sizes,
+             "overlaps_node_segment" : label_sum(in_node_segment) > 0 }
+
 def write_synapses(csv_writer, skeleton, node_info, roi_xyz, synapse_cc_xy, predictions_xyc, segmentation_xy, node_overall_index):
     """
     Given a slice of synapse segmentation and prediction images,
@@ -462,40 +1203,25 @@ def write_synapses(csv_writer, skeleton, node_info, roi_xyz, synapse_cc_xy, pred
     # Node is always located in the middle pixel, by definition.
     center_coord = np.array(segmentation_xy.shape) / 2
     node_segment = segmentation_xy[tuple(center_coord)]
-    
-    synapseIds = unique(synapse_cc_xy)
-    for sid in synapseIds[1:]: # skip 0
-        # find the pixel positions of this synapse
-        syn_pixel_coords = np.where(synapse_cc_xy == sid)
-        synapse_size = len( syn_pixel_coords[0] )
-        syn_average_x = np.average(syn_pixel_coords[0])+roi_xyz[0,0]
-        syn_average_y = np.average(syn_pixel_coords[1])+roi_xyz[0,1]
+
+    features = synapse_features(synapse_cc_xy, predictions_xyc, segmentation_xy, node_segment)
+    for i, sid in enumerate(features["synapse_id"]):
+        syn_average_x = features["x_px"][i]+roi_xyz[0,0]
+        syn_average_y = features["y_px"][i]+roi_xyz[0,1]
 
         # For now, we just compute euclidean distance to the node (in pixels).
         distance_euclidean = euclidean((syn_average_x, syn_average_y), (node_info.x_px, node_info.y_px))
 
-        # Determine average uncertainty
-        # Get probabilities for this synapse's pixels
-        flat_predictions = predictions_xyc[synapse_cc_xy == sid]
-        # Sort along channel axis
-        flat_predictions.sort(axis=-1)
-        # What's the difference between the highest and second-highest class?
-        certainties = flat_predictions[:,-1] - flat_predictions[:,-2]
-        avg_certainty = np.mean(certainties)
-        avg_uncertainty = 1.0 - avg_certainty
-
-        overlapping_segments = unique(segmentation_xy[synapse_cc_xy == sid])
-
         fields = {}
         fields["synapse_id"] = int(sid)
         fields["x_px"] = int(syn_average_x + 0.5)
         fields["y_px"] = int(syn_average_y + 0.5)
         fields["z_px"] = roi_xyz[0,2]
 
-        fields["size_px"] = synapse_size
+        fields["size_px"] = features["size_px"][i]
         fields["distance_to_node_px"] = distance_euclidean
-        fields["detection_uncertainty"] = avg_uncertainty
-        fields["overlaps_node_segment"] = {True: "true", False: "false"}[node_segment in overlapping_segments]
+        fields["detection_uncertainty"] = 1.0 - features["certainty"][i]
+        fields["overlaps_node_segment"] = {True: "true", False: "false"}[bool(features["overlaps_node_segment"][i])]
 
         fields["tile_x_px"] = int(syn_average_x + 0.5) - node_info.x_px + center_coord[0]
         fields["tile_y_px"] = int(syn_average_y + 0.5) - node_info.y_px + center_coord[1]
@@ -0,0 +1,107 @@
+"""
+Run locate_synapses on many skeletons in a single process.
+
+The ilastik projects are loaded only once (which takes longer than processing a small skeleton),
+and the tile cache and prediction cache are shared by all skeletons, so regions that are
+visited by more than one skeleton needn't be downloaded (or predicted) again.
+
+The skeletons are processed one after another, and each one gets the same outputs
+(in its own subdirectory of the output directory) as a separate locate_synapses run.
+
+--processes is not supported here: each shard process would have to load both projects
+again for every skeleton, and the shards couldn't share the tile cache, which would
+defeat the purpose of this script.  Use --workers instead, or run several batches
+(on different skeletons) side by side.
+"""
+import os
+import sys
+import argparse
+
+from lazyflow.utility.io_util import TiledVolume
+
+from skeleton_synapses.skeleton_utils import iter_skeleton_json, Skeleton
+from skeleton_synapses.locate_synapses import add_locate_arguments, locate_kwargs_from_args, load_projects, \
+                                              locate_synapses, mkdir_p
+
+import logging
+logger = logging.getLogger(__name__)
+
+def main():
+    parser = argparse.ArgumentParser()
+    add_locate_arguments(parser)
+    parser.add_argument('--keep-going', action='store_true',
+                        help='If a skeleton fails, log the error and continue with the next one.')
+    parser.add_argument('autocontext_project',
+                        help="ilastik autocontext project file (.ilp) with output channels [membrane,other,synapse].  Must use axes 'xyt'.")
+    parser.add_argument('multicut_project',
+                        help="ilastik 2D multicut project file.  Should expect the probability channels from the autocontext project.")
+    parser.add_argument('volume_description',
+                        help="A file describing the CATMAID tile volume in the ilastik 'TiledVolume' json format.")
+    parser.add_argument('output_dir',
+                        help="A directory to drop the output files (in a subdirectory for each skeleton).")
+    parser.add_argument('skeleton_paths', nargs='+',
+                        help="'treenode and connector geometry' files exported from CATMAID, "
+                             "or directories to search for them (*.json).  A file may contain several skeletons.")
+    args = parser.parse_args()
+
+    if args.processes > 1:
+        parser.error("--processes is not supported by locate_synapses_batch, since each shard process would "
+                     "have to load the projects again for every skeleton.  Use --workers instead.")
+
+    volume_description = TiledVolume.readDescription(args.volume_description)
+    z_res, y_res, x_res = volume_description.resolution_zyx
+
+    locate_kwargs = locate_kwargs_from_args(parser, args, volume_description)
+
+    skeleton_files = find_skeleton_files(args.skeleton_paths)
+    if not skeleton_files:
+        parser.error("No skeleton files found.")
+
+    locate_kwargs['projects'] = load_projects(args.autocontext_project, args.multicut_project, args.volume_description,
+                                              max(1, args.workers))
+
+    failed_skeletons = []
+    for skeleton_file in skeleton_files:
+        for skeleton_data in iter_skeleton_json(skeleton_file):
+            skeleton = Skeleton.from_data(skeleton_data, (x_res, y_res, z_res))
+            output_dir = args.output_dir + "/{}".format(skeleton.skeleton_id)
+            mkdir_p(output_dir)
+            logger.info("Processing skeleton {} (from {})".format( skeleton.skeleton_id, skeleton_file ))
+            try:
+                locate_synapses( args.autocontext_project,
+                                 args.multicut_project,
+                                 args.volume_description,
+                                 output_dir,
+                                 skeleton,
+                                 args.roi_radius_px,
+                                 **locate_kwargs )
+            except Exception:
+                if not args.keep_going:
+                    raise
+                logger.error("Skeleton {} failed".format( skeleton.skeleton_id ), exc_info=True)
+                failed_skeletons.append(skeleton.skeleton_id)
+
+    if failed_skeletons:
+        logger.error("{} skeleton(s) failed: {}".format( len(failed_skeletons), ", ".join(failed_skeletons) ))
+        return 1
+    return 0
+
+def find_skeleton_files(paths):
+    """
+    Return the skeleton json files in the given list of files and directories.
+    Directories are searched recursively, and their files are listed in sorted order.
+    """
+    skeleton_files = []
+    for path in paths:
+        if not os.path.isdir(path):
+            skeleton_files.append(path)
+            continue
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            skeleton_files += [ os.path.join(dirpath, filename)
+                                for filename in sorted(filenames)
+                                if filename.endswith('.json') ]
+    return skeleton_files
+
+if __name__ == "__main__":
+    sys.exit( main() )
@@ -1,108 +1,95 @@
-import csv
-import collections
 import numpy
-from skeleton_utils import CSV_FORMAT
+from detection_table import read_detections, write_detections, append_columns
+
+# Columns for which the merged row gets the minimum of all merged rows (if the column is present).
+MIN_COLUMNS = ["distance", "distance_hessian", "distance_raw_probs", "nearest_connector_distance_nm"]
 
 def merge_synapse_ids(input_path, output_path):
     """
-    Read the given csv file and merge all rows with identical synapse ids into a single row for each id.
+    Read the given detections file (csv, .h5 or .npy) and merge all rows with identical
+    synapse ids into a single row for each id.  (See merge_detections().)
+    """
+    detections = read_detections(input_path)
+    write_detections( output_path, merge_detections(detections) )
+
+def merge_detections(detections):
+    """
+    Merge all rows of the given detection table with identical synapse ids into a single row for each id.
 
-    The input csv file must contain a header row, and the following fields must be present (in any order):
-    synapse_id, x_px, y_px, z_px, size_px, distance, detection_uncertainty
+    The following columns must be present (in any order):
+    synapse_id, x_px, y_px, z_px, size_px, detection_uncertainty
 
     Rows with the same synapse_id are merged.  Each column is handled as follows:
     x_px, y_px, z_px - weighted average across rows (weighted by size_px)
     size_px - sum of all rows
-    distance - the minimum of all rows is chosen
     detection_uncertainty - weighted average across rows (weighted by size_px)
-    
-    A new column "node_count" will be appended to indicate how many rows were merged to create each output row.
-    
-    All other fields in the output row will be copied from one of the corresponding input rows.
+    distance, distance_hessian, distance_raw_probs, nearest_connector_distance_nm -
+        the minimum of all rows is chosen (for each of these columns that is present)
+
+    A new column "node_count" will be appended (or replaced, if it exists)
+    to indicate how many rows were merged to create each output row.
+
+    All other fields in the output row will be copied from one of the corresponding input rows:
+    the one with the smallest distance_hessian if that column is present, otherwise the one with the
+    smallest distance if that column is present, otherwise the first one.
+
+    The output rows are ordered by the first appearance of each synapse id in the input.
     """
-    with open(input_path, "r") as f:
-        # Read all rows and group them by synapse id
-        all_synapses = collections.OrderedDict()
-        csv_reader = csv.DictReader(f, **CSV_FORMAT)
-        for row in csv_reader:
-            syn_id = row["synapse_id"]
-            try:
-                all_synapses[syn_id].append( row )
-            except KeyError:
-                all_synapses[syn_id] = [row]
-            
-    with open(output_path, "w") as f2:
-        output_columns = csv_reader.fieldnames + ["node_count"]
-        csv_writer = csv.DictWriter(f2, output_columns, **CSV_FORMAT)
-        csv_writer.writeheader()
-        for syn_id, rows in all_synapses.iteritems():
-            if len(rows) == 1:
-                # Fast path
-                final_row = rows[0]
-            else:
-                min_distance = distance_hessian = distance_raw_probs = None
-                if "distance" in output_columns:
-                    # Find min distance
-                    distances = map( lambda row: row["distance"], rows )
-                    min_distance = numpy.asarray(distances, dtype=numpy.float32).min()
-                
-                connector_distances = map( lambda row: row["nearest_connector_distance_nm"], rows)
-                min_conn_distance = numpy.asarray(connector_distances, dtype=numpy.float32).min()
-
-                if "distance_hessian" in output_columns:
-                    # Find min hessian distance
-                    distances_hessian = map( lambda row: row["distance_hessian"], rows )
-                    min_distance_hessian = numpy.asarray(distances_hessian, dtype=numpy.float32).min()
-
-                if "distance_raw_probs" in output_columns:
-                    # Find min raw_probs distance
-                    distances_raw_probs = map( lambda row: row["distance_raw_probs"], rows )
-                    min_distance_raw_probs = numpy.asarray(distances_raw_probs, dtype=numpy.float32).min()
-
-                # Sum sizes
-                sizes = map( lambda row: row["size_px"], rows )
-                sizes = numpy.asarray( sizes, dtype=numpy.uint32 )
-                total_size = sizes.sum()
-                size_weights = sizes/float(total_size)
-
-                # Uncertainty: take weighted average
-                uncertainties = map( lambda row: row["detection_uncertainty"], rows )
-                uncertainties = numpy.asarray(uncertainties, dtype=numpy.float32)
-                avg_uncertainty = numpy.average( uncertainties, weights=size_weights )
-            
-                # Create list of coord tuples for this synapse
-                syn_coords = map( lambda row: (row["x_px"], row["y_px"], row["z_px"]), rows )
-                syn_coord_array = numpy.asarray(syn_coords).astype(int)
-                
-                # Coord: take weighted average
-                avg_coord = (numpy.average(syn_coord_array, axis=0, weights=size_weights) + 0.5).astype(int)
-
-                # At least one row has the same z-coord as the average coord
-                # Find it and use it as the final_row.
-                #final_row = filter( lambda row: float(row["distance"]) == min_distance, rows )[0]
-                final_row = rows[0]
-                if "distance" in output_columns:
-                    final_row = filter( lambda row: float(row["distance"]) == min_distance, rows )[0]
-                if "distance_hessian" in output_columns:
-                    final_row = filter( lambda row: numpy.float32(row["distance_hessian"]) == numpy.float32(min_distance_hessian), rows )[0]
-                
-                # Replace fields in the final row
-                final_row["x_px"], final_row["y_px"], final_row["z_px"] = avg_coord
-                final_row["nearest_connector_distance_nm"] = min_conn_distance
-                final_row["size_px"] = total_size
-                final_row["detection_uncertainty"] = avg_uncertainty
-
-                if "distance" in output_columns:
-                    final_row["distance"] = min_distance
-                if "distance_hessian" in output_columns:
-                    final_row["distance_hessian"] = min_distance_hessian
-                if "distance_raw_probs" in output_columns:
-                    final_row["distance_raw_probs"] = min_distance_raw_probs
-
-            final_row["node_count"] = len(rows)
-
-            # Write.
-            csv_writer.writerow( final_row )            
+    column_names = detections.dtype.names
+
+    # Sort by synapse id.  The sort is stable, so each synapse's rows stay in their original order.
+    order = numpy.argsort(detections["synapse_id"], kind='mergesort')
+    sorted_detections = detections[order]
+    synapse_ids = sorted_detections["synapse_id"]
+    group_starts = numpy.flatnonzero( numpy.concatenate(([True], synapse_ids[1:] != synapse_ids[:-1])) )
+    node_counts = numpy.diff( numpy.append(group_starts, len(synapse_ids)) )
+
+    if len(sorted_detections) == 0:
+        return append_columns(sorted_detections, ["node_count"], [node_counts])
+
+    # Choose the row that provides the other fields for each synapse.
+    if "distance_hessian" in column_names:
+        representatives = _segment_argmin(sorted_detections["distance_hessian"], group_starts, node_counts)
+    elif "distance" in column_names:
+        representatives = _segment_argmin(sorted_detections["distance"], group_starts, node_counts)
+    else:
+        representatives = group_starts
+    merged = sorted_detections[representatives]
+
+    # Sum sizes
+    sizes = sorted_detections["size_px"]
+    total_sizes = numpy.add.reduceat(sizes, group_starts)
+    merged["size_px"] = total_sizes
+
+    # Coords and uncertainty: take weighted average.
+    # (Synapses with a single row are copied as-is.)
+    multiple = (node_counts > 1)
+    def weighted_average(values):
+        weighted_sums = numpy.add.reduceat(values * sizes.astype(numpy.float64), group_starts)
+        return weighted_sums[multiple] / total_sizes[multiple]
+
+    for column in ("x_px", "y_px", "z_px"):
+        merged[column][multiple] = ( weighted_average(sorted_detections[column]) + 0.5 ).astype(int)
+    merged["detection_uncertainty"][multiple] = weighted_average(sorted_detections["detection_uncertainty"])
+
+    for column in MIN_COLUMNS:
+        if column in column_names:
+            merged[column] = numpy.minimum.reduceat(sorted_detections[column], group_starts)
+
+    # Restore the order in which the synapses first appeared.
+    first_appearance_order = numpy.argsort(order[group_starts])
+    return append_columns( merged[first_appearance_order], ["node_count"], [node_counts[first_appearance_order]] )
+
+def _segment_argmin(values, segment_starts, segment_lengths):
+    """
+    Given an array divided into consecutive segments, return the index of the minimum value in each segment.
+    For ties, the first such index is returned.
+    """
+    segment_ids = numpy.repeat( numpy.arange(len(segment_starts)), segment_lengths )
+
+    # Sort by value within each segment (stably, so ties keep their original order).
+    order = numpy.lexsort( (values, segment_ids) )
+    return order[segment_starts]
 
 if __name__ == "__main__":
     import argparse
@@ -1,76 +1,110 @@
-import csv
+import multiprocessing
+from collections import deque
+
 import numpy
-import scipy.spatial.distance
+from scipy.spatial import cKDTree
+
+from skeleton_utils import parse_connectors, ConnectorInfo
+from detection_table import iter_detection_chunks, DetectionWriter, append_columns, DEFAULT_CHUNK_SIZE
+
+# Emitted for detections without a connector nearby.
+NO_CONNECTOR = ConnectorInfo(-1, -1, -1, -1, [], [])
+NO_CONNECTOR_DISTANCE = 9999999.0
 
-from lazyflow.roi import getIntersectingBlocks
-from lazyflow.utility.io import TiledVolume
-from skeleton_utils import parse_connectors, ConnectorInfo, CSV_FORMAT
+NEAREST_CONNECTOR_COLUMNS = [ "nearest_connector_id",
+                              "nearest_connector_distance_nm",
+                              "nearest_connector_x_nm",
+                              "nearest_connector_y_nm",
+                              "nearest_connector_z_nm" ]
 
 class ConnectorStore(object):
     """
-    Stores a list of connectors in buckets for faster location-based lookup.
+    Stores a list of connectors in a KD-tree for fast location-based lookup.
+
+    All coordinates are in nanometers (xyz order), so distances are isotropic even though
+    the volume's resolution isn't.  (Use pixels_to_nm() to convert pixel coordinates first.)
+    Each query method accepts an array of many coordinates, which is much faster than
+    querying them one at a time.
     """
     SEARCH_RADIUS = 500
     
-    def __init__(self, connectors, blockshape_xyz):
-        self._blockshape = blockshape_xyz
-        self._blocks = self._generate_connector_buckets( connectors, blockshape_xyz )
-    
-    @classmethod
-    def _generate_connector_buckets(cls, connectors, blockshape_xyz ):
+    def __init__(self, connectors):
+        self.connectors = list(connectors)
+        self.connector_ids = numpy.array( [ conn.id for conn in self.connectors ], dtype=numpy.int64 )
+        self.coords_nm = numpy.array( [ (conn.x_nm, conn.y_nm, conn.z_nm) for conn in self.connectors ],
+                                      dtype=numpy.float64 ).reshape(-1, 3)
+        self._tree = None
+        if self.connectors:
+            # (cKDTree can't be constructed without any points)
+            self._tree = cKDTree(self.coords_nm)
+
+    def nearest_connectors(self, coords_nm, k=1, max_distance=numpy.inf):
         """
-        Store the list of ConnectorInfos into buckets (a dictionary of lists), grouped by block location.
-        The dict keys are simply the start coordinate of each block (as a tuple).
-        The block boundaries are determined by blockshape_zyx.
+        Find the k nearest connectors to each of the given coordinates.
+        Connectors farther than max_distance (if given) are not considered.
+
+        Args:
+            coords_nm: An array of shape (N,3)
+            k: How many connectors to find for each coordinate.
+
+        Returns: indexes, distances
+            Two arrays of shape (N,k) (or (N,), if k == 1), sorted by distance.
+            The indexes refer to self.connectors.  Where fewer than k connectors
+            were found, the index is -1 and the distance is NO_CONNECTOR_DISTANCE.
         """
-        blocks = {}
-        for conn in connectors:
-            coord = numpy.array( (conn.x_nm, conn.y_nm, conn.z_nm) ).astype(int)
-            block_start = getIntersectingBlocks( blockshape_xyz, (coord, coord+1) )[0]
-            block_start = tuple(block_start)
-            try:
-                blocks[block_start].append( conn )
-            except KeyError:
-                blocks[block_start] = [conn]
-        return blocks
+        coords_nm = numpy.asarray(coords_nm, dtype=numpy.float64).reshape(-1, 3)
+        shape = (len(coords_nm),) if k == 1 else (len(coords_nm), k)
+        if self._tree is None:
+            return numpy.full(shape, -1, dtype=numpy.int64), numpy.full(shape, NO_CONNECTOR_DISTANCE)
+
+        # max_distance is inclusive (as in connectors_within()), but cKDTree's upper bound is exclusive.
+        upper_bound = numpy.nextafter(max_distance, numpy.inf)
+        distances, indexes = self._tree.query(coords_nm, k=k, distance_upper_bound=upper_bound)
+
+        # cKDTree reports missing neighbors with index == len(connectors) and an infinite distance.
+        missing = (indexes == len(self.connectors))
+        indexes = numpy.where(missing, -1, indexes).astype(numpy.int64)
+        distances = numpy.where(missing, NO_CONNECTOR_DISTANCE, distances)
+        return indexes.reshape(shape), distances.reshape(shape)
+
+    def connectors_within(self, coords_nm, radius):
+        """
+        Find all connectors within the given radius of each of the given coordinates (an array of shape (N,3)).
+        Returns: A list (one item for each coordinate) of arrays of indexes into self.connectors, sorted by distance.
+        """
+        coords_nm = numpy.asarray(coords_nm, dtype=numpy.float64).reshape(-1, 3)
+        if self._tree is None:
+            return [ numpy.zeros((0,), dtype=numpy.int64) for _ in coords_nm ]
+
+        results = []
+        for coord, indexes in zip(coords_nm, self._tree.query_ball_point(coords_nm, radius)):
+            indexes = numpy.asarray(indexes, dtype=numpy.int64)
+            distances = numpy.linalg.norm(self.coords_nm[indexes] - coord, axis=-1)
+            results.append( indexes[numpy.argsort(distances, kind='mergesort')] )
+        return results
 
     def find_nearest_connector(self, detection_coord ):
         """
-        Search the given buckets of connectors for the one that is nearest to the given coordinates.
-        Buckets farther than SEARCH_RADIUS are not searched, in which case a default ConnectorInfo object is returned.
+        Search for the connector that is nearest to the given coordinates (in nm).
+        Connectors farther than SEARCH_RADIUS are not considered, in which case NO_CONNECTOR is returned.
         
         Returns: nearest_connector, distance to the nearest connector
         """
-        # Find nearby blocks
-        detection_coord_int = detection_coord.astype(int)
-        search_roi = ( detection_coord_int - self.SEARCH_RADIUS,
-                       detection_coord_int + self.SEARCH_RADIUS )
-        nearby_block_starts = getIntersectingBlocks(self._blockshape, search_roi)
-        nearby_block_starts = map(tuple, nearby_block_starts)
-    
-        # Accumulate connectors found in nearby blocks
-        nearby_connectors = []
-        for block_start in nearby_block_starts:
-            if block_start in self._blocks:
-                nearby_connectors += self._blocks[block_start]
-    
-        # Closure.  Distance from current point to given connector.
-        def distance( conn ):
-            return scipy.spatial.distance.euclidean( (conn.x_nm, conn.y_nm, conn.z_nm), detection_coord )
-    
-        # Find closest connector.
-        if nearby_connectors:
-            nearest_connector = min(nearby_connectors, key=distance)
-            min_distance = distance( nearest_connector )
-        else:
-            # No connectors nearby.  Emit default values.
-            nearest_connector = ConnectorInfo(-1, -1, -1, -1, [], [])
-            min_distance = 9999999.0
-        
-        return nearest_connector, min_distance
-    
+        indexes, distances = self.nearest_connectors( [detection_coord], max_distance=self.SEARCH_RADIUS )
+        if indexes[0] == -1:
+            return NO_CONNECTOR, NO_CONNECTOR_DISTANCE
+        return self.connectors[indexes[0]], distances[0]
 
-def output_nearest_connectors( synapse_detections_csv, connectors, resolution_xyz, output_csv ):
+
+def pixels_to_nm(coords_px, resolution_xyz):
+    """
+    Convert the given array of (x,y,z) pixel coordinates (shape (N,3)) to nanometers.
+    """
+    return numpy.asarray(coords_px, dtype=numpy.float64) * numpy.asarray(resolution_xyz, dtype=numpy.float64)
+
+def output_nearest_connectors( synapse_detections_csv, connectors, resolution_xyz, output_csv,
+                               max_distance=ConnectorStore.SEARCH_RADIUS,
+                               chunk_size=DEFAULT_CHUNK_SIZE, num_processes=1 ):
     """
     Read the synapse detections csv file at the given path and write a copy of it 
     with extra columns appended for the distance to the nearest connector annotation.
@@ -81,52 +115,87 @@ def output_nearest_connectors( synapse_detections_csv, connectors, resolution_xy
                                     nearest_connector_y_nm, 
                                     nearest_connector_z_nm
                                     
-    The nearest connector is only searched for within a maximum radius of SEARCH_RADIUS.
-    If no nearby connector is found for a synapse detection, a negative id is output, 
-    with a very large distance.
-    
-    The extra columns are nearest_connector_id, nearest_connector_distance_nm
+    The nearest connector is only searched for within a radius of max_distance (by default, SEARCH_RADIUS).
+    If no nearby connector is found for a synapse detection (or there are no connectors at all),
+    a negative id is output, with a very large distance.
+
+    The detections are streamed through in chunks of chunk_size rows, so the memory usage doesn't
+    depend on the size of the detections file.  With num_processes > 1, the chunks are annotated
+    in a pool of processes (and written in their original order).
     
     Args:
-        synapase_detections_csv: A path to the output file from locate_synapses()
+        synapase_detections_csv: A path to the output file from locate_synapses() (CSV, .h5 or .npy)
         connectors: A list of ConnectorInfo objects
         resolution_xyz: A tuple of the resolution in x,y,z order
-        output_csv: The path to write the output file to    
+        output_csv: The path to write the output file to (CSV, .h5 or .npy)
+        max_distance: The search radius, in nm (numpy.inf to search without a limit)
+        chunk_size: How many detections to read (and annotate) at a time
+        num_processes: How many processes to annotate the chunks with
     """
-    # Avoid searching the whole list every time:
-    # store the connectors in buckets by block.
-    connector_store = ConnectorStore( connectors, blockshape_xyz=(1000,1000,1000) )
-    
-    with open(synapse_detections_csv, 'r') as detections_file,\
-         open(output_csv, 'w') as output_file:
-        
-        csv_reader = csv.DictReader(detections_file, **CSV_FORMAT)
-        output_fields = csv_reader.fieldnames + [ "nearest_connector_id", 
-                                                  "nearest_connector_distance_nm", 
-                                                  "nearest_connector_x_nm", 
-                                                  "nearest_connector_y_nm", 
-                                                  "nearest_connector_z_nm" ]
-
-        csv_writer = csv.DictWriter(output_file, output_fields, **CSV_FORMAT)
-        csv_writer.writeheader()
-        
-        for row in csv_reader:
-            # Convert from pixels to nanometers
-            x_nm = int(row["x_px"]) * resolution_xyz[0]
-            y_nm = int(row["y_px"]) * resolution_xyz[1]
-            z_nm = int(row["z_px"]) * resolution_xyz[2]
+    connector_store = ConnectorStore( connectors )
+    chunks = iter_detection_chunks(synapse_detections_csv, chunk_size)
+    if num_processes > 1:
+        annotated_chunks = _annotate_chunks_in_processes( chunks, connector_store, resolution_xyz, max_distance, num_processes )
+    else:
+        annotated_chunks = ( annotate_nearest_connectors(chunk, connector_store, resolution_xyz, max_distance)
+                             for chunk in chunks )
 
-            detection_coord = numpy.array( (x_nm, y_nm, z_nm) )
-            nearest_connector, distance = connector_store.find_nearest_connector( detection_coord )
+    writer = DetectionWriter(output_csv)
+    try:
+        for annotated_chunk in annotated_chunks:
+            writer.append(annotated_chunk)
+    finally:
+        writer.close()
 
-            # Write output row.
-            row["nearest_connector_id"] = nearest_connector.id
-            row["nearest_connector_distance_nm"] = distance
-            row["nearest_connector_x_nm"] = nearest_connector.x_nm
-            row["nearest_connector_y_nm"] = nearest_connector.y_nm
-            row["nearest_connector_z_nm"] = nearest_connector.z_nm
-            csv_writer.writerow( row )
+def annotate_nearest_connectors( detections, connector_store, resolution_xyz, max_distance=ConnectorStore.SEARCH_RADIUS ):
+    """
+    Return a copy of the given detection table, with the NEAREST_CONNECTOR_COLUMNS appended.
+    (See output_nearest_connectors().)
+    """
+    detection_coords_px = numpy.transpose( [ detections["x_px"], detections["y_px"], detections["z_px"] ] )
+    indexes, distances = connector_store.nearest_connectors( pixels_to_nm(detection_coords_px, resolution_xyz),
+                                                             max_distance=max_distance )
+
+    # Look up the connector fields, with an extra entry (at index -1) for 'no connector'.
+    connector_ids = numpy.append( connector_store.connector_ids, NO_CONNECTOR.id )
+    connector_coords = numpy.append( connector_store.coords_nm, [(NO_CONNECTOR.x_nm, NO_CONNECTOR.y_nm, NO_CONNECTOR.z_nm)], axis=0 )
+
+    column_values = [ connector_ids[indexes],
+                      distances,
+                      connector_coords[indexes, 0],
+                      connector_coords[indexes, 1],
+                      connector_coords[indexes, 2] ]
+    return append_columns(detections, NEAREST_CONNECTOR_COLUMNS, column_values)
+
+# The arguments of annotate_nearest_connectors() in each worker process of _annotate_chunks_in_processes()
+_worker_args = None
+
+def _init_annotation_worker(connector_store, resolution_xyz, max_distance):
+    global _worker_args
+    _worker_args = (connector_store, resolution_xyz, max_distance)
 
+def _annotate_chunk(chunk):
+    return annotate_nearest_connectors(chunk, *_worker_args)
+
+def _annotate_chunks_in_processes( chunks, connector_store, resolution_xyz, max_distance, num_processes ):
+    """
+    Like imap(annotate_nearest_connectors, chunks), but the chunks are annotated in a pool of processes.
+    Only a few chunks per process are in flight at any time, so the input is read no faster than it
+    can be processed.  The annotated chunks are yielded in the same order as the input chunks.
+    """
+    # The worker processes are forked, so they inherit the connector store without pickling it.
+    pool = multiprocessing.Pool( num_processes, _init_annotation_worker, (connector_store, resolution_xyz, max_distance) )
+    try:
+        pending = deque()
+        for chunk in chunks:
+            pending.append( pool.apply_async(_annotate_chunk, (chunk,)) )
+            if len(pending) >= 2*num_processes:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+        pool.join()
 
 if __name__ == "__main__":
     USE_DEBUG_FILES = False
@@ -139,16 +208,27 @@ if __name__ == "__main__":
         sys.argv.append( '/magnetic/workspace/skeleton_synapses/skeleton_18689_detections_with_distances_2.csv' )        
 
     import argparse
+    from lazyflow.utility.io_util import TiledVolume
+
     parser = argparse.ArgumentParser()
     parser.add_argument('volume_description_json')
     parser.add_argument('skeleton_json')
     parser.add_argument('detections_csv')
     parser.add_argument('output_csv')
+    parser.add_argument('--max-distance-nm', type=float, default=ConnectorStore.SEARCH_RADIUS,
+                        help='Only search for connectors within this distance of each detection '
+                             '(default: {}).  Use "inf" to find the nearest connector regardless of its distance.'
+                             .format( ConnectorStore.SEARCH_RADIUS ))
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        help='How many detections to process at a time.  Limits the memory usage for large files.')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='How many processes to annotate the detections with.')
     parsed_args = parser.parse_args()
 
     volume_description = TiledVolume.readDescription(parsed_args.volume_description_json)
     z_res, y_res, x_res = volume_description.resolution_zyx
 
     connectors, _ = parse_connectors( parsed_args.skeleton_json )
-    output_nearest_connectors( parsed_args.detections_csv, connectors, ( x_res, y_res, z_res ), parsed_args.output_csv )
+    output_nearest_connectors( parsed_args.detections_csv, connectors, ( x_res, y_res, z_res ), parsed_args.output_csv,
+                               parsed_args.max_distance_nm, parsed_args.chunk_size, parsed_args.processes )
  
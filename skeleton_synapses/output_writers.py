@@ -0,0 +1,239 @@
+import os
+import sys
+import errno
+import threading
+import collections
+from Queue import Queue
+
+import numpy as np
+import h5py
+import vigra
+
+try:
+    # Registers the blosc filter with h5py
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+import logging
+logger = logging.getLogger(__name__)
+
+COMPRESSION_CHOICES = ['none', 'gzip', 'lzf', 'blosc']
+
+# Storage options for an output stack:
+# - compression: One of COMPRESSION_CHOICES
+# - quantize: If True, the images (probabilities in the range [0.0, 1.0]) are stored as uint8,
+#             scaled by 255.  (The same convention that OpNodewiseCache.TransformFn undoes.)
+StackOptions = collections.namedtuple('StackOptions', 'compression quantize')
+DEFAULT_STACK_OPTIONS = StackOptions('none', False)
+
+def dataset_options(stack_options):
+    """
+    Return the keyword arguments to pass to h5py's create_dataset()
+    for the compression setting of the given StackOptions.
+    """
+    if stack_options.compression == 'none':
+        return {}
+    if stack_options.compression == 'gzip':
+        return { 'compression' : 'gzip', 'compression_opts' : 4, 'shuffle' : True }
+    if stack_options.compression == 'lzf':
+        return { 'compression' : 'lzf', 'shuffle' : True }
+    if stack_options.compression == 'blosc':
+        if hdf5plugin is None:
+            raise RuntimeError("Blosc compression requires the hdf5plugin package.")
+        return dict( hdf5plugin.Blosc(cname='lz4', clevel=5, shuffle=hdf5plugin.Blosc.SHUFFLE) )
+    raise ValueError("Unknown compression: {}".format( stack_options.compression ))
+
+def quantize_probabilities(image):
+    """
+    Convert the given probabilities (in the range [0.0, 1.0]) to uint8 (in the range [0, 255]).
+    """
+    return np.clip( np.round(np.asarray(image) * 255), 0, 255 ).astype(np.uint8)
+
+class StackWriter(object):
+    """
+    Appends 2D images (one per skeleton node) to an HDF5 stack,
+    keeping the file open between flushes.
+
+    The file contains two datasets:
+    - 'data': The image stack, with axes xyzc, chunked by whole slices.
+    - 'slice-names': A string for each slice of the stack, "{z}: {name}".
+
+    To avoid resizing the datasets for every slice, they are grown in increments
+    of preallocate_slices and trimmed to their final length when the writer is flushed or closed.
+    (In between, the datasets may contain a few extra all-zero slices at the end.)
+
+    An HDF5 file that is open for writing can be corrupted if the process is killed,
+    so the file is only kept open from the first append() after a flush() until the next flush().
+    When flush() returns, the file is closed, and it holds exactly the slices written so far.
+    (That's what a checkpoint relies on: a run that is killed between checkpoints can be resumed
+    from the last one, as long as the stacks weren't being written at the moment it was killed.)
+
+    The data may be compressed and/or quantized, according to the given StackOptions.
+    Since each slice is a single chunk, the compression is applied per slice,
+    and reading one node's image never requires decompressing any other.
+    """
+    def __init__(self, filepath, resume_length=None, preallocate_slices=100, options=DEFAULT_STACK_OPTIONS):
+        """
+        filepath: The HDF5 file to write.
+        resume_length: If None, any existing file is deleted and a new stack is started.
+                       Otherwise, the existing stack is truncated to this many slices
+                       (e.g. to discard slices written after the last checkpoint),
+                       and subsequent slices are appended after them.
+        preallocate_slices: How many slices to add to the datasets each time they run out of room.
+        options: A StackOptions tuple.
+        """
+        self.filepath = filepath
+        self.preallocate_slices = preallocate_slices
+        self.options = options
+
+        if resume_length is None:
+            try:
+                os.unlink(filepath)
+            except OSError as ex:
+                if ex.errno != errno.ENOENT:
+                    raise
+
+        self._file = h5py.File(filepath, 'a')
+        self._length = resume_length or 0
+        if resume_length is not None and 'data' in self._file:
+            self._resize(resume_length)
+        self.flush()
+
+    def __len__(self):
+        """
+        The number of slices written so far.
+        """
+        return self._length
+
+    def append(self, image_xyc, name):
+        """
+        Append the given image to the end of the stack.
+        """
+        if self.options.quantize:
+            image_xyc = quantize_probabilities(image_xyc)
+        if self._file is None:
+            self._file = h5py.File(self.filepath, 'a')
+
+        # Insert a Z-axis
+        image_xyzc = vigra.taggedView(image_xyc[:,:,None,:], 'xyzc')
+        if 'data' not in self._file:
+            self._create_datasets(image_xyzc)
+
+        data = self._file['data']
+        if self._length == data.shape[2]:
+            self._resize(self._length + self.preallocate_slices)
+
+        data[:, :, self._length:self._length+1, :] = image_xyzc
+        self._file['slice-names'][self._length] = "{}: {}".format(self._length, name)
+        self._length += 1
+
+    def flush(self):
+        """
+        Write all slices appended so far to disk, and close the file.
+        (The next append() reopens it.)
+        """
+        self.close()
+
+    def close(self):
+        """
+        Trim the datasets to the number of slices actually written, and close the file.
+        """
+        if self._file is None:
+            return
+        if 'data' in self._file:
+            self._resize(self._length)
+        self._file.close()
+        self._file = None
+
+    def _create_datasets(self, image_xyzc):
+        shape = list(image_xyzc.shape)
+        shape[2] = self.preallocate_slices
+        maxshape = list(image_xyzc.shape)
+        maxshape[2] = None
+        chunks = list(image_xyzc.shape)
+        chunks[2] = 1
+
+        data = self._file.create_dataset( 'data',
+                                          shape=tuple(shape),
+                                          maxshape=tuple(maxshape),
+                                          chunks=tuple(chunks),
+                                          dtype=image_xyzc.dtype,
+                                          **dataset_options(self.options) )
+        data.attrs['axistags'] = image_xyzc.axistags.toJSON()
+        if self.options.quantize:
+            data.attrs['quantization-scale'] = 255
+        self._file.create_dataset( 'slice-names',
+                                   shape=(self.preallocate_slices,),
+                                   maxshape=(None,),
+                                   dtype=h5py.special_dtype(vlen=str) )
+
+    def _resize(self, num_slices):
+        self._file['data'].resize(num_slices, 2)
+        self._file['slice-names'].resize((num_slices,))
+
+class BackgroundWriter(object):
+    """
+    Runs output operations (e.g. StackWriter.append, CSV writes) in a dedicated thread,
+    in the order they were submitted, so the caller can continue computing while
+    the previous results are written to disk.
+
+    At most max_pending operations may be waiting at once.  After that,
+    submit() blocks until the writer thread catches up.
+
+    If an operation raises an exception, the remaining operations are discarded,
+    and the exception is re-raised in the caller's thread by the next call to
+    submit() or close().  (Unless the caller is already handling an exception of
+    its own: see close().)
+    """
+    def __init__(self, max_pending=10):
+        self._queue = Queue(max_pending)
+        self._exc_info = None
+        self._thread = threading.Thread(target=self._run, name="BackgroundWriter")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Queue func(*args, **kwargs) to be run in the writer thread.
+        """
+        self._raise_if_failed()
+        assert self._thread is not None, "Writer is already closed."
+        self._queue.put( (func, args, kwargs) )
+
+    def close(self, raise_errors=True):
+        """
+        Wait for all submitted operations to complete and stop the writer thread.
+
+        raise_errors: If False, a failed operation is only logged, not re-raised.
+                      (For closing the writer while another exception is propagating,
+                      which the write error would otherwise replace.)
+        """
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        if raise_errors:
+            self._raise_if_failed()
+        elif self._exc_info is not None:
+            logger.error("Ignoring the background write error ({}), since another error occurred first."
+                         .format( self._exc_info[1] ))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if self._exc_info is not None:
+                continue
+            func, args, kwargs = item
+            try:
+                func(*args, **kwargs)
+            except:
+                logger.error("Background write failed", exc_info=True)
+                self._exc_info = sys.exc_info()
+
+    def _raise_if_failed(self):
+        if self._exc_info is not None:
+            exc_type, exc_value, exc_traceback = self._exc_info
+            raise exc_type, exc_value, exc_traceback
@@ -0,0 +1,154 @@
+"""
+Post-process a skeleton's synapse detections in a single pass.
+
+This replaces the chain of separate post-processing scripts
+(merge_synapse_ids, nearest_connectors, filter_by_distance, remove_csv_columns,
+and connected_node_distances for evaluation), each of which reads and rewrites
+the whole detection file.  Here, the detection table is read once, passed through
+the requested stages in memory, and only the final outputs are written.
+
+The stages are applied in this order (each one is optional):
+
+1. merge:      Merge the rows of each synapse (see merge_synapse_ids.merge_detections())
+2. annotate:   Append the nearest connector columns (see nearest_connectors.annotate_nearest_connectors())
+3. filter:     Keep only the rows whose value in a column is at least a minimum value
+               (see filter_by_distance.filter_detections())
+4. project:    Remove columns (see remove_csv_columns.remove_columns())
+
+Optionally, the connected node distances (see connected_node_distances) are written as well,
+computed from the detections as they are after the merge and annotate stages.
+"""
+import sys
+import argparse
+
+from lazyflow.utility.io_util import TiledVolume
+
+from skeleton_synapses.skeleton_utils import load_skeleton_data, connectors_from_data, node_infos_from_data
+from skeleton_synapses.detection_table import read_detections, write_detections
+from skeleton_synapses.merge_synapse_ids import merge_detections
+from skeleton_synapses.nearest_connectors import ConnectorStore, annotate_nearest_connectors
+from skeleton_synapses.filter_by_distance import filter_detections
+from skeleton_synapses.remove_csv_columns import remove_columns
+from skeleton_synapses.connected_node_distances import connected_node_distance_table
+
+import logging
+logger = logging.getLogger(__name__)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--merge', action='store_true',
+                        help='Merge all rows with the same synapse id.')
+    parser.add_argument('--nearest-connectors', action='store_true',
+                        help="Append the nearest connector columns (requires --skeleton-json and --volume-description).")
+    parser.add_argument('--max-distance-nm', type=float, default=ConnectorStore.SEARCH_RADIUS,
+                        help='With --nearest-connectors, only search for connectors within this distance of each detection '
+                             '(default: {}).  Use "inf" to search without a limit.'.format( ConnectorStore.SEARCH_RADIUS ))
+    parser.add_argument('--filter', nargs=2, action='append', default=[], metavar=('COLUMN', 'MIN_VALUE'),
+                        help='Keep only the rows whose value in COLUMN is at least MIN_VALUE.  May be given more than once.')
+    parser.add_argument('--remove-columns', nargs='+', default=[], metavar='COLUMN',
+                        help='Remove the given columns from the output.')
+    parser.add_argument('--connected-node-distances', metavar='OUTPUT_PATH',
+                        help='Also write the connected node distances (for evaluation) to the given path '
+                             '(requires --nearest-connectors).')
+    parser.add_argument('--skeleton-json',
+                        help="The skeleton's 'treenode and connector geometry' file exported from CATMAID.")
+    parser.add_argument('--skeleton-id',
+                        help='Which skeleton to use, if the skeleton file contains more than one.')
+    parser.add_argument('--volume-description',
+                        help="A file describing the CATMAID tile volume in the ilastik 'TiledVolume' json format "
+                             "(for its resolution).")
+    parser.add_argument('input_path', help='The detections from locate_synapses (csv, .h5 or .npy).')
+    parser.add_argument('output_path', help='Where to write the post-processed detections (csv, .h5 or .npy).')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    if args.connected_node_distances and not args.nearest_connectors:
+        parser.error("--connected-node-distances requires --nearest-connectors")
+    if args.nearest_connectors and not (args.skeleton_json and args.volume_description):
+        parser.error("--nearest-connectors requires --skeleton-json and --volume-description")
+
+    filters = []
+    for column_name, min_value in args.filter:
+        try:
+            filters.append( (column_name, float(min_value)) )
+        except ValueError:
+            parser.error("Invalid --filter value: {}".format( min_value ))
+
+    connector_infos = node_infos = connector_store = resolution_xyz = None
+    if args.nearest_connectors:
+        volume_description = TiledVolume.readDescription(args.volume_description)
+        z_res, y_res, x_res = volume_description.resolution_zyx
+        resolution_xyz = (x_res, y_res, z_res)
+
+        skeleton_data = load_skeleton_data(args.skeleton_json, args.skeleton_id)
+        connector_infos, _ = connectors_from_data(skeleton_data)
+        node_infos = node_infos_from_data(skeleton_data, x_res, y_res, z_res)
+        connector_store = ConnectorStore(connector_infos)
+
+    detections = read_detections(args.input_path)
+    logger.info("Read {} detections".format( len(detections) ))
+
+    output_detections, annotated_detections = \
+        postprocess_detections( detections,
+                                args.merge,
+                                connector_store,
+                                resolution_xyz,
+                                args.max_distance_nm,
+                                filters,
+                                args.remove_columns )
+
+    write_detections(args.output_path, output_detections)
+    logger.info("Wrote {} detections to {}".format( len(output_detections), args.output_path ))
+
+    if args.connected_node_distances:
+        # The raw detections need the nearest connector columns, too.
+        raw_detections = annotate_nearest_connectors( detections, connector_store, resolution_xyz, args.max_distance_nm )
+        distances, nodes_without_detections = \
+            connected_node_distance_table(connector_infos, node_infos, raw_detections, annotated_detections)
+        write_detections(args.connected_node_distances, distances)
+        logger.info( "Wrote connected node distances for {} connectors ({} without detections) to {}"
+                     .format( len(connector_infos), len(nodes_without_detections), args.connected_node_distances ) )
+    return 0
+
+def postprocess_detections( detections,
+                            merge=False,
+                            connector_store=None,
+                            resolution_xyz=None,
+                            max_distance=ConnectorStore.SEARCH_RADIUS,
+                            filters=(),
+                            columns_to_remove=() ):
+    """
+    Pass the given detection table through the post-processing stages (see above).
+
+    Args:
+        detections: A detection table (see detection_table)
+        merge: If True, merge the rows of each synapse.
+        connector_store: If given, a ConnectorStore with which to append the nearest connector columns.
+        resolution_xyz: The volume's resolution (required with connector_store)
+        max_distance: The nearest connector search radius, in nm (numpy.inf for no limit)
+        filters: A list of (column_name, min_value).  Only rows with at least min_value
+                 in each of the given columns are kept.
+        columns_to_remove: A list of columns to remove from the output.
+
+    Returns: output_detections, annotated_detections
+             where annotated_detections is the table after the merge and annotate stages
+             (i.e. before any rows or columns were removed).
+    """
+    if merge:
+        detections = merge_detections(detections)
+
+    if connector_store is not None:
+        detections = annotate_nearest_connectors(detections, connector_store, resolution_xyz, max_distance)
+    annotated_detections = detections
+
+    for column_name, min_value in filters:
+        detections = filter_detections(detections, column_name, min_value)
+
+    if columns_to_remove:
+        detections = remove_columns(detections, columns_to_remove)
+
+    return detections, annotated_detections
+
+if __name__ == "__main__":
+    sys.exit( main() )
@@ -0,0 +1,144 @@
+import os
+import errno
+import hashlib
+import tempfile
+import threading
+
+import numpy as np
+import h5py
+
+import logging
+logger = logging.getLogger(__name__)
+
+def file_hash(path, block_size=2**20):
+    """
+    Return the sha1 hex digest of the given file's contents.
+    """
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+class PredictionCache(object):
+    """
+    A persistent on-disk cache of prediction tiles, so that repeated runs over
+    the same skeleton (e.g. after a crash, or with different thresholds)
+    don't need to run the classifier again.
+
+    Similar in spirit to OpNodewiseCache, but keyed by roi rather than node id,
+    and populated automatically as the predictions are computed.
+
+    The cache is content-addressed: All entries are stored in a subdirectory of cache_dir
+    whose name is derived from the contents of the classifier project file and the volume
+    description file.  If either of those files changes, the old entries are simply never
+    used again (and eventually evicted).  Within that subdirectory, each tile is stored in
+    its own (single-chunk) HDF5 file, named after its roi.
+
+    The total size of the cache directory is bounded by max_size_mb.  When it is exceeded,
+    the least recently used entries are evicted.  (Each entry's modification time serves as
+    its last access time.)
+
+    All writes are atomic, so several processes may safely share the same cache directory.
+    """
+    # When the cache is full, evict entries until it is this fraction of max_size_mb.
+    EVICTION_TARGET_FRACTION = 0.9
+
+    def __init__(self, cache_dir, project_path, volume_description_path, max_size_mb):
+        namespace = hashlib.sha1( file_hash(project_path) + file_hash(volume_description_path) ).hexdigest()
+        self.cache_dir = cache_dir
+        self.namespace_dir = os.path.join(cache_dir, namespace)
+        try:
+            os.makedirs(self.namespace_dir)
+        except OSError as ex:
+            if ex.errno != errno.EEXIST:
+                raise
+
+        self.max_size_bytes = int(max_size_mb * 2**20)
+        self._lock = threading.Lock()
+        self._total_bytes = sum( size for _, size, _ in self._list_entries() )
+        logger.info( "Using prediction cache {} ({:.1f} MB in use)"
+                     .format( self.namespace_dir, self._total_bytes / float(2**20) ) )
+
+    def get(self, roi_xyz):
+        """
+        Return the cached predictions for the given roi, or None if they aren't in the cache.
+        """
+        path = self._entry_path(roi_xyz)
+        try:
+            with h5py.File(path, 'r') as f:
+                predictions = f['predictions'][:]
+        except (IOError, KeyError):
+            return None
+
+        # Mark as recently used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass # Evicted in the meantime (by another process).  No problem.
+        return predictions
+
+    def put(self, roi_xyz, predictions):
+        """
+        Store the given predictions in the cache, evicting old entries if necessary.
+        """
+        path = self._entry_path(roi_xyz)
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self.namespace_dir)
+        os.close(fd)
+        try:
+            predictions = np.asarray(predictions)
+            with h5py.File(tmp_path, 'w') as f:
+                f.create_dataset('predictions', data=predictions, chunks=predictions.shape)
+            entry_size = os.path.getsize(tmp_path)
+            os.rename(tmp_path, path)
+        except:
+            os.unlink(tmp_path)
+            raise
+
+        with self._lock:
+            self._total_bytes += entry_size
+            if self._total_bytes > self.max_size_bytes:
+                self._evict()
+
+    def _evict(self):
+        """
+        Delete the least recently used entries until the cache is below its eviction target.
+        (Must be called with the lock held.)
+        """
+        # Re-scan the directory, since other processes may be using it too.
+        entries = sorted( self._list_entries() )
+        self._total_bytes = sum( size for _, size, _ in entries )
+        target_bytes = self.EVICTION_TARGET_FRACTION * self.max_size_bytes
+        num_evicted = 0
+        for _, size, path in entries:
+            if self._total_bytes <= target_bytes:
+                break
+            try:
+                os.unlink(path)
+            except OSError as ex:
+                if ex.errno != errno.ENOENT:
+                    raise
+            self._total_bytes -= size
+            num_evicted += 1
+        logger.debug("Evicted {} entries from the prediction cache".format( num_evicted ))
+
+    def _list_entries(self):
+        """
+        Return a list of (mtime, size, path) for all entries in the cache.
+        """
+        entries = []
+        for filename in os.listdir(self.namespace_dir):
+            if not filename.endswith('.h5'):
+                continue
+            path = os.path.join(self.namespace_dir, filename)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue # Evicted in the meantime.
+            entries.append( (st.st_mtime, st.st_size, path) )
+        return entries
+
+    def _entry_path(self, roi_xyz):
+        start, stop = np.asarray(roi_xyz)
+        filename = "x{}-y{}-z{}_x{}-y{}-z{}.h5".format( *(tuple(start) + tuple(stop)) )
+        return os.path.join(self.namespace_dir, filename)
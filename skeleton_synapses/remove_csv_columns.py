@@ -1,19 +1,17 @@
-import csv
-from skeleton_utils import CSV_FORMAT
+from detection_table import read_detections, write_detections, select_columns
 
 def remove_csv_columns(input_path, output_path, columns_to_remove):
-    with open(input_path, 'r') as f_in, open(output_path, 'w') as f_out:
-        reader = csv.DictReader(f_in, **CSV_FORMAT)
-        output_columns = list(reader.fieldnames)
-        for col in columns_to_remove:
-            output_columns.remove(col)
+    detections = read_detections(input_path)
+    write_detections( output_path, remove_columns(detections, columns_to_remove) )
 
-        writer = csv.DictWriter(f_out, output_columns, **CSV_FORMAT)
-        writer.writeheader()
-        for row in reader:
-            for col in columns_to_remove:
-                del row[col]
-            writer.writerow(row)
+def remove_columns(detections, columns_to_remove):
+    """
+    Return a copy of the given detection table without the given columns.
+    """
+    output_columns = list(detections.dtype.names)
+    for col in columns_to_remove:
+        output_columns.remove(col)
+    return select_columns(detections, output_columns)
     
 
 if __name__ == "__main__":
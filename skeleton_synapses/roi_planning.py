@@ -0,0 +1,90 @@
+"""
+Utilities for planning which image regions to request for a group of skeleton nodes.
+"""
+import numpy as np
+
+def roi_area(roi_xyz):
+    """
+    Return the number of pixels in the xy-plane of the given roi.
+    """
+    roi_xyz = np.asarray(roi_xyz)
+    return np.prod(roi_xyz[1, :2] - roi_xyz[0, :2])
+
+def bounding_roi(rois_xyz):
+    """
+    Return the smallest roi that contains all of the given rois.
+    """
+    rois_xyz = np.asarray(rois_xyz)
+    return np.array( (rois_xyz[:, 0].min(axis=0), rois_xyz[:, 1].max(axis=0)) )
+
+def coalesce_rois_by_slice(rois_xyz, max_area_ratio=1.0):
+    """
+    Group the given rois (each with a Z-thickness of 1) so that each group
+    can be fetched with a single request for its bounding box.
+
+    Only rois on the same z-slice are grouped together, and only if the
+    bounding box of the group contains no more than max_area_ratio times
+    as many pixels as the group's rois do individually.
+    (With the default ratio of 1.0, the grouped request never computes more
+    pixels than the individual requests would have.)
+
+    The rois are considered in the order given, and each one is added to the
+    first existing group that can accept it.
+
+    Returns: A list of (bounding_roi, indexes) tuples, where indexes lists the
+             positions (in rois_xyz) of the rois in the group, in ascending order.
+    """
+    groups = []
+    for index, roi_xyz in enumerate(rois_xyz):
+        roi_xyz = np.asarray(roi_xyz)
+        assert roi_xyz[1, 2] - roi_xyz[0, 2] == 1, "Only single-slice rois are supported."
+        for group in groups:
+            group_rois, group_indexes, group_area = group
+            if group_rois[0][0, 2] != roi_xyz[0, 2]:
+                continue
+            new_bounding_roi = bounding_roi( group_rois + [roi_xyz] )
+            new_area = group_area + roi_area(roi_xyz)
+            if roi_area(new_bounding_roi) <= max_area_ratio * new_area:
+                group_rois.append(roi_xyz)
+                group_indexes.append(index)
+                group[2] = new_area
+                break
+        else:
+            groups.append( [[roi_xyz], [index], roi_area(roi_xyz)] )
+
+    return [ (bounding_roi(group_rois), group_indexes) for group_rois, group_indexes, _ in groups ]
+
+def group_overlapping_rois(rois_xyz, min_overlap_fraction):
+    """
+    Group the given rois (each with a Z-thickness of 1) into merged tiles,
+    such that each tile can be computed once and each roi's view cut out of it.
+
+    An roi joins a group only if it lies in the same z-slice and at least
+    min_overlap_fraction of its pixels are already covered by the group's
+    bounding box.  (Hence, each roi that joins a group enlarges the merged tile
+    by only a small amount.)
+    
+    The rois are considered in the order given, and each one is added to the
+    first existing group that can accept it.
+
+    Returns: A list of (tile_roi, indexes) tuples, where indexes lists the
+             positions (in rois_xyz) of the rois in the group, in ascending order.
+    """
+    groups = []
+    for index, roi_xyz in enumerate(rois_xyz):
+        roi_xyz = np.asarray(roi_xyz)
+        for group in groups:
+            tile_roi, group_indexes = group
+            if tile_roi[0, 2] != roi_xyz[0, 2]:
+                continue
+            overlap_start = np.maximum(tile_roi[0, :2], roi_xyz[0, :2])
+            overlap_stop = np.minimum(tile_roi[1, :2], roi_xyz[1, :2])
+            overlap_area = np.prod( np.maximum(overlap_stop - overlap_start, 0) )
+            if overlap_area >= min_overlap_fraction * roi_area(roi_xyz):
+                group[0] = bounding_roi( [tile_roi, roi_xyz] )
+                group_indexes.append(index)
+                break
+        else:
+            groups.append( [roi_xyz, [index]] )
+
+    return [ (tile_roi, group_indexes) for tile_roi, group_indexes in groups ]
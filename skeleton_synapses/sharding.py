@@ -0,0 +1,160 @@
+"""
+Utilities for splitting a skeleton's branches into shards that can be processed
+by independent processes, and for merging the per-shard outputs afterwards.
+"""
+import os
+import re
+import csv
+
+import numpy as np
+import h5py
+
+from skeleton_synapses.skeleton_utils import CSV_FORMAT
+from skeleton_synapses.output_writers import DEFAULT_STACK_OPTIONS, dataset_options
+
+# The image stacks written by locate_synapses
+STACK_NAMES = ["raw", "predictions", "synapse_cc", "segmentation"]
+
+# How many z-slices to copy at once when merging the image stacks.
+MERGE_BLOCK_SLICES = 100
+
+def shard_branches(branches, num_shards):
+    """
+    Split the given list of branches into (at most) num_shards contiguous groups,
+    each with roughly the same number of nodes.
+    The original branch order is preserved, both across and within the shards.
+
+    Returns: A list of shards, each of which is a list of branches.
+    """
+    total_nodes = sum( map(len, branches) )
+    num_shards = max(1, min(num_shards, len(branches)))
+    nodes_per_shard = total_nodes / float(num_shards)
+
+    shards = [[]]
+    shard_nodes = 0
+    for branch in branches:
+        # Start a new shard once the current one has its share of the nodes
+        # (but never leave branches behind without a shard to put them in).
+        if shards[-1] and shard_nodes >= nodes_per_shard*len(shards) and len(shards) < num_shards:
+            shards.append([])
+        shards[-1].append(branch)
+        shard_nodes += len(branch)
+    return shards
+
+def merge_shards(shard_dirs, shard_node_counts, output_dir, csv_filename, stack_options=None):
+    """
+    Merge the outputs of the given shard directories (in order) into a single set of
+    outputs in output_dir, as if they had been produced by a single (serial) run.
+
+    Each shard numbers its synapses and tiles starting from 1 and 0, respectively,
+    so those are renumbered to be globally unique:
+
+    - In the CSV file, synapse_id is offset by the max synapse_id of all preceding shards,
+      and tile_index is offset by the number of nodes in all preceding shards.
+    - In synapse_cc.h5, all nonzero labels are offset in the same way.
+    - In all image stacks, the slice-names are renumbered to match the merged stack.
+
+    shard_node_counts: The number of nodes that were processed in each shard.
+    stack_options: A dict of { stack_name : StackOptions } for the image stacks to merge.
+                   By default, all stacks in STACK_NAMES are merged, uncompressed.
+                   (The stacks are written with the given compression.
+                   Quantization is not applied again -- quantized shard stacks are copied verbatim.)
+
+    Note: In a serial run, the first node of a shard could have inherited
+          synapse ids from the last node of the previous shard.
+          Since shard boundaries always coincide with branch boundaries,
+          (and branches start at an end node), that is rare, and it is not attempted here.
+    """
+    if stack_options is None:
+        stack_options = dict.fromkeys(STACK_NAMES, DEFAULT_STACK_OPTIONS)
+
+    synapse_offsets, tile_offsets = _merge_csv_files(shard_dirs, shard_node_counts, output_dir, csv_filename)
+    for name in STACK_NAMES:
+        if name not in stack_options:
+            continue
+        shard_paths = [ os.path.join(shard_dir, name + ".h5") for shard_dir in shard_dirs ]
+        label_offsets = None
+        if name == "synapse_cc":
+            label_offsets = synapse_offsets
+        _merge_stacks( shard_paths, os.path.join(output_dir, name + ".h5"), tile_offsets,
+                       label_offsets, dataset_options(stack_options[name]) )
+
+def _merge_csv_files(shard_dirs, shard_node_counts, output_dir, csv_filename):
+    """
+    Concatenate the shard CSV files into a single file, renumbering synapse_id and tile_index.
+    All other fields are copied verbatim.
+
+    Returns: The synapse_id offsets and tile_index offsets that were used for each shard.
+    """
+    synapse_offsets = []
+    tile_offsets = []
+    synapse_offset = 0
+    tile_offset = 0
+    with open(os.path.join(output_dir, csv_filename), 'w') as fout:
+        csv_writer = None
+        for shard_dir, shard_node_count in zip(shard_dirs, shard_node_counts):
+            synapse_offsets.append(synapse_offset)
+            tile_offsets.append(tile_offset)
+
+            max_synapse_id = 0
+            with open(os.path.join(shard_dir, csv_filename), 'r') as fin:
+                csv_reader = csv.DictReader(fin, **CSV_FORMAT)
+                if csv_writer is None:
+                    csv_writer = csv.DictWriter(fout, csv_reader.fieldnames, **CSV_FORMAT)
+                    csv_writer.writeheader()
+                for row in csv_reader:
+                    synapse_id = int(row["synapse_id"])
+                    max_synapse_id = max(max_synapse_id, synapse_id)
+                    row["synapse_id"] = synapse_id + synapse_offset
+                    row["tile_index"] = int(row["tile_index"]) + tile_offset
+                    csv_writer.writerow(row)
+
+            synapse_offset += max_synapse_id
+            tile_offset += shard_node_count
+    return synapse_offsets, tile_offsets
+
+def _merge_stacks(shard_paths, output_path, slice_offsets, label_offsets=None, create_options={}):
+    """
+    Concatenate the given HDF5 stacks along z into a single stack.
+    If label_offsets is given, add the corresponding offset to all nonzero pixels of each shard.
+    The output dataset is created with the given create_options (e.g. compression settings).
+    """
+    with h5py.File(output_path, 'w') as fout:
+        out_data = None
+        slice_names = []
+        for shard_index, shard_path in enumerate(shard_paths):
+            with h5py.File(shard_path, 'r') as fin:
+                in_data = fin['data']
+                if out_data is None:
+                    maxshape = list(in_data.shape)
+                    maxshape[2] = None
+                    shape = list(in_data.shape)
+                    shape[2] = 0
+                    chunks = list(in_data.shape)
+                    chunks[2] = 1
+                    out_data = fout.create_dataset( 'data', shape=tuple(shape), maxshape=tuple(maxshape),
+                                                    chunks=tuple(chunks), dtype=in_data.dtype, **create_options )
+                    for key, value in in_data.attrs.items():
+                        out_data.attrs[key] = value
+
+                z_start = out_data.shape[2]
+                z_stop = z_start + in_data.shape[2]
+                out_data.resize(z_stop, 2)
+                for block_start in range(0, in_data.shape[2], MERGE_BLOCK_SLICES):
+                    block_stop = min(block_start + MERGE_BLOCK_SLICES, in_data.shape[2])
+                    block = in_data[:, :, block_start:block_stop, :]
+                    if label_offsets is not None:
+                        block = np.where(block, block + label_offsets[shard_index], 0).astype(block.dtype)
+                    out_data[:, :, z_start+block_start:z_start+block_stop, :] = block
+
+                for slice_name in fin['slice-names'][:in_data.shape[2]]:
+                    slice_names.append( _renumber_slice_name(slice_name, slice_offsets[shard_index]) )
+
+        fout.create_dataset('slice-names', data=slice_names, dtype=h5py.special_dtype(vlen=str))
+
+def _renumber_slice_name(slice_name, offset):
+    """
+    Slice names have the form "{z}: {name}".  Offset the z index by the given amount.
+    """
+    z, name = re.match(r"(\d+): (.*)", slice_name).groups()
+    return "{}: {}".format(int(z) + offset, name)
@@ -1,9 +1,9 @@
 import os
-import json
+import array
 import collections
 import numpy
-import networkx as nx
-from tree_util import partition
+from tree_util import partition, ArrayTree, networkx_node_order
+from json_stream import JsonStream
 
 
 # Not  used in this file, but defined for cmd-line utilities to use.
@@ -37,112 +37,220 @@ def parse_skeleton_swc(swc_path, x_res, y_res, z_res):
             node_infos.append( NodeInfo(node_id, x_px, y_px, z_px, parent_id) )    
     return node_infos
 
-def parse_skeleton_json(json_path, x_res, y_res, z_res):
+# The contents of one skeleton in a CATMAID "Treenode and connector geometry" export, as compact arrays:
+# - skeleton_id: The skeleton's id (a string, as it appears in the file)
+# - node_ids, parent_ids: int64 arrays (parent_id = -1 for the root)
+# - node_locations_nm: float64 array of shape (N, 3), xyz
+# - connector_ids: int64 array
+# - connector_locations_nm: float64 array of shape (C, 3), xyz
+# - presynaptic_links, postsynaptic_links: int64 arrays of (connector_id, node_id) pairs, shape (L, 2)
+#   (Following the file's terminology: A presynaptic link means the node is presynaptic to the connector.)
+# All arrays are in the order in which the entries appear in the file.
+SkeletonData = collections.namedtuple( 'SkeletonData', 'skeleton_id node_ids parent_ids node_locations_nm '
+                                                       'connector_ids connector_locations_nm '
+                                                       'presynaptic_links postsynaptic_links' )
+
+def iter_skeleton_json(json_path, skeleton_ids=None):
     """
-    Parse the given json file and return a list of NodeInfo tuples.
-    Coordinates are converted from nm to pixels.
-    
-    Note: Mimicking the conventions above for swc files, 
-          a parentless node will be assigned parent_id = -1    
+    Read a CATMAID "Treenode and connector geometry" export in a single pass,
+    and yield a SkeletonData tuple for each skeleton it contains.
+
+    The file is read incrementally, so only the arrays (not the parsed json objects) are kept in memory.
+    If skeleton_ids is given, all other skeletons are skipped.
+    """
+    if skeleton_ids is not None:
+        skeleton_ids = set(map(str, skeleton_ids))
+
+    with open(json_path, 'r') as json_file:
+        stream = JsonStream(json_file)
+        for key in stream.iter_object():
+            if key != 'skeletons':
+                stream.skip_value()
+                continue
+            for skeleton_id in stream.iter_object():
+                if skeleton_ids is not None and skeleton_id not in skeleton_ids:
+                    stream.skip_value()
+                else:
+                    yield _read_skeleton_data(stream, skeleton_id)
+
+def _read_skeleton_data(stream, skeleton_id):
+    node_ids = array.array('l')
+    parent_ids = array.array('l')
+    node_locations = array.array('d')
+    connector_ids = array.array('l')
+    connector_locations = array.array('d')
+    presynaptic_links = array.array('l')
+    postsynaptic_links = array.array('l')
+
+    for section in stream.iter_object():
+        if section == 'treenodes':
+            for node_id in stream.iter_object():
+                node_data = stream.read_value()
+                node_ids.append( int(node_id) )
+                parent_ids.append( int(node_data['parent_id'] or -1) )
+                node_locations.extend( map(float, node_data['location']) )
+        elif section == 'connectors':
+            for connector_id in stream.iter_object():
+                connector_data = stream.read_value()
+                connector_id = int(connector_id)
+                connector_ids.append( connector_id )
+                connector_locations.extend( map(float, connector_data['location']) )
+                for node_id in connector_data['presynaptic_to']:
+                    presynaptic_links.extend( (connector_id, int(node_id)) )
+                for node_id in connector_data['postsynaptic_to']:
+                    postsynaptic_links.extend( (connector_id, int(node_id)) )
+        else:
+            stream.skip_value()
+
+    return SkeletonData( skeleton_id,
+                         _to_numpy(node_ids, numpy.int64),
+                         _to_numpy(parent_ids, numpy.int64),
+                         _to_numpy(node_locations, numpy.float64).reshape(-1, 3),
+                         _to_numpy(connector_ids, numpy.int64),
+                         _to_numpy(connector_locations, numpy.float64).reshape(-1, 3),
+                         _to_numpy(presynaptic_links, numpy.int64).reshape(-1, 2),
+                         _to_numpy(postsynaptic_links, numpy.int64).reshape(-1, 2) )
+
+def _to_numpy(a, dtype):
+    """
+    Convert the given array.array to a numpy array of the given dtype.
+    """
+    if len(a) == 0:
+        return numpy.zeros((0,), dtype=dtype)
+    return numpy.frombuffer(a, dtype=a.typecode).astype(dtype)
+
+def load_skeleton_data(json_path, skeleton_id=None):
+    """
+    Return the SkeletonData for the given skeleton in the given json file.
+    If skeleton_id is None, the file must contain exactly one skeleton.
     """
     assert os.path.splitext(json_path)[1] == '.json', \
         "Skeleton file must end with .json"
-    
-    node_infos = []
-    with open(json_path, 'r') as json_file:
-        json_data = json.load(json_file)
-    
-    if len(json_data['skeletons']) == 0:
+
+    skeleton_ids = None
+    if skeleton_id is not None:
+        skeleton_ids = [skeleton_id]
+    skeletons = list( iter_skeleton_json(json_path, skeleton_ids) )
+
+    if len(skeletons) == 0:
+        if skeleton_id is not None:
+            raise Exception("File '{}' does not contain skeleton {}.".format( json_path, skeleton_id ))
         raise Exception("File '{}' does not contain any skeleton data.".format( json_path ))
-    if len(json_data['skeletons']) > 1:
-        raise Exception("File '{}' contains more than one skeleton.  Can't process.".format( json_path ))
-    node_dict = json_data['skeletons'].values()[0]['treenodes']
-
-    for node_id, node_data in node_dict.iteritems():
-        # Convert from string
-        node_id = int( node_id )
-        if node_data['parent_id']:
-            parent_id = int( node_data['parent_id'] )
-        else:
-            parent_id = -1
-        x_nm, y_nm, z_nm = map(float, node_data['location'])
+    if len(skeletons) > 1:
+        raise Exception( "File '{}' contains more than one skeleton ({}).  Please specify which one to use."
+                         .format( json_path, ", ".join( s.skeleton_id for s in skeletons ) ) )
+    return skeletons[0]
 
-        # Convert to pixels
-        x_px = int(x_nm / float(x_res))
-        y_px = int(y_nm / float(y_res))
-        z_px = int(z_nm / float(z_res))
-        
-        node_infos.append( NodeInfo(node_id, x_px, y_px, z_px, parent_id) )
+def _json_dict_order(ids):
+    """
+    Return the indexes of the given ids, in the order in which the (python 2) dict
+    produced by json.load() would list them.
+
+    The parsers below used to iterate over such dicts, and the resulting order determines the
+    order of the skeleton's branches (and thus of the output files and checkpoints).
+    A dict built by inserting the same keys in the same order has the same iteration order.
+    """
+    return dict( (str(id_), index) for index, id_ in enumerate(ids) ).values()
+
+def node_infos_from_data(skeleton_data, x_res, y_res, z_res):
+    """
+    Return a list of NodeInfo tuples for the nodes in the given SkeletonData.
+    Coordinates are converted from nm to pixels.
+    """
+    locations_px = (skeleton_data.node_locations_nm / numpy.array([x_res, y_res, z_res], dtype=float)).astype(int)
+    node_infos = []
+    for index in _json_dict_order(skeleton_data.node_ids):
+        x_px, y_px, z_px = map(int, locations_px[index])
+        node_infos.append( NodeInfo( int(skeleton_data.node_ids[index]), x_px, y_px, z_px,
+                                     int(skeleton_data.parent_ids[index]) ) )
+    return node_infos
+
+def parse_skeleton_json(json_path, x_res, y_res, z_res, skeleton_id=None):
+    """
+    Parse the given json file and return a list of NodeInfo tuples.
+    Coordinates are converted from nm to pixels.
+    If the file contains more than one skeleton, the skeleton_id must be given.
     
-    skeleton_id = json_data['skeletons'].keys()[0]
-    return skeleton_id, node_infos
+    Note: Mimicking the conventions above for swc files, 
+          a parentless node will be assigned parent_id = -1    
+    """
+    skeleton_data = load_skeleton_data(json_path, skeleton_id)
+    return skeleton_data.skeleton_id, node_infos_from_data(skeleton_data, x_res, y_res, z_res)
 
 def parse_skeleton_ids( json_path ):
     """
     Read the given skeleton json file and return the list of skeleton ids it contains.
     """
     assert os.path.splitext(json_path)[1] == '.json'
+    skeleton_ids = []
     with open(json_path, 'r') as json_file:
-        json_data = json.load(json_file)
-    return json_data['skeletons'].keys()
+        stream = JsonStream(json_file)
+        for key in stream.iter_object():
+            if key != 'skeletons':
+                stream.skip_value()
+                continue
+            for skeleton_id in stream.iter_object():
+                skeleton_ids.append(skeleton_id)
+                stream.skip_value()
+    return skeleton_ids
 
 # Note that in ConnectorInfos, we keep the coordinates in nanometers!
 ConnectorInfo = collections.namedtuple('ConnectorInfo', 'id x_nm y_nm z_nm incoming_nodes outgoing_nodes')
-def parse_connectors( json_path ):
+def connectors_from_data( skeleton_data ):
     """
-    Parses skeleton files as returned by the CATMAID
-    export widget's "Treenode and connector geometry" format.
-    
-    Read the skeleton json file and return:
+    Return the connectors of the given SkeletonData as:
     - A list of ConnectorInfo tuples
     - A dict of node -> connectors (regardless of whether the node is incoming or outgoing for the connector:
       { node : [connector_id, connector_id, ...] }
-    
     """
+    # Note the strange terminology of the json file:
+    # The 'presynaptic_to' list means "all nodes in this list are presynaptic to the connector"
+    #  (not "the connector is presynaptic to the following nodes")
+    incoming = collections.defaultdict(list)
+    for connector_id, node_id in skeleton_data.presynaptic_links.tolist():
+        incoming[connector_id].append(node_id)
+    outgoing = collections.defaultdict(list)
+    for connector_id, node_id in skeleton_data.postsynaptic_links.tolist():
+        outgoing[connector_id].append(node_id)
+
     connector_infos = []
     node_to_connector = {}
-    with open(json_path, 'r') as json_file:
-        json_data = json.load(json_file)
+    for index in _json_dict_order(skeleton_data.connector_ids):
+        connector_id = int(skeleton_data.connector_ids[index])
+        x_nm, y_nm, z_nm = skeleton_data.connector_locations_nm[index].tolist()
 
-    if len(json_data['skeletons']) == 0:
-        raise Exception("File '{}' does not contain any skeleton data.".format( json_path ))
-    if len(json_data['skeletons']) > 1:
-        raise Exception("File '{}' contains more than one skeleton.  Can't process.".format( json_path ))
-
-    connection_dict = json_data['skeletons'].values()[0]['connectors']
-    for connector_id, connector_data in connection_dict.iteritems():
-        connector_id = int(connector_id)
-        x_nm, y_nm, z_nm = map(float, connector_data['location'])
-        #x_px = int(x_nm / float(X_RES))
-        #y_px = int(y_nm / float(Y_RES))
-        #z_px = int(z_nm / float(Z_RES))
-
-
-        # Note the strange terminology of the json file:
-        # The 'presynaptic_to' list means "all nodes in this list are presynaptic to the connector"
-        #  (not "the connector is presynaptic to the following nodes")
-        incoming = map(int, connector_data['presynaptic_to'] )
-        outgoing = map(int, connector_data['postsynaptic_to'] )
-        
-        for node in incoming:
-            node_connectors = node_to_connector.setdefault(node, [])
-            node_connectors.append(connector_id)
-        
-        for node in outgoing:
+        for node in incoming[connector_id] + outgoing[connector_id]:
             node_connectors = node_to_connector.setdefault(node, [])
             node_connectors.append(connector_id)
         
-        connector_infos.append( ConnectorInfo(connector_id, x_nm, y_nm, z_nm, incoming, outgoing) )
+        connector_infos.append( ConnectorInfo( connector_id, x_nm, y_nm, z_nm,
+                                               incoming[connector_id], outgoing[connector_id] ) )
 
     return connector_infos, node_to_connector
 
+def parse_connectors( json_path, skeleton_id=None ):
+    """
+    Parses skeleton files as returned by the CATMAID
+    export widget's "Treenode and connector geometry" format.
+    If the file contains more than one skeleton, the skeleton_id must be given.
+    
+    Read the skeleton json file and return:
+    - A list of ConnectorInfo tuples
+    - A dict of node -> connectors (regardless of whether the node is incoming or outgoing for the connector:
+      { node : [connector_id, connector_id, ...] }
+    
+    """
+    return connectors_from_data( load_skeleton_data(json_path, skeleton_id) )
+
 #
 # A 'tree' is a networkx.DiGraph with a single root node (a node without parents)
 #
 def construct_tree(node_infos):
     """
     Construct a networkx.DiGraph() from a list of SWC NodeInfo instances.
+    (Skeleton uses the more compact ArrayTree instead.)
     """
+    import networkx as nx
     tree = nx.DiGraph()
     for node_info in node_infos:
         tree.add_edge( node_info.parent_id, node_info.id )
@@ -163,6 +271,16 @@ def roi_around_node(node_info, radius):
     coord_xyz = (node_info.x_px, node_info.y_px, node_info.z_px)
     return roi_around_point(coord_xyz, radius)
 
+def rois_around_nodes(node_infos, radius):
+    """
+    Same as roi_around_node(), for a list of nodes at once.
+    Returns an array of shape (N, 2, 3).
+    """
+    coords_xyz = numpy.array( [ (n.x_px, n.y_px, n.z_px) for n in node_infos ], dtype=int ).reshape(-1, 3)
+    starts = coords_xyz - [radius, radius, 0]
+    stops = coords_xyz + [radius+1, radius+1, 1]
+    return numpy.stack( (starts, stops), axis=1 )
+
 def branchwise_node_infos(tree):
     branches = []
     for branch in partition(tree):
@@ -185,22 +303,50 @@ def nodes_and_rois_for_tree(tree, radius):
     return branchwise_rois
 
 class Skeleton(object):
-    def __init__(self, json_path, resolution_xyz):
-        skeleton_id, node_infos = parse_skeleton_json( json_path, *resolution_xyz )
-        connector_infos_list, node_to_connector = parse_connectors(json_path)
+    def __init__(self, json_path, resolution_xyz, skeleton_id=None):
+        """
+        Load the given skeleton from a CATMAID json export.
+        If the file contains more than one skeleton, the skeleton_id must be given.
+        (To load all of them at once, use load_skeletons().)
+        """
+        self._init_from_data( load_skeleton_data(json_path, skeleton_id), resolution_xyz )
+
+    @classmethod
+    def from_data(cls, skeleton_data, resolution_xyz):
+        """
+        Construct a Skeleton from an already-parsed SkeletonData tuple.
+        """
+        skeleton = cls.__new__(cls)
+        skeleton._init_from_data(skeleton_data, resolution_xyz)
+        return skeleton
+
+    def _init_from_data(self, skeleton_data, resolution_xyz):
+        node_infos = node_infos_from_data( skeleton_data, *resolution_xyz )
+        connector_infos_list, node_to_connector = connectors_from_data( skeleton_data )
         
-        self.skeleton_id = skeleton_id
+        self.skeleton_id = skeleton_data.skeleton_id
         self.connector_infos = { info.id : info for info in connector_infos_list }
         self.node_to_connector = node_to_connector
 
-        # Construct a networkx tree
-        self.tree = construct_tree( node_infos )
+        # Construct the tree (with the nodes in the same order as node_infos)
+        node_ids = numpy.array( [ n.id for n in node_infos ], dtype=numpy.int64 )
+        parent_ids = numpy.array( [ n.parent_id for n in node_infos ], dtype=numpy.int64 )
+        self.tree = ArrayTree( node_ids, parent_ids )
         
         # And a list of the branches [[NodeInfo, NodeInfo,...], [NodeInfo, NodeInfo,...],...]
-        self.branches = branchwise_node_infos(self.tree)
+        # (In the same order that partition() produces for the equivalent networkx tree.)
+        branches = self.tree.partition( networkx_node_order(node_ids, parent_ids) )
+        self.branches = [ [ node_infos[index] for index in branch ] for branch in branches ]
 
         self.x_res, self.y_res, self.z_res = resolution_xyz
 
+def load_skeletons(json_path, resolution_xyz):
+    """
+    Load all of the skeletons in the given CATMAID json export (in a single pass over the file).
+    """
+    return [ Skeleton.from_data(skeleton_data, resolution_xyz)
+             for skeleton_data in iter_skeleton_json(json_path) ]
+
 if __name__ == "__main__":
     X_RES = 3.8
     Y_RES = 3.8
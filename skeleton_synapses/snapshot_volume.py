@@ -0,0 +1,184 @@
+"""
+Download the raw data tiles around a skeleton into a local directory,
+so that locate_synapses can be run on them without touching the tile server.
+
+The tiles are stored unmodified (still encoded), one file per tile, in a nested
+{z_index}/{y_index}/{x_index}.{format} layout (similar to an N5 volume's chunk layout).
+Next to them, a new volume description is written, whose tile_url_format points
+at the local tiles (via file://).  Pass that description to locate_synapses instead of
+the original one.
+
+Only the tiles within the given radius (plus a margin, for the classifier's halo)
+of the skeleton's nodes are downloaded.  Reading any other part of the snapshot will fail.
+Tiles that the server doesn't have (HTTP 404) are stored as all-zero tiles,
+which is how they would be read from the server, too.
+
+Only the tile cache (see tile_cache.install_tile_cache()) can read file:// tile urls,
+so the snapshot can't be used with locate_synapses --tile-cache-size-mb=0.
+
+The original description's extend_slices setting is applied while downloading:
+each missing slice is stored as a copy of the slice that replaces it,
+so the snapshot's description doesn't need an extend_slices setting.
+"""
+import os
+import sys
+import json
+import errno
+import shutil
+import argparse
+import tempfile
+import threading
+from multiprocessing.pool import ThreadPool
+
+import vigra
+from lazyflow.utility.io_util import TiledVolume
+
+from skeleton_synapses.skeleton_utils import Skeleton, rois_around_nodes
+from skeleton_synapses.tile_cache import TileSource, TileNotFoundError, create_session
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Extra pixels to download around each node's roi,
+# so that the classifier's halo is also available locally.
+DEFAULT_MARGIN_PX = 50
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--roi-radius-px', type=int, default=150,
+                        help='The radius (in pixels) around each skeleton node to download. '
+                             'Should match the radius given to locate_synapses.')
+    parser.add_argument('--margin-px', type=int, default=DEFAULT_MARGIN_PX,
+                        help='Extra pixels to download around each node, for the classifier\'s halo.')
+    parser.add_argument('--threads', type=int, default=8,
+                        help='How many tiles to download concurrently.')
+    parser.add_argument('--skeleton-id',
+                        help='Which skeleton to download, if the skeleton file contains more than one.')
+    parser.add_argument('skeleton_json', help="A 'treenode and connector geometry' file exported from CATMAID")
+    parser.add_argument('volume_description', help="A file describing the CATMAID tile volume in the ilastik 'TiledVolume' json format.")
+    parser.add_argument('output_dir', help="A directory to store the tiles and the snapshot's volume description in.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    volume_description = TiledVolume.readDescription(args.volume_description)
+    z_res, y_res, x_res = volume_description.resolution_zyx
+    skeleton = Skeleton(args.skeleton_json, (x_res, y_res, z_res), args.skeleton_id)
+
+    auth = None
+    if getattr(volume_description, 'username', None):
+        auth = (volume_description.username, volume_description.password)
+    tile_source = TileSource(volume_description, None, create_session(args.threads, auth))
+
+    node_infos = [ node_info for branch in skeleton.branches for node_info in branch ]
+    tile_positions = footprint_tile_positions(tile_source, node_infos, args.roi_radius_px + args.margin_px)
+
+    tiles_dir = os.path.join(args.output_dir, 'tiles')
+    num_downloaded = snapshot_tiles(tile_source, tile_positions, tiles_dir, args.threads)
+    logger.info( "Downloaded {} tiles ({} were already present)"
+                 .format( num_downloaded, len(tile_positions) - num_downloaded ) )
+
+    with open(args.volume_description, 'r') as f:
+        description_fields = json.load(f)
+    description_path = os.path.join(args.output_dir, 'volume-description.json')
+    with open(description_path, 'w') as f:
+        json.dump( snapshot_description(description_fields, tiles_dir), f, indent=4, sort_keys=True )
+    logger.info("Wrote {}".format( description_path ))
+    return 0
+
+def footprint_tile_positions(tile_source, node_infos, radius):
+    """
+    Return the sorted (z, y_index, x_index) positions of all tiles within the given radius of any of the given nodes.
+    """
+    tile_positions = set()
+    for roi_xyz in rois_around_nodes(node_infos, radius):
+        tile_positions.update( tile_source.tile_positions(roi_xyz) )
+    return sorted(tile_positions)
+
+def snapshot_tiles(tile_source, tile_positions, tiles_dir, num_threads=8):
+    """
+    Download the tiles at the given positions into tiles_dir (see snapshot_tile_path()).
+    Tiles that are already present are skipped, so an interrupted snapshot can simply be restarted.
+    Missing tiles are stored as all-zero tiles (see encode_missing_tile()).
+    Returns the number of tiles that were downloaded (including missing ones).
+    """
+    # With extend_slices, several positions may share the same source tile.
+    # Download each one only once.
+    positions_by_url = {}
+    for tile_position in tile_positions:
+        if not os.path.exists( snapshot_tile_path(tiles_dir, tile_position, tile_source.description.format) ):
+            positions_by_url.setdefault(tile_source.tile_url(*tile_position), []).append(tile_position)
+
+    # Encoded on demand (at most once)
+    missing_tile_data = []
+    missing_tile_lock = threading.Lock()
+
+    def download(url_and_positions):
+        url, positions = url_and_positions
+        try:
+            data = tile_source.fetch_encoded_tile(url)
+        except TileNotFoundError:
+            logger.warn("NOTFOUND: {}".format( url ))
+            with missing_tile_lock:
+                if not missing_tile_data:
+                    missing_tile_data.append( encode_missing_tile(tile_source) )
+            data = missing_tile_data[0]
+        for tile_position in positions:
+            _write_atomic( snapshot_tile_path(tiles_dir, tile_position, tile_source.description.format), data )
+        return len(positions)
+
+    pool = ThreadPool(num_threads)
+    try:
+        return sum( pool.imap_unordered(download, positions_by_url.items()) )
+    finally:
+        pool.close()
+        pool.join()
+
+def encode_missing_tile(tile_source):
+    """
+    Return the all-zero tile that stands in for a missing tile (see TileSource.missing_tile()),
+    encoded in the volume's tile format.
+    """
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'missing.' + tile_source.description.format)
+        vigra.impex.writeImage( vigra.taggedView(tile_source.missing_tile()[..., 0], 'yx'), path )
+        with open(path, 'rb') as f:
+            return f.read()
+    finally:
+        shutil.rmtree(tmpdir)
+
+def snapshot_tile_path(tiles_dir, tile_position, tile_format):
+    z, y_index, x_index = tile_position
+    return os.path.join( tiles_dir, str(z), str(y_index), "{}.{}".format(x_index, tile_format) )
+
+def snapshot_description(description_fields, tiles_dir):
+    """
+    Given the (json) fields of the original volume description,
+    return the fields of the snapshot's description.
+    """
+    fields = dict(description_fields)
+    fields['tile_url_format'] = 'file://' + os.path.abspath(tiles_dir) + '/{z_index}/{y_index}/{x_index}.' + fields['format']
+    fields['## NOTES'] = "A local snapshot of {}".format( description_fields['tile_url_format'] )
+
+    # Already applied to the snapshot's tiles
+    fields.pop('extend_slices', None)
+
+    # Not needed for local files
+    fields.pop('username', None)
+    fields.pop('password', None)
+    return fields
+
+def _write_atomic(path, data):
+    try:
+        os.makedirs(os.path.dirname(path))
+    except OSError as ex:
+        if ex.errno != errno.EEXIST:
+            raise
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.rename(tmp_path, path)
+
+if __name__ == "__main__":
+    sys.exit( main() )
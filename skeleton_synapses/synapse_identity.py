@@ -0,0 +1,306 @@
+"""
+Global synapse ids, linked across all of the tiles in a run (not just consecutive ones).
+
+As each tile is processed, its detections are given provisional ids,
+and the world-space footprint (the labeled pixels) of each detection is recorded.
+Detections whose footprints overlap in the same or in adjacent z-slices are joined
+in a union-find structure, no matter which branch or node they came from.
+When the run is finished, the provisional ids are replaced by the final (consecutive) ids
+in the output files.
+"""
+import os
+import csv
+import shutil
+import cPickle as pickle
+
+import numpy as np
+import h5py
+
+from skeleton_synapses.skeleton_utils import CSV_FORMAT
+
+import logging
+logger = logging.getLogger(__name__)
+
+# How many z-slices to rewrite at once in the final pass over the synapse_cc stack.
+REWRITE_BLOCK_SLICES = 100
+
+class UnionFind(object):
+    """
+    Disjoint sets of the integers 0..N-1.
+    The representative of each set is always its smallest member.
+    """
+    def __init__(self):
+        self.parents = []
+
+    def __len__(self):
+        return len(self.parents)
+
+    def add(self, count=1):
+        """
+        Add the given number of new (singleton) elements.
+        """
+        self.parents.extend( range(len(self.parents), len(self.parents)+count) )
+
+    def find(self, x):
+        parents = self.parents
+        while parents[x] != x:
+            # Path halving
+            parents[x] = parents[parents[x]]
+            x = parents[x]
+        return x
+
+    def union(self, a, b):
+        root_a = self.find(a)
+        root_b = self.find(b)
+        if root_a < root_b:
+            self.parents[root_b] = root_a
+        elif root_b < root_a:
+            self.parents[root_a] = root_b
+
+    def roots(self):
+        """
+        Return an array of the representative of every element.
+        """
+        roots = np.array(self.parents, dtype=np.uint32)
+        while True:
+            next_roots = roots[roots]
+            if (next_roots == roots).all():
+                return roots
+            roots = next_roots
+
+class GlobalSynapseRelabeler(object):
+    """
+    A drop-in replacement for SynapseSliceRelabeler that links detections
+    across all tiles processed so far, rather than only the previous one.
+
+    normalize_synapse_ids() returns the detections with (unique) provisional ids.
+    Once all tiles have been processed, final_id_mapping() gives the final id of each provisional id.
+
+    The recorded footprints grow with every tile, so they aren't copied into each checkpoint.
+    Instead, state() appends the changes since its previous call to a journal file,
+    and the state itself only records the journal's length.  (Like the CSV file's offset.)
+    restore_state() rebuilds the relabeler by replaying the journal up to that length.
+    """
+    def __init__(self, min_overlap_fraction=None, journal_path=None):
+        """
+        min_overlap_fraction: If given, a detection is only linked to a previously recorded detection
+                              if at least this fraction of its pixels overlap it.
+                              By default, a single overlapping pixel is sufficient.
+        journal_path: Where to write the journal for state() and restore_state().
+                      (Not needed if they aren't used.)
+        """
+        self.min_overlap_fraction = min_overlap_fraction
+        self.journal_path = journal_path
+        self.max_label = 0
+
+        # Set once the provisional ids in the output files have been replaced with the final ids.
+        self.finalized = False
+
+        # Element 0 is the background.
+        self.synapse_sets = UnionFind()
+        self.synapse_sets.add()
+
+        # For each z-slice: A list of sorted runs of (pixel keys, provisional id of each pixel).
+        # Each run is at least twice as long as the next one, so there are only a few runs,
+        # and recording a tile doesn't re-sort the pixels that are already recorded.
+        self.footprints = {}
+
+        # The changes that haven't been written to the journal yet, one entry per tile:
+        # (num_new_ids, [(id, linked_id), ...], z, new_footprint_keys, new_footprint_ids)
+        self._journal_entries = []
+        self._journal_length = None
+
+    def state(self):
+        """
+        Append the changes since the previous call to the journal file,
+        and return this relabeler's state (but not its settings), suitable for a checkpoint.
+        """
+        if self.journal_path is None:
+            raise RuntimeError("GlobalSynapseRelabeler needs a journal_path to record its state.")
+
+        # A new relabeler starts a new journal.
+        with open(self.journal_path, 'ab' if self._journal_length is not None else 'wb') as f:
+            pickle.dump(self._journal_entries, f, pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+            self._journal_length = os.fstat(f.fileno()).st_size
+        self._journal_entries = []
+
+        return { 'journal_length' : self._journal_length,
+                 'max_label' : self.max_label,
+                 'finalized' : self.finalized }
+
+    def restore_state(self, state):
+        """
+        Continue from a state returned by state(), by replaying the journal up to that point.
+        (Anything written to the journal after that is discarded.)
+        Must be called before any tiles are processed.
+        The relabeler's settings (e.g. min_overlap_fraction) are left as they are.
+        """
+        with open(self.journal_path, 'r+b') as f:
+            f.truncate(state['journal_length'])
+            while f.tell() < state['journal_length']:
+                for num_new_ids, links, z, keys, pixel_ids in pickle.load(f):
+                    self.max_label += num_new_ids
+                    self.synapse_sets.add(num_new_ids)
+                    for provisional_id, linked_id in links:
+                        self.synapse_sets.union(provisional_id, linked_id)
+                    self._record_footprint(z, keys, pixel_ids)
+
+        assert self.max_label == state['max_label'], \
+            "The synapse id journal doesn't match the checkpoint."
+        self.finalized = state['finalized']
+        self._journal_entries = []
+        self._journal_length = state['journal_length']
+
+    def normalize_synapse_ids(self, current_slice, current_roi):
+        """
+        Assign new provisional ids to the labeled objects in current_slice,
+        and link them to any recorded detections they overlap.
+
+        current_slice: A label image (0 is background)
+        current_roi: The position of current_slice in the volume, with a Z-thickness of 1.
+        """
+        current_roi = np.asarray(current_roi)
+        current_slice = np.asarray(current_slice)
+        mask = (current_slice != 0)
+        labels = current_slice[mask]
+        if len(labels) == 0:
+            return current_slice
+
+        unique_labels, label_indexes = np.unique(labels, return_inverse=True)
+        provisional_ids = np.arange( self.max_label+1, self.max_label+1+len(unique_labels), dtype=np.uint32 )
+        self.max_label += len(unique_labels)
+        self.synapse_sets.add( len(unique_labels) )
+
+        coords = np.nonzero(mask)
+        keys = _pixel_keys( coords[0] + current_roi[0,0], coords[1] + current_roi[0,1] )
+        label_sizes = np.bincount(label_indexes)
+
+        # The (provisional id, recorded id) pairs to link
+        links = []
+        z = int(current_roi[0,2])
+        for neighbor_z in (z-1, z, z+1):
+            if neighbor_z not in self.footprints:
+                continue
+            found, recorded_ids = _lookup_footprint(self.footprints[neighbor_z], keys)
+
+            # Joint histogram of the (current, recorded) id pairs
+            num_recorded = int(self.max_label)+1
+            pair_keys = label_indexes[found].astype(np.uint64) * num_recorded + recorded_ids[found]
+            pair_keys, pair_counts = np.unique(pair_keys, return_counts=True)
+            pair_current = (pair_keys // num_recorded).astype(np.intp)
+            pair_recorded = (pair_keys % num_recorded)
+            if self.min_overlap_fraction:
+                sufficient = (pair_counts >= self.min_overlap_fraction * label_sizes[pair_current])
+                pair_current = pair_current[sufficient]
+                pair_recorded = pair_recorded[sufficient]
+
+            for current_index, recorded_id in zip(pair_current, pair_recorded):
+                links.append( (int(provisional_ids[current_index]), int(recorded_id)) )
+
+        for provisional_id, linked_id in links:
+            self.synapse_sets.union(provisional_id, linked_id)
+        new_keys, new_pixel_ids = self._record_footprint(z, keys, provisional_ids[label_indexes])
+        self._journal_entries.append( (len(unique_labels), links, z, new_keys, new_pixel_ids) )
+
+        relabeled_slice = np.zeros(current_slice.shape, dtype=np.uint32)
+        relabeled_slice[mask] = provisional_ids[label_indexes]
+        return relabeled_slice
+
+    def _record_footprint(self, z, keys, pixel_ids):
+        """
+        Add the given pixels to the footprint of slice z, skipping pixels that are already recorded.
+        Returns: The (keys, pixel_ids) that were added.
+        """
+        runs = self.footprints.setdefault(z, [])
+        if runs:
+            recorded, _ = _lookup_footprint(runs, keys)
+            keys, pixel_ids = keys[~recorded], pixel_ids[~recorded]
+        if len(keys) == 0:
+            return keys, pixel_ids
+
+        # Only the new pixels are sorted.  They are then merged into the
+        # smaller runs (amortized O(log n) merges per pixel), as in a binary counter.
+        order = np.argsort(keys, kind='mergesort')
+        run_keys, run_ids = keys[order], pixel_ids[order]
+        while runs and len(runs[-1][0]) < 2*len(run_keys):
+            previous_keys, previous_ids = runs.pop()
+            positions = np.searchsorted(previous_keys, run_keys)
+            run_keys, run_ids = ( np.insert(previous_keys, positions, run_keys),
+                                  np.insert(previous_ids, positions, run_ids) )
+        runs.append( (run_keys, run_ids) )
+        return keys, pixel_ids
+
+    def final_id_mapping(self):
+        """
+        Return an array that maps each provisional id to its final id.
+        The final ids are consecutive, and numbered in order of first detection.
+        """
+        # Since each set is represented by its smallest member, sorting the
+        # representatives sorts the synapses by their first detection.
+        _, final_ids = np.unique( self.synapse_sets.roots(), return_inverse=True )
+        return final_ids.astype(np.uint32)
+
+def _lookup_footprint(runs, keys):
+    """
+    Look up the given pixel keys in the given footprint runs (see GlobalSynapseRelabeler.footprints).
+    Returns: (found, ids) where found is a boolean mask of the keys that are recorded,
+             and ids holds their provisional ids (0 where not found).
+    """
+    found = np.zeros(len(keys), dtype=bool)
+    ids = np.zeros(len(keys), dtype=np.uint32)
+    for run_keys, run_ids in runs:
+        positions = np.minimum( np.searchsorted(run_keys, keys), len(run_keys)-1 )
+        in_run = (run_keys[positions] == keys)
+        found |= in_run
+        ids[in_run] = run_ids[positions[in_run]]
+    return found, ids
+
+def _pixel_keys(x, y):
+    """
+    Combine the given (world) pixel coordinates into a single sortable key per pixel.
+    """
+    return np.asarray(x, dtype=np.int64) * 2**32 + (np.asarray(y, dtype=np.int64) + 2**31)
+
+def rewritten_path(path):
+    """
+    Where rewrite_synapse_ids() writes the rewritten copy of the given output file.
+    """
+    return path + '.rewritten'
+
+def rewrite_synapse_ids(id_mapping, csv_path, synapse_cc_path=None):
+    """
+    Write copies of the given output files (see rewritten_path()) in which the provisional
+    synapse ids are replaced with their final ids.  The original files are left as they are,
+    so the ids can be rewritten again if the process dies before the copies are complete.
+    Once they are (and that has been recorded), call replace_rewritten_files().
+    """
+    with open(csv_path, 'r') as fin, open(rewritten_path(csv_path), 'w') as fout:
+        csv_reader = csv.DictReader(fin, **CSV_FORMAT)
+        csv_writer = csv.DictWriter(fout, csv_reader.fieldnames, **CSV_FORMAT)
+        csv_writer.writeheader()
+        for row in csv_reader:
+            row["synapse_id"] = id_mapping[int(row["synapse_id"])]
+            csv_writer.writerow(row)
+
+    if synapse_cc_path is not None:
+        tmp_stack_path = rewritten_path(synapse_cc_path)
+        shutil.copyfile(synapse_cc_path, tmp_stack_path)
+        with h5py.File(tmp_stack_path, 'r+') as f:
+            data = f['data']
+            for block_start in range(0, data.shape[2], REWRITE_BLOCK_SLICES):
+                block_stop = min(block_start + REWRITE_BLOCK_SLICES, data.shape[2])
+                data[:, :, block_start:block_stop, :] = id_mapping[ data[:, :, block_start:block_stop, :] ]
+
+    logger.info("Assigned {} global synapse ids".format( id_mapping.max() ))
+
+def replace_rewritten_files(*paths):
+    """
+    Replace each of the given output files with its rewritten copy from rewrite_synapse_ids(),
+    if there is one.  Files that have already been replaced are skipped,
+    so this can be repeated if the process dies in the middle.  (None entries are ignored.)
+    """
+    for path in filter(None, paths):
+        if os.path.exists(rewritten_path(path)):
+            os.rename(rewritten_path(path), path)
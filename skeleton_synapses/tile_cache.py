@@ -0,0 +1,417 @@
+"""
+A shared cache of decoded tiles for lazyflow's TiledVolume, plus a pooled HTTP session.
+
+By default, TiledVolume downloads and decodes every tile that intersects each requested roi,
+even though neighboring skeleton nodes almost always need the same tiles.
+install_tile_cache() replaces TiledVolume.read() with an implementation that fetches
+tiles through a TileCache (and a single keep-alive requests.Session).
+"""
+import os
+import errno
+import shutil
+import hashlib
+import tempfile
+import threading
+import collections
+from functools import partial
+from Queue import Queue, Empty
+
+import numpy as np
+import vigra
+import requests
+from requests.adapters import HTTPAdapter
+
+from lazyflow.request import Request, RequestPool
+from lazyflow.utility.io_util import TiledVolume
+
+import logging
+logger = logging.getLogger(__name__)
+
+class TileNotFoundError(Exception):
+    """
+    Raised by TileSource.fetch_encoded_tile() if there is no tile at the given url
+    (HTTP 404, or a missing file).
+    """
+    pass
+
+class TileCache(object):
+    """
+    An LRU cache of decoded tiles, bounded by the total size of the tiles (in bytes).
+
+    If spill_dir is given, tiles that are evicted from memory are saved there (as .npy files),
+    and are loaded from there again (rather than downloaded) if they are needed later.
+    The spill directory is not bounded in size, so it should be a scratch directory.
+
+    The cache also keeps track of the tiles that are being fetched (see get_or_fetch()),
+    so that every TileSource that shares it (e.g. a TilePrefetcher's and TiledVolume's)
+    fetches each tile only once.
+    """
+    def __init__(self, max_size_mb, spill_dir=None):
+        self.max_size_bytes = int(max_size_mb * 2**20)
+        self.spill_dir = spill_dir
+        if spill_dir and not os.path.exists(spill_dir):
+            os.makedirs(spill_dir)
+
+        self._tiles = collections.OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+        # The tiles that are currently being fetched: { key : threading.Event }
+        self._pending_fetches = {}
+
+    def get(self, key):
+        """
+        Return the cached tile for the given key, or None if it isn't in the cache.
+        """
+        with self._lock:
+            try:
+                tile = self._tiles.pop(key)
+            except KeyError:
+                pass
+            else:
+                # Mark as most recently used
+                self._tiles[key] = tile
+                return tile
+
+        if self.spill_dir:
+            try:
+                tile = np.load(self._spill_path(key))
+            except IOError:
+                return None
+            self.put(key, tile, spill=False)
+            return tile
+        return None
+
+    def get_or_fetch(self, key, fetch):
+        """
+        Return the cached tile for the given key, or call fetch() to obtain it (and add it to the cache).
+        If the tile is already being fetched by another thread, wait for it rather than fetching it twice.
+        """
+        while True:
+            tile = self.get(key)
+            if tile is not None:
+                return tile
+
+            with self._lock:
+                pending_event = self._pending_fetches.get(key)
+                if pending_event is None:
+                    pending_event = self._pending_fetches[key] = threading.Event()
+                    break
+            # Now the tile is in the cache (unless the fetch failed, in which case we'll try it ourselves)
+            pending_event.wait()
+
+        try:
+            # Another thread may have finished fetching it just before we registered our fetch.
+            tile = self.get(key)
+            if tile is None:
+                tile = fetch()
+                self.put(key, tile)
+            return tile
+        finally:
+            with self._lock:
+                del self._pending_fetches[key]
+            pending_event.set()
+
+    def put(self, key, tile, spill=True):
+        """
+        Add the given tile to the cache, evicting the least recently used tiles if necessary.
+        """
+        evicted = []
+        with self._lock:
+            if key in self._tiles:
+                return
+            self._tiles[key] = tile
+            self._total_bytes += tile.nbytes
+            while self._total_bytes > self.max_size_bytes and len(self._tiles) > 1:
+                evicted_key, evicted_tile = self._tiles.popitem(last=False)
+                self._total_bytes -= evicted_tile.nbytes
+                evicted.append( (evicted_key, evicted_tile) )
+
+        if self.spill_dir and spill:
+            for evicted_key, evicted_tile in evicted:
+                self._spill(evicted_key, evicted_tile)
+
+    def __len__(self):
+        return len(self._tiles)
+
+    def _spill(self, key, tile):
+        path = self._spill_path(key)
+        if os.path.exists(path):
+            return
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self.spill_dir)
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, tile)
+        os.rename(tmp_path, path)
+
+    def _spill_path(self, key):
+        return os.path.join(self.spill_dir, hashlib.sha1(key).hexdigest() + '.npy')
+
+def create_session(max_connections=10, auth=None):
+    """
+    Create a requests.Session that keeps up to max_connections (keep-alive) connections
+    open to each host, so that concurrent tile requests don't have to reconnect.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=max_connections, pool_maxsize=max_connections)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.auth = auth
+    return session
+
+class TileSource(object):
+    """
+    Reads rois from the tiles of a volume described in the TiledVolume json format,
+    fetching each tile through the given TileCache.
+
+    Supports http(s):// and file:// tile urls (or plain paths), and the
+    description's 'view_origin_zyx' and 'extend_slices' settings.
+
+    As in TiledVolume, tiles that the server doesn't have (HTTP 404) are read as zeros.
+    """
+    def __init__(self, description, cache, session=None):
+        self.description = description
+        self.cache = cache
+        self.session = session
+        if session is None and description.tile_url_format.startswith('http'):
+            auth = None
+            if getattr(description, 'username', None):
+                auth = (description.username, description.password)
+            self.session = create_session(auth=auth)
+
+        # Missing slices are replaced by the data of another slice
+        self._slice_remapping = {}
+        for source_slice, destination_slices in (getattr(description, 'extend_slices', None) or []):
+            for destination_slice in destination_slices:
+                self._slice_remapping[destination_slice] = source_slice
+
+    def read(self, view_roi, result_out):
+        """
+        Same as TiledVolume.read():
+        view_roi: (start, stop), ordered according to description.output_axes,
+                  relative to the description's view_origin_zyx.
+        result_out: The array to write the data into.
+        """
+        output_axes = self.description.output_axes
+        if 'c' not in output_axes:
+            output_axes += 'c'
+            result_out = result_out[..., None]
+            view_roi = ( tuple(view_roi[0]) + (0,), tuple(view_roi[1]) + (1,) )
+
+        # Transpose the roi and the output array to zyxc
+        axis_order = [ output_axes.index(key) for key in 'zyxc' ]
+        roi = np.array(view_roi)[:, axis_order]
+        result_out = result_out.transpose(*axis_order)
+        channel_slicing = slice(roi[0,3], roi[1,3])
+
+        pool = RequestPool()
+        for tile_position, tile_slicing, destination_slicing in self._tile_intersections(roi[:, :3]):
+            pool.add( Request( partial( self._copy_tile, tile_position, tile_slicing + (channel_slicing,),
+                                        result_out[destination_slicing] ) ) )
+        pool.wait()
+
+    def tile_positions(self, view_roi):
+        """
+        Return the (z, y_index, x_index) positions of all tiles that
+        TileSource.read() would need for the given roi.
+        """
+        output_axes = self.description.output_axes.replace('c', '')
+        view_roi = np.array(view_roi)[:, :len(output_axes)]
+        roi_zyx = view_roi[:, [ output_axes.index(key) for key in 'zyx' ]]
+        return [ tile_position for tile_position, _, _ in self._tile_intersections(roi_zyx) ]
+
+    def _tile_intersections(self, view_roi_zyx):
+        """
+        For each tile that intersects the given roi (and lies within the volume bounds), yield:
+            - the tile position (z, y_index, x_index)
+            - the slicing of the intersection within the tile (yx)
+            - the slicing of the intersection within the roi (zyx)
+        """
+        roi = np.array(view_roi_zyx)
+        view_origin_zyx = getattr(self.description, 'view_origin_zyx', None)
+        if view_origin_zyx is not None:
+            roi += view_origin_zyx
+
+        tile_shape_yx = np.array(self.description.tile_shape_2d_yx)
+        bounds_zyx = np.array(self.description.bounds_zyx)
+        first_tile = roi[0, 1:3] // tile_shape_yx
+        last_tile = (roi[1, 1:3] - 1) // tile_shape_yx
+
+        for z in range(roi[0,0], roi[1,0]):
+            for y_index in range(first_tile[0], last_tile[0]+1):
+                for x_index in range(first_tile[1], last_tile[1]+1):
+                    tile_start = np.array((y_index, x_index)) * tile_shape_yx
+                    tile_stop = np.minimum(tile_start + tile_shape_yx, bounds_zyx[1:])
+                    intersection_start = np.maximum(tile_start, roi[0, 1:3])
+                    intersection_stop = np.minimum(tile_stop, roi[1, 1:3])
+                    if (tile_start < 0).any() or (intersection_start >= intersection_stop).any() or not (0 <= z < bounds_zyx[0]):
+                        # Outside of the volume
+                        continue
+
+                    tile_slicing = tuple( slice(*a) for a in zip(intersection_start - tile_start,
+                                                                  intersection_stop - tile_start) )
+                    destination_slicing = (z - roi[0,0],) + tuple( slice(*a) for a in zip(intersection_start - roi[0, 1:3],
+                                                                                           intersection_stop - roi[0, 1:3]) )
+                    yield (z, y_index, x_index), tile_slicing, destination_slicing
+
+    def tile(self, z, y_index, x_index):
+        """
+        Return the decoded tile at the given position, with axes yxc.
+        If the tile is already being fetched (by any TileSource with the same cache),
+        wait for it rather than fetching it twice.
+        """
+        url = self.tile_url(z, y_index, x_index)
+        return self.cache.get_or_fetch( url, partial(self._fetch_tile, url) )
+
+    def tile_url(self, z, y_index, x_index):
+        z = self._slice_remapping.get(z, z)
+        tile_shape_yx = self.description.tile_shape_2d_yx
+        rest_args = { 'z_start' : z,
+                      'z_stop' : z+1,
+                      'y_start' : y_index * tile_shape_yx[0],
+                      'y_stop' : (y_index+1) * tile_shape_yx[0],
+                      'x_start' : x_index * tile_shape_yx[1],
+                      'x_stop' : (x_index+1) * tile_shape_yx[1],
+                      'z_index' : z,
+                      'y_index' : y_index,
+                      'x_index' : x_index }
+        return self.description.tile_url_format.format(**rest_args)
+
+    def _copy_tile(self, tile_position, tile_slicing, data_out):
+        data_out[:] = self.tile(*tile_position)[tile_slicing]
+
+    def fetch_encoded_tile(self, url):
+        """
+        Return the contents of the tile file at the given url, without decoding it.
+        Raises TileNotFoundError if there is no such tile.
+        """
+        if url.startswith('http'):
+            response = self.session.get(url)
+            if response.status_code == requests.codes.not_found:
+                raise TileNotFoundError(url)
+            response.raise_for_status()
+            return response.content
+
+        if url.startswith('file://'):
+            url = url[len('file://'):]
+        try:
+            with open(url, 'rb') as f:
+                return f.read()
+        except IOError as ex:
+            if ex.errno == errno.ENOENT:
+                raise TileNotFoundError(url)
+            raise
+
+    def missing_tile(self):
+        """
+        Return the (all-zero) tile that stands in for a tile the server doesn't have.
+        """
+        tile_shape_yx = tuple(self.description.tile_shape_2d_yx)
+        return np.zeros( tile_shape_yx + (1,), dtype=getattr(self.description, 'dtype', np.uint8) )
+
+    def _fetch_tile(self, url):
+        if url.startswith('http'):
+            tmpdir = tempfile.mkdtemp()
+            try:
+                path = os.path.join(tmpdir, 'tile.' + self.description.format)
+                with open(path, 'wb') as f:
+                    f.write(self.fetch_encoded_tile(url))
+                return _read_tile_image(path)
+            except TileNotFoundError:
+                logger.warn("NOTFOUND: {}".format( url ))
+                return self.missing_tile()
+            finally:
+                shutil.rmtree(tmpdir)
+
+        if url.startswith('file://'):
+            url = url[len('file://'):]
+        return _read_tile_image(url)
+
+def _read_tile_image(path):
+    """
+    Read the image at the given path, and return it as a plain array with axes yxc.
+    """
+    image = vigra.impex.readImage(path, dtype='NATIVE')
+    return np.asarray( image.withAxes('y', 'x', 'c') )
+
+def install_tile_cache(cache, session=None):
+    """
+    Replace TiledVolume.read() so that all TiledVolumes read their tiles through the given TileCache.
+    If session is given, it is used for all http(s) tile requests.
+    """
+    def read(tiled_volume, view_roi, result_out):
+        try:
+            tile_source = tiled_volume._skeleton_synapses_tile_source
+        except AttributeError:
+            tile_source = TileSource(tiled_volume.description, cache, session)
+            tiled_volume._skeleton_synapses_tile_source = tile_source
+        tile_source.read(view_roi, result_out)
+
+    TiledVolume.read = read
+
+class TilePrefetcher(object):
+    """
+    Fetches the tiles for a planned sequence of rois (e.g. around each skeleton node, in processing order)
+    in background threads, so they are already in the cache when they are needed.
+
+    The consumer calls advance() as it proceeds through the rois,
+    and the prefetcher stays (up to) lookahead rois ahead of it.
+    """
+    def __init__(self, tile_source, view_rois, lookahead=20, num_threads=4):
+        """
+        tile_source: The TileSource to fetch the tiles with (and whose cache they are stored in).
+                     To avoid fetching tiles twice, its cache should be the one given to install_tile_cache().
+        view_rois: The rois that will be read, in order (as given to TileSource.read()).
+        """
+        self.tile_source = tile_source
+        self.view_rois = view_rois
+        self.lookahead = lookahead
+
+        self._next_roi_index = 0
+        self._queued_tiles = set()
+        self._lock = threading.Lock()
+        self._queue = Queue()
+        self._threads = []
+        for _ in range(num_threads):
+            thread = threading.Thread(target=self._run, name="TilePrefetcher")
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        self.advance(0)
+
+    def advance(self, roi_index):
+        """
+        Notify the prefetcher that the consumer has reached the given roi.
+        """
+        with self._lock:
+            stop = min(roi_index + self.lookahead, len(self.view_rois))
+            while self._next_roi_index < stop:
+                for tile_position in self.tile_source.tile_positions(self.view_rois[self._next_roi_index]):
+                    if tile_position not in self._queued_tiles:
+                        self._queued_tiles.add(tile_position)
+                        self._queue.put(tile_position)
+                self._next_roi_index += 1
+
+    def close(self):
+        """
+        Discard the remaining queued tiles and stop the prefetch threads.
+        """
+        try:
+            while True:
+                self._queue.get_nowait()
+        except Empty:
+            pass
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def _run(self):
+        while True:
+            tile_position = self._queue.get()
+            if tile_position is None:
+                return
+            try:
+                self.tile_source.tile(*tile_position)
+            except Exception:
+                # Not fatal: the tile will be fetched again when it is actually needed.
+                logger.warn("Failed to prefetch tile {}".format( tile_position ), exc_info=True)
@@ -1,3 +1,5 @@
+import numpy as np
+
 # A 'tree' is a networkx.DiGraph with a single root node (a node without parents)
 
 # Copied from CATMAID/django/applications/catmaid/control/tree_util.py
@@ -49,3 +51,118 @@ def find_root(tree):
     for node in tree:
         if not next(tree.predecessors_iter(node), None):
             return node
+
+class ArrayTree(object):
+    """
+    A compact (numpy-based) alternative to the networkx 'tree' used by the functions above,
+    for skeletons with many nodes.
+
+    Nodes are referred to by their index (position in the node_ids array):
+    - node_ids: The node ids
+    - parent_indexes: The index of each node's parent, or -1 for the root(s)
+    - child_offsets, child_indexes: The children of each node (in CSR form):
+      The children of node i are child_indexes[child_offsets[i]:child_offsets[i+1]]
+    """
+    def __init__(self, node_ids, parent_ids):
+        """
+        node_ids, parent_ids: The id of each node and of its parent (-1 for the root).
+                              Parents that aren't in node_ids are treated as -1.
+        """
+        self.node_ids = np.asarray(node_ids, dtype=np.int64)
+        parent_ids = np.asarray(parent_ids, dtype=np.int64)
+
+        sorted_positions = np.argsort(self.node_ids, kind='mergesort')
+        sorted_ids = self.node_ids[sorted_positions]
+        positions = np.minimum( np.searchsorted(sorted_ids, parent_ids), max(len(sorted_ids)-1, 0) )
+        found = (len(sorted_ids) > 0) & (sorted_ids[positions] == parent_ids)
+        self.parent_indexes = np.where(found, sorted_positions[positions], -1).astype(np.intp)
+
+        has_parent = (self.parent_indexes != -1)
+        self.child_indexes = np.nonzero(has_parent)[0]
+        self.child_indexes = self.child_indexes[ np.argsort(self.parent_indexes[self.child_indexes], kind='mergesort') ]
+        child_counts = np.bincount(self.parent_indexes[has_parent], minlength=len(self.node_ids))
+        self.child_offsets = np.concatenate( ([0], np.cumsum(child_counts)) )
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    def children(self, index):
+        return self.child_indexes[self.child_offsets[index]:self.child_offsets[index+1]]
+
+    def depths(self):
+        """
+        Return the number of edges from each node to its root.
+        (Equivalent to edge_count_to_root(), minus a constant.)
+        """
+        # Pointer jumping: After k rounds, ancestors[i] is the 2**k-th ancestor of node i (or -1),
+        # and depths[i] counts the edges traversed so far.
+        ancestors = self.parent_indexes.copy()
+        depths = (ancestors != -1).astype(np.int64)
+        active = np.nonzero(ancestors != -1)[0]
+        while len(active):
+            next_ancestors = ancestors[ancestors[active]]
+            depths[active] += depths[ancestors[active]]
+            ancestors[active] = next_ancestors
+            active = active[next_ancestors != -1]
+        return depths
+
+    def partition(self, node_order=None):
+        """
+        Same as partition() above, but returns arrays of node indexes rather than lists of node ids,
+        and doesn't include the (virtual) parent of the root in the first sequence.
+
+        partition() visits the end nodes in order of decreasing distance to the root,
+        and breaks ties according to the networkx node order, which is given here as node_order:
+        An array of node indexes (by default, the order of the node_ids array).
+
+        Each node belongs to the sequence of the first end node (in that order) below it,
+        so the sequences are found by propagating the end nodes' ranks up the tree.
+        """
+        num_nodes = len(self.node_ids)
+        if num_nodes == 0:
+            return []
+        if node_order is None:
+            node_order = np.arange(num_nodes)
+        depths = self.depths()
+
+        child_counts = np.diff(self.child_offsets)
+        end_nodes = np.asarray(node_order)[ child_counts[node_order] == 0 ]
+        # Stable sort, so ties stay in node_order
+        end_nodes = end_nodes[ np.argsort(-depths[end_nodes], kind='mergesort') ]
+
+        # The rank of the first end node below each node
+        owners = np.full(num_nodes, num_nodes, dtype=np.intp)
+        owners[end_nodes] = np.arange(len(end_nodes))
+        nodes_by_depth = np.argsort(-depths, kind='mergesort')
+        level_starts = np.nonzero( np.diff(depths[nodes_by_depth]) )[0] + 1
+        for level in np.split(nodes_by_depth, level_starts):
+            level = level[self.parent_indexes[level] != -1]
+            np.minimum.at(owners, self.parent_indexes[level], owners[level])
+
+        # Each sequence runs from its end node up to (and including) the first node owned by another sequence.
+        ordered = np.lexsort( (-depths, owners) )
+        sequence_starts = np.nonzero( np.diff(owners[ordered]) )[0] + 1
+        sequences = []
+        for sequence in np.split(ordered, sequence_starts):
+            junction = self.parent_indexes[sequence[-1]]
+            if junction != -1:
+                sequence = np.append(sequence, junction)
+            sequences.append(sequence)
+        return sequences
+
+def networkx_node_order(node_ids, parent_ids):
+    """
+    Return the node indexes in the order in which the (python 2) networkx.DiGraph built by
+    adding the edges (parent_id, node_id) (in the given order) would list its nodes.
+
+    That order depends on the dict ordering of the node ids, which is reproduced here
+    by inserting the ids into a dict in the same sequence.
+    """
+    node_ids = np.asarray(node_ids).tolist()
+    parent_ids = np.asarray(parent_ids).tolist()
+    indexes = dict( (node_id, index) for index, node_id in enumerate(node_ids) )
+    networkx_nodes = {}
+    for parent_id, node_id in zip(parent_ids, node_ids):
+        networkx_nodes[parent_id] = None
+        networkx_nodes[node_id] = None
+    return np.array([ indexes[node_id] for node_id in networkx_nodes if node_id in indexes ], dtype=np.intp)
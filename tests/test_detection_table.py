@@ -0,0 +1,162 @@
+import os
+import csv
+import shutil
+import tempfile
+
+import numpy
+
+import skeleton_synapses
+from skeleton_synapses.skeleton_utils import CSV_FORMAT
+from skeleton_synapses.detection_table import read_detections, write_detections, table_from_rows, iter_rows, \
+                                              select_columns, append_columns, iter_detection_chunks, DetectionWriter, \
+                                              MISSING_BOOL
+from skeleton_synapses.filter_by_distance import filter_by_distance
+from skeleton_synapses.remove_csv_columns import remove_csv_columns
+
+TEST_SKELETONS_DIR = os.path.join( os.path.dirname(skeleton_synapses.__file__), '../test_skeletons' )
+
+class TestDetectionTable(object):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.csv_path = os.path.join(TEST_SKELETONS_DIR, 'detections_with_distances_18689.csv')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_read_csv(self):
+        detections = read_detections(self.csv_path)
+        with open(self.csv_path) as f:
+            rows = list(csv.DictReader(f, **CSV_FORMAT))
+
+        assert len(detections) == len(rows)
+        assert detections.dtype['synapse_id'] == numpy.int64
+        assert detections.dtype['nearest_connector_distance_nm'] == numpy.float64
+        for row, table_row in zip(rows, iter_rows(detections)):
+            assert table_row['node_id'] == int(row['node_id'])
+            assert table_row['distance'] == float(row['distance'])
+
+    def test_round_trip(self):
+        detections = read_detections(self.csv_path)
+        for extension in ('.csv', '.h5', '.npy'):
+            path = os.path.join(self.tmpdir, 'detections' + extension)
+            write_detections(path, detections)
+            reloaded = read_detections(path)
+            assert reloaded.dtype == detections.dtype, extension
+            assert (reloaded == detections).all(), extension
+
+    def test_chunks(self):
+        detections = read_detections(self.csv_path)
+        for extension in ('.csv', '.h5', '.npy'):
+            path = os.path.join(self.tmpdir, 'detections' + extension)
+            write_detections(path, detections)
+
+            chunks = list( iter_detection_chunks(path, 1000) )
+            assert [ len(chunk) for chunk in chunks[:-1] ] == [1000] * (len(chunks) - 1), extension
+            assert 0 < len(chunks[-1]) <= 1000, extension
+
+            # Write the chunks back out, one at a time
+            chunked_path = os.path.join(self.tmpdir, 'chunked' + extension)
+            writer = DetectionWriter(chunked_path)
+            for chunk in chunks:
+                writer.append(chunk)
+            writer.close()
+            assert len(writer) == len(detections)
+            reloaded = read_detections(chunked_path)
+            assert reloaded.dtype == detections.dtype, extension
+            assert (reloaded == detections).all(), extension
+
+        # An empty table is read as a single empty chunk.
+        write_detections(os.path.join(self.tmpdir, 'empty.csv'), detections[:0])
+        chunks = list( iter_detection_chunks(os.path.join(self.tmpdir, 'empty.csv'), 1000) )
+        assert len(chunks) == 1 and len(chunks[0]) == 0
+        assert chunks[0].dtype == detections.dtype
+
+    def test_bool_and_string_columns(self):
+        rows = [ { 'synapse_id' : '1', 'overlaps_node_segment' : 'true', 'comment' : 'a' },
+                 { 'synapse_id' : '2', 'overlaps_node_segment' : 'false', 'comment' : 'b c' } ]
+        detections = table_from_rows(rows, ['synapse_id', 'overlaps_node_segment', 'comment'])
+        assert detections['overlaps_node_segment'].tolist() == [True, False]
+
+        path = os.path.join(self.tmpdir, 'detections.csv')
+        write_detections(path, detections)
+        with open(path) as f:
+            assert [ row['overlaps_node_segment'] for row in csv.DictReader(f, **CSV_FORMAT) ] == ['true', 'false']
+        assert (read_detections(path) == detections).all()
+
+    def test_missing_bool_values(self):
+        # -1 marks a missing boolean (e.g. a connected node without a detection).
+        rows = [ { 'synapse_id' : 1, 'overlaps_node_segment' : True },
+                 { 'synapse_id' : -1, 'overlaps_node_segment' : -1 },
+                 { 'synapse_id' : 2, 'overlaps_node_segment' : False } ]
+        detections = table_from_rows(rows, ['synapse_id', 'overlaps_node_segment'])
+        assert detections['overlaps_node_segment'].dtype == numpy.int8
+        assert detections['overlaps_node_segment'].tolist() == [1, MISSING_BOOL, 0]
+
+        path = os.path.join(self.tmpdir, 'detections.csv')
+        write_detections(path, detections)
+        with open(path) as f:
+            assert [ row['overlaps_node_segment'] for row in csv.DictReader(f, **CSV_FORMAT) ] == ['true', '-1', 'false']
+        for extension in ('.csv', '.h5', '.npy'):
+            path = os.path.join(self.tmpdir, 'detections' + extension)
+            write_detections(path, detections)
+            reloaded = read_detections(path)
+            assert reloaded.dtype == detections.dtype, extension
+            assert (reloaded == detections).all(), extension
+
+    def test_invalid_values(self):
+        # Well-known columns must have values of their own type...
+        rows = [ { 'x_px' : '123', 'comment' : '1' },
+                 { 'x_px' : '123.5', 'comment' : '1.5' } ]
+        try:
+            table_from_rows(rows, ['x_px', 'comment'])
+        except ValueError as ex:
+            assert 'x_px' in str(ex)
+        else:
+            assert False, "Expected a ValueError for the non-integer x_px value."
+
+        # ...but other columns get whatever type fits their values.
+        detections = table_from_rows(rows, ['comment'])
+        assert detections['comment'].dtype == numpy.float64
+
+    def test_empty_table(self):
+        detections = table_from_rows([], ['synapse_id', 'detection_uncertainty'])
+        for extension in ('.csv', '.h5', '.npy'):
+            path = os.path.join(self.tmpdir, 'empty' + extension)
+            write_detections(path, detections)
+            reloaded = read_detections(path)
+            assert len(reloaded) == 0
+            assert reloaded.dtype.names == ('synapse_id', 'detection_uncertainty')
+
+    def test_columns(self):
+        detections = read_detections(self.csv_path)
+        selected = select_columns(detections, ['node_id', 'synapse_id'])
+        assert selected.dtype.names == ('node_id', 'synapse_id')
+        assert (selected['synapse_id'] == detections['synapse_id']).all()
+
+        extended = append_columns(selected, ['synapse_id', 'extra'], [selected['synapse_id'] + 1, numpy.zeros(len(selected))])
+        assert extended.dtype.names == ('node_id', 'synapse_id', 'extra')
+        assert (extended['synapse_id'] == detections['synapse_id'] + 1).all()
+
+    def test_tools_accept_columnar_files(self):
+        h5_path = os.path.join(self.tmpdir, 'detections.h5')
+        write_detections(h5_path, read_detections(self.csv_path))
+
+        # The same results, whether the input and output are csv or h5
+        filter_by_distance(self.csv_path, os.path.join(self.tmpdir, 'filtered.csv'), 0.01, 'distance')
+        filter_by_distance(h5_path, os.path.join(self.tmpdir, 'filtered.npy'), 0.01, 'distance')
+        filtered = read_detections(os.path.join(self.tmpdir, 'filtered.csv'))
+        assert len(filtered) > 0
+        assert (filtered['distance'] >= 0.01).all()
+        assert (read_detections(os.path.join(self.tmpdir, 'filtered.npy')) == filtered).all()
+
+        remove_csv_columns(h5_path, os.path.join(self.tmpdir, 'removed.h5'), ['distance', 'node_count'])
+        removed = read_detections(os.path.join(self.tmpdir, 'removed.h5'))
+        assert 'distance' not in removed.dtype.names
+        assert len(removed.dtype.names) == len(filtered.dtype.names) - 2
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    sys.exit(nose.run(defaultTest=__file__))
@@ -1,8 +1,11 @@
+import time
+import threading
 import numpy
 from lazyflow.roi import roiToSlice
-from skeleton_synapses.locate_synapses import normalize_synapse_ids
+from skeleton_synapses.locate_synapses import SynapseSliceRelabeler, MulticutLanePool
 
 def test_normalize_synapse_ids():
+    relabeler = SynapseSliceRelabeler()
     slice1 = numpy.zeros((20, 20, 1), dtype=numpy.uint8)
     slice2 = numpy.zeros((20, 20, 1), dtype=numpy.uint8)
     
@@ -25,12 +28,14 @@ def test_normalize_synapse_ids():
     consecutivized_slice1 = numpy.array(slice1)
     consecutivized_slice1[7:9, 2:3] = 2 # Will be consecutivized
     
-    result1, maxLabel = normalize_synapse_ids(extracted_slice1, roi1, None, None, 0)
+    result1 = relabeler.normalize_synapse_ids(extracted_slice1, roi1)
+    maxLabel = relabeler.max_label
     
     assert numpy.all(result1 == consecutivized_slice1[roiToSlice(*roi1_2d)]), result1[...,0]
     assert maxLabel == 2
     
-    result2, maxLabel2 = normalize_synapse_ids(extracted_slice2, roi2, result1, roi1, maxLabel)
+    result2 = relabeler.normalize_synapse_ids(extracted_slice2, roi2)
+    maxLabel2 = relabeler.max_label
     
     # Copy into the original (big) array for straightforward comparison
     slice2[roiToSlice(*roi2_2d)] = result2
@@ -48,6 +53,7 @@ def test_normalize_synapse_ids_no_overlap():
     should simply be relabeled starting with the previous slice max.    
     (No objects are assigned an id from the previous slice.)
     """
+    relabeler = SynapseSliceRelabeler()
     slice1 = numpy.zeros((20, 20, 1), dtype=numpy.uint8)
     slice2 = numpy.zeros((20, 20, 1), dtype=numpy.uint8)
     
@@ -70,11 +76,13 @@ def test_normalize_synapse_ids_no_overlap():
     consecutivized_slice1 = numpy.array(slice1)
     consecutivized_slice1[7:9, 2:3] = 2 # Will be consecutivized
     
-    result1, maxLabel = normalize_synapse_ids(extracted_slice1, roi1, None, None, 0)
+    result1 = relabeler.normalize_synapse_ids(extracted_slice1, roi1)
+    maxLabel = relabeler.max_label
     assert numpy.all(result1 == consecutivized_slice1[roiToSlice(*roi1_2d)]), result1[...,0]
     assert maxLabel == 2
     
-    result2, maxLabel2 = normalize_synapse_ids(extracted_slice2, roi2, result1, roi1, maxLabel)
+    result2 = relabeler.normalize_synapse_ids(extracted_slice2, roi2)
+    maxLabel2 = relabeler.max_label
     
     # Copy into the original (big) array for straightforward comparison
     slice2[roiToSlice(*roi2_2d)] = result2
@@ -90,6 +98,111 @@ def test_normalize_synapse_ids_no_overlap():
 
     assert maxLabel2 == 5, "Got wrong max: {} instead of 5".format( maxLabel2 )
 
+def test_normalize_synapse_ids_max_previous_id_wins():
+    """
+    If an object overlaps several objects from the previous slice,
+    it inherits the highest of their ids.
+    """
+    relabeler = SynapseSliceRelabeler()
+    slice1 = numpy.zeros((10, 10, 1), dtype=numpy.uint32)
+    slice1[0:2, 0:5] = 1
+    slice1[5:7, 0:5] = 2
+
+    slice2 = numpy.zeros((10, 10, 1), dtype=numpy.uint32)
+    slice2[1:6, 0:5] = 1
+
+    relabeler.normalize_synapse_ids(slice1, [(0,0,0), (10,10,1)])
+    result2 = relabeler.normalize_synapse_ids(slice2, [(0,0,1), (10,10,2)])
+    assert numpy.all(result2[1:6, 0:5] == 2)
+    assert relabeler.max_label == 2
+
+def test_normalize_synapse_ids_min_overlap_fraction():
+    """
+    With min_overlap_fraction, objects that barely touch an object
+    from the previous slice get a new id.
+    """
+    relabeler = SynapseSliceRelabeler(min_overlap_fraction=0.5)
+    slice1 = numpy.zeros((10, 10, 1), dtype=numpy.uint32)
+    slice1[0:4, 0:4] = 1
+    slice1[6:10, 6:10] = 2
+
+    slice2 = numpy.zeros((10, 10, 1), dtype=numpy.uint32)
+    slice2[1:5, 1:5] = 1  # 9/16 overlap
+    slice2[5:7, 5:9] = 2  # 3/8 overlap
+
+    relabeler.normalize_synapse_ids(slice1, [(0,0,0), (10,10,1)])
+    result2 = relabeler.normalize_synapse_ids(slice2, [(0,0,1), (10,10,2)])
+    assert numpy.all(result2[1:5, 1:5] == 1)
+    assert numpy.all(result2[5:7, 5:9] == 3)
+    assert relabeler.max_label == 3
+
+
+def test_relabeler_restore_state():
+    """
+    A relabeler restored from another's state continues where it left off,
+    but keeps its own settings.
+    """
+    slice1 = numpy.zeros((10, 10, 1), dtype=numpy.uint32)
+    slice1[0:4, 0:4] = 1
+    slice2 = numpy.zeros((10, 10, 1), dtype=numpy.uint32)
+    slice2[3:7, 3:7] = 1  # 1/16 overlap
+
+    relabeler = SynapseSliceRelabeler()
+    relabeler.normalize_synapse_ids(slice1, [(0,0,0), (10,10,1)])
+
+    resumed = SynapseSliceRelabeler(min_overlap_fraction=0.5)
+    resumed.restore_state(relabeler.state())
+    assert resumed.min_overlap_fraction == 0.5
+
+    result2 = resumed.normalize_synapse_ids(slice2, [(0,0,1), (10,10,2)])
+    assert numpy.all(result2[3:7, 3:7] == 2)
+    assert resumed.max_label == 2
+
+class _RecordingLane(object):
+    """
+    Stands in for a MulticutLane.  Records how many segment() calls are in progress at once,
+    in this lane and across all lanes.
+    """
+    lock = threading.Lock()
+    active = 0
+    max_active = 0
+
+    def __init__(self):
+        self.in_use = False
+
+    def segment(self, raw_xy, predictions_xyc):
+        with _RecordingLane.lock:
+            assert not self.in_use, "Lane used by two requests at once"
+            self.in_use = True
+            _RecordingLane.active += 1
+            _RecordingLane.max_active = max(_RecordingLane.max_active, _RecordingLane.active)
+        time.sleep(0.05)
+        with _RecordingLane.lock:
+            _RecordingLane.active -= 1
+            self.in_use = False
+        return raw_xy
+
+def _max_concurrent_segments(num_lanes, num_threads):
+    _RecordingLane.max_active = 0
+    pool = MulticutLanePool( [ _RecordingLane() for _ in range(num_lanes) ] )
+    raw_xy = numpy.zeros((10, 10), dtype=numpy.uint8)
+    def segment_nodes():
+        for _ in range(5):
+            assert pool.segment(raw_xy, None) is raw_xy
+    threads = [ threading.Thread(target=segment_nodes) for _ in range(num_threads) ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return _RecordingLane.max_active
+
+def test_multicut_lane_pool():
+    # With a lane per worker, all workers segment concurrently.
+    assert _max_concurrent_segments(num_lanes=3, num_threads=3) == 3
+
+    # With fewer lanes, the workers share them (but never use a lane twice at once).
+    assert _max_concurrent_segments(num_lanes=2, num_threads=4) == 2
+    assert _max_concurrent_segments(num_lanes=1, num_threads=3) == 1
 
 if __name__ == "__main__":
     import sys
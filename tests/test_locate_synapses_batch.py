@@ -0,0 +1,31 @@
+import os
+import shutil
+import tempfile
+
+from skeleton_synapses.locate_synapses_batch import find_skeleton_files
+
+class TestFindSkeletonFiles(object):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        for relpath in ['b/2/tree_geometry.json', 'b/1/tree_geometry.json', 'b/1/notes.txt', 'a.json']:
+            path = os.path.join(self.tmpdir, relpath)
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_files_and_directories(self):
+        a_path = os.path.join(self.tmpdir, 'a.json')
+        found = find_skeleton_files([ a_path, os.path.join(self.tmpdir, 'b') ])
+        assert found == [ a_path,
+                          os.path.join(self.tmpdir, 'b/1/tree_geometry.json'),
+                          os.path.join(self.tmpdir, 'b/2/tree_geometry.json') ]
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    sys.exit(nose.run(defaultTest=__file__))
@@ -0,0 +1,78 @@
+import os
+import shutil
+import tempfile
+
+import numpy
+
+from skeleton_synapses.detection_table import table_from_rows, read_detections, write_detections
+from skeleton_synapses.merge_synapse_ids import merge_detections, merge_synapse_ids
+
+COLUMNS = [ "synapse_id", "x_px", "y_px", "z_px", "size_px", "distance", "detection_uncertainty", "node_id" ]
+
+def make_detections(rows, columns=COLUMNS):
+    return table_from_rows( [ dict(zip(columns, row)) for row in rows ], columns )
+
+def test_merge_detections():
+    detections = make_detections([ # id,  x,  y,  z, size, dist, uncertainty, node
+                                   ( 5, 10, 10, 1,   10, 0.3,  0.5,         100 ),
+                                   ( 2, 50, 50, 2,    7, 0.9,  0.25,        101 ),
+                                   ( 5, 20, 30, 2,   30, 0.1,  0.1,         102 ),
+                                   ( 5, 20, 30, 3,   60, 0.1,  0.2,         103 ) ])
+    merged = merge_detections(detections)
+
+    # Ordered by first appearance
+    assert merged["synapse_id"].tolist() == [5, 2]
+    assert merged["node_count"].tolist() == [3, 1]
+    assert merged["size_px"].tolist() == [100, 7]
+    assert merged["distance"].tolist() == [0.1, 0.9]
+
+    # Size-weighted averages
+    assert merged[0]["x_px"] == 19 and merged[0]["y_px"] == 28 and merged[0]["z_px"] == 3
+    assert numpy.isclose( merged[0]["detection_uncertainty"], (0.5*10 + 0.1*30 + 0.2*60) / 100.0 )
+
+    # Other fields come from the first row with the smallest distance
+    assert merged[0]["node_id"] == 102
+
+    # Single rows are copied unchanged
+    assert merged[1].tolist() == detections[1].tolist() + (1,)
+
+def test_optional_columns():
+    columns = [ "synapse_id", "x_px", "y_px", "z_px", "size_px", "detection_uncertainty", "node_id",
+                "distance_hessian", "nearest_connector_distance_nm" ]
+    detections = make_detections([ ( 1, 0, 0, 0, 1, 0.5, 200, 0.7, 30.0 ),
+                                   ( 1, 2, 2, 0, 1, 0.5, 201, 0.2, 40.0 ),
+                                   ( 1, 4, 4, 0, 2, 0.5, 202, 0.4, 10.0 ) ], columns)
+    merged = merge_detections(detections)
+    assert len(merged) == 1
+    assert merged[0]["node_id"] == 201
+    assert merged[0]["distance_hessian"] == 0.2
+    assert merged[0]["nearest_connector_distance_nm"] == 10.0
+
+    # Without any distance columns, the first row is used.
+    merged = merge_detections( make_detections([ row[:7] for row in detections.tolist() ], columns[:7]) )
+    assert merged[0]["node_id"] == 200
+    assert merged[0]["x_px"] == 3
+
+def test_merge_synapse_ids():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        detections = make_detections([ ( 1, 10, 10, 1, 10, 0.3, 0.5, 100 ),
+                                       ( 1, 20, 30, 2, 30, 0.1, 0.1, 102 ) ])
+        write_detections(os.path.join(tmpdir, 'detections.csv'), detections)
+        merge_synapse_ids(os.path.join(tmpdir, 'detections.csv'), os.path.join(tmpdir, 'merged.h5'))
+        merged = read_detections(os.path.join(tmpdir, 'merged.h5'))
+        assert (merged == merge_detections(detections)).all()
+
+        # Empty input
+        write_detections(os.path.join(tmpdir, 'empty.csv'), detections[:0])
+        merge_synapse_ids(os.path.join(tmpdir, 'empty.csv'), os.path.join(tmpdir, 'empty-merged.csv'))
+        assert read_detections(os.path.join(tmpdir, 'empty-merged.csv')).dtype.names == tuple(COLUMNS) + ("node_count",)
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    sys.exit(nose.run(defaultTest=__file__))
@@ -0,0 +1,114 @@
+import os
+import shutil
+import tempfile
+
+import numpy
+
+from skeleton_synapses.skeleton_utils import ConnectorInfo
+from skeleton_synapses.detection_table import table_from_rows, read_detections, write_detections
+from skeleton_synapses.nearest_connectors import ConnectorStore, annotate_nearest_connectors, output_nearest_connectors, \
+                                                 NO_CONNECTOR_DISTANCE
+
+def random_connectors(num_connectors, seed=0):
+    coords = numpy.random.RandomState(seed).uniform(0, 5000, size=(num_connectors, 3))
+    return [ ConnectorInfo(1000+i, x, y, z, [], []) for i, (x, y, z) in enumerate(coords) ]
+
+def brute_force_distances(connectors, coord):
+    connector_coords = numpy.array([ (c.x_nm, c.y_nm, c.z_nm) for c in connectors ])
+    return numpy.linalg.norm(connector_coords - coord, axis=1)
+
+def test_nearest_connectors():
+    connectors = random_connectors(200)
+    store = ConnectorStore(connectors)
+    coords = numpy.random.RandomState(1).uniform(0, 5000, size=(50, 3))
+
+    indexes, distances = store.nearest_connectors(coords)
+    for coord, index, distance in zip(coords, indexes, distances):
+        all_distances = brute_force_distances(connectors, coord)
+        assert index == all_distances.argmin()
+        assert numpy.isclose(distance, all_distances.min())
+
+    # With a limited radius, distant connectors are not found.
+    indexes, distances = store.nearest_connectors(coords, max_distance=300)
+    for coord, index, distance in zip(coords, indexes, distances):
+        if brute_force_distances(connectors, coord).min() > 300:
+            assert index == -1 and distance == NO_CONNECTOR_DISTANCE
+        else:
+            assert index != -1 and distance <= 300
+
+    # k nearest, sorted by distance
+    indexes, distances = store.nearest_connectors(coords, k=3)
+    assert indexes.shape == distances.shape == (50, 3)
+    for coord, k_indexes in zip(coords, indexes):
+        assert (k_indexes == numpy.argsort(brute_force_distances(connectors, coord))[:3]).all()
+
+    # Single lookups return the ConnectorInfo itself.
+    nearest_connector, distance = store.find_nearest_connector(numpy.array((connectors[5].x_nm, connectors[5].y_nm, connectors[5].z_nm)))
+    assert nearest_connector == connectors[5] and distance == 0.0
+
+def test_connectors_within():
+    connectors = random_connectors(200)
+    store = ConnectorStore(connectors)
+    coords = numpy.random.RandomState(2).uniform(0, 5000, size=(20, 3))
+    for coord, indexes in zip(coords, store.connectors_within(coords, 800)):
+        all_distances = brute_force_distances(connectors, coord)
+        assert sorted(indexes) == list(numpy.flatnonzero(all_distances <= 800))
+        assert (numpy.diff(all_distances[indexes]) >= 0).all()
+
+def test_empty_store():
+    store = ConnectorStore([])
+    indexes, distances = store.nearest_connectors(numpy.zeros((4, 3)))
+    assert (indexes == -1).all() and (distances == NO_CONNECTOR_DISTANCE).all()
+    assert [ len(found) for found in store.connectors_within(numpy.zeros((2, 3)), 100) ] == [0, 0]
+
+def test_annotate_nearest_connectors():
+    # Anisotropic resolution: z pixels are 10x larger than x/y pixels.
+    resolution_xyz = (4.0, 4.0, 40.0)
+    connectors = [ ConnectorInfo(7, 400.0, 400.0, 400.0, [], []),
+                   ConnectorInfo(8, 400.0, 400.0, 800.0, [], []) ]
+    rows = [ { 'synapse_id' : 1, 'x_px' : 100, 'y_px' : 100, 'z_px' : 10 },  # Exactly at connector 7
+             { 'synapse_id' : 2, 'x_px' : 100, 'y_px' : 100, 'z_px' : 19 },  # 40 nm from connector 8
+             { 'synapse_id' : 3, 'x_px' : 500, 'y_px' : 500, 'z_px' : 10 } ] # Far from both
+    detections = table_from_rows(rows, ['synapse_id', 'x_px', 'y_px', 'z_px'])
+
+    # By default, only connectors within SEARCH_RADIUS are found.
+    annotated = annotate_nearest_connectors(detections, ConnectorStore(connectors), resolution_xyz)
+    assert annotated['nearest_connector_id'].tolist() == [7, 8, -1]
+    assert annotated['nearest_connector_distance_nm'].tolist() == [0.0, 40.0, NO_CONNECTOR_DISTANCE]
+    assert annotated['nearest_connector_z_nm'].tolist() == [400.0, 800.0, -1]
+    assert (annotated['synapse_id'] == detections['synapse_id']).all()
+
+    # Without a limit, the last detection gets a connector, too.
+    annotated = annotate_nearest_connectors(detections, ConnectorStore(connectors), resolution_xyz, max_distance=numpy.inf)
+    assert annotated['nearest_connector_id'].tolist() == [7, 8, 7]
+
+def test_output_nearest_connectors():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        resolution_xyz = (4.0, 4.0, 45.0)
+        connectors = random_connectors(100)
+        coords = numpy.random.RandomState(3).randint(0, 1000, size=(2500, 3))
+        rows = [ { 'synapse_id' : i, 'x_px' : x, 'y_px' : y, 'z_px' : z } for i, (x, y, z) in enumerate(coords) ]
+        detections = table_from_rows(rows, ['synapse_id', 'x_px', 'y_px', 'z_px'])
+        expected = annotate_nearest_connectors(detections, ConnectorStore(connectors), resolution_xyz)
+
+        input_path = os.path.join(tmpdir, 'detections.csv')
+        write_detections(input_path, detections)
+
+        # The same results, however the work is divided
+        for output_name, chunk_size, num_processes in [ ('all.csv', 10000, 1),
+                                                        ('chunked.h5', 300, 1),
+                                                        ('processes.npy', 300, 3) ]:
+            output_path = os.path.join(tmpdir, output_name)
+            output_nearest_connectors( input_path, connectors, resolution_xyz, output_path,
+                                       chunk_size=chunk_size, num_processes=num_processes )
+            assert (read_detections(output_path) == expected).all(), output_name
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    sys.exit(nose.run(defaultTest=__file__))
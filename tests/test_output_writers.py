@@ -0,0 +1,122 @@
+import os
+import time
+import shutil
+import tempfile
+
+import numpy
+import h5py
+
+from skeleton_synapses.output_writers import BackgroundWriter, StackWriter, StackOptions, quantize_probabilities
+
+def test_quantize_probabilities():
+    quantized = quantize_probabilities( numpy.array([0.0, 0.5, 1.0, 1.2]) )
+    assert quantized.dtype == numpy.uint8
+    assert list(quantized) == [0, 128, 255, 255], quantized
+
+def test_stack_writer_compressed_quantized():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'predictions.h5')
+        slices = [ numpy.random.random((10,10,3)).astype(numpy.float32) for _ in range(3) ]
+        writer = StackWriter(path, preallocate_slices=2, options=StackOptions('gzip', True))
+        for i, image in enumerate(slices):
+            writer.append(image, "node-{}".format(i))
+        writer.close()
+
+        with h5py.File(path, 'r') as f:
+            data = f['data']
+            assert data.shape == (10,10,3,3)
+            assert data.dtype == numpy.uint8
+            assert data.compression == 'gzip'
+            assert data.chunks == (10,10,1,3)
+            assert (data[:,:,2,:] == quantize_probabilities(slices[2])).all()
+            assert list(f['slice-names'][:]) == ["0: node-0", "1: node-1", "2: node-2"]
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_stack_writer_flush_and_resume():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'raw.h5')
+        slices = [ numpy.full((4,4,1), i, dtype=numpy.uint8) for i in range(5) ]
+        writer = StackWriter(path, preallocate_slices=10)
+        for i, image in enumerate(slices[:3]):
+            writer.append(image, "node-{}".format(i))
+        writer.flush()
+
+        # After a flush, the file is closed and holds exactly the slices written so far.
+        with h5py.File(path, 'r') as f:
+            assert f['data'].shape == (4,4,3,1)
+            assert list(f['slice-names'][:]) == ["0: node-0", "1: node-1", "2: node-2"]
+
+        # Writing continues after the flush.
+        writer.append(slices[3], "node-3")
+        writer.close()
+        with h5py.File(path, 'r') as f:
+            assert f['data'].shape == (4,4,4,1)
+
+        # Resume after the third slice (e.g. from a checkpoint), discarding the fourth.
+        writer = StackWriter(path, resume_length=3, preallocate_slices=10)
+        assert len(writer) == 3
+        writer.append(slices[4], "node-4")
+        writer.close()
+        with h5py.File(path, 'r') as f:
+            assert (f['data'][:,:,:,0].max(axis=(0,1)) == [0,1,2,4]).all()
+            assert list(f['slice-names'][:]) == ["0: node-0", "1: node-1", "2: node-2", "3: node-4"]
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_background_writer_order():
+    results = []
+    def slow_append(x):
+        time.sleep(0.001)
+        results.append(x)
+
+    writer = BackgroundWriter(max_pending=2)
+    for i in range(20):
+        writer.submit(slow_append, i)
+    writer.close()
+    assert results == range(20), results
+
+def test_background_writer_error():
+    results = []
+    def append(x):
+        if x == 3:
+            raise IOError("Disk full")
+        results.append(x)
+
+    writer = BackgroundWriter(max_pending=1)
+    try:
+        for i in range(10):
+            writer.submit(append, i)
+        writer.close()
+    except IOError:
+        pass
+    else:
+        assert False, "Expected the write error to be re-raised."
+
+    # Nothing after the failed write is written.
+    assert results == [0,1,2], results
+
+def test_background_writer_error_not_raised():
+    def fail():
+        raise IOError("Disk full")
+
+    # While the caller handles another exception, close() doesn't replace it with the write error.
+    writer = BackgroundWriter(max_pending=1)
+    writer.submit(fail)
+    try:
+        try:
+            raise RuntimeError("Computation failed")
+        except:
+            writer.close(raise_errors=False)
+            raise
+    except RuntimeError:
+        pass
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    sys.exit(nose.run(defaultTest=__file__))
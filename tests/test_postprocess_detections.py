@@ -0,0 +1,81 @@
+import os
+import shutil
+import tempfile
+
+import skeleton_synapses
+from skeleton_synapses.skeleton_utils import parse_connectors, parse_skeleton_json
+from skeleton_synapses.detection_table import read_detections, write_detections
+from skeleton_synapses.merge_synapse_ids import merge_synapse_ids
+from skeleton_synapses.nearest_connectors import ConnectorStore, output_nearest_connectors, annotate_nearest_connectors
+from skeleton_synapses.filter_by_distance import filter_by_distance
+from skeleton_synapses.remove_csv_columns import remove_csv_columns
+from skeleton_synapses.connected_node_distances import connected_node_distances, connected_node_distance_table
+from skeleton_synapses.postprocess_detections import postprocess_detections
+
+TEST_SKELETONS_DIR = os.path.join( os.path.dirname(skeleton_synapses.__file__), '../test_skeletons' )
+RESOLUTION_XYZ = (4.0, 4.0, 45.0)
+
+class TestPostprocessDetections(object):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.skeleton_path = os.path.join(TEST_SKELETONS_DIR, 'skeleton_18689.json')
+        self.raw_path = os.path.join(TEST_SKELETONS_DIR, 'raw_detections_18689.csv')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def path(self, name):
+        return os.path.join(self.tmpdir, name)
+
+    def test_same_as_separate_scripts(self):
+        connectors, _ = parse_connectors(self.skeleton_path)
+
+        # The old way: a separate script (and file) for each step
+        merge_synapse_ids(self.raw_path, self.path('merged.csv'))
+        output_nearest_connectors(self.path('merged.csv'), connectors, RESOLUTION_XYZ, self.path('with_distances.csv'))
+        filter_by_distance(self.path('with_distances.csv'), self.path('filtered.csv'), 0.01, 'distance')
+        remove_csv_columns(self.path('filtered.csv'), self.path('final.csv'), ['node_count'])
+
+        output_detections, annotated_detections = \
+            postprocess_detections( read_detections(self.raw_path),
+                                    merge=True,
+                                    connector_store=ConnectorStore(connectors),
+                                    resolution_xyz=RESOLUTION_XYZ,
+                                    filters=[('distance', 0.01)],
+                                    columns_to_remove=['node_count'] )
+
+        expected = read_detections(self.path('final.csv'))
+        assert output_detections.dtype == expected.dtype
+        assert (output_detections == expected).all()
+        assert (annotated_detections == read_detections(self.path('with_distances.csv'))).all()
+
+        # Evaluation output
+        write_detections( self.path('raw_with_distances.csv'),
+                          annotate_nearest_connectors(read_detections(self.raw_path), ConnectorStore(connectors), RESOLUTION_XYZ) )
+        connected_node_distances( self.skeleton_path,
+                                  self.path('raw_with_distances.csv'),
+                                  self.path('with_distances.csv'),
+                                  self.path('connected_node_distances.csv') )
+
+        _, node_infos = parse_skeleton_json(self.skeleton_path, *RESOLUTION_XYZ)
+        raw_detections = annotate_nearest_connectors(read_detections(self.raw_path), ConnectorStore(connectors), RESOLUTION_XYZ)
+        distances, _ = connected_node_distance_table(connectors, node_infos, raw_detections, annotated_detections)
+        assert (distances == read_detections(self.path('connected_node_distances.csv'))).all()
+
+        # Connected nodes without a detection get the node's own coordinates.
+        without_detections = distances[distances['synapse_id'] == -1]
+        assert len(without_detections) > 0
+        for axis in 'xyz':
+            assert (without_detections['node_{}_px'.format(axis)] == without_detections['{}_px'.format(axis)]).all()
+
+    def test_no_stages(self):
+        detections = read_detections(self.raw_path)
+        output_detections, annotated_detections = postprocess_detections(detections)
+        assert output_detections is detections and annotated_detections is detections
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    sys.exit(nose.run(defaultTest=__file__))
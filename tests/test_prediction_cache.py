@@ -0,0 +1,70 @@
+import os
+import time
+import shutil
+import tempfile
+
+import numpy
+
+from skeleton_synapses.prediction_cache import PredictionCache
+
+class TestPredictionCache(object):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.project_path = os.path.join(self.tmpdir, 'project.ilp')
+        self.description_path = os.path.join(self.tmpdir, 'description.json')
+        with open(self.project_path, 'w') as f:
+            f.write('project')
+        with open(self.description_path, 'w') as f:
+            f.write('description')
+        self.cache_dir = os.path.join(self.tmpdir, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testRoundTrip(self):
+        cache = PredictionCache(self.cache_dir, self.project_path, self.description_path, max_size_mb=100)
+        roi = [(10, 20, 5), (41, 51, 6)]
+        predictions = numpy.random.random((31, 31, 3)).astype(numpy.float32)
+
+        assert cache.get(roi) is None
+        cache.put(roi, predictions)
+        assert (cache.get(roi) == predictions).all()
+
+        # Entries survive into a new cache instance...
+        cache = PredictionCache(self.cache_dir, self.project_path, self.description_path, max_size_mb=100)
+        assert (cache.get(roi) == predictions).all()
+
+        # ...but not if the project changes.
+        with open(self.project_path, 'w') as f:
+            f.write('retrained project')
+        cache = PredictionCache(self.cache_dir, self.project_path, self.description_path, max_size_mb=100)
+        assert cache.get(roi) is None
+
+    def testEviction(self):
+        predictions = numpy.random.random((100, 100, 3)).astype(numpy.float32)
+        rois = [ [(0, 0, z), (100, 100, z+1)] for z in range(4) ]
+
+        # Room for about 3 entries
+        max_size_mb = 3.5 * predictions.nbytes / float(2**20)
+        cache = PredictionCache(self.cache_dir, self.project_path, self.description_path, max_size_mb)
+        for roi in rois[:3]:
+            cache.put(roi, predictions)
+            time.sleep(0.01)
+
+        # Use the first entry, so the second one is now the least recently used.
+        past = time.time() - 100
+        os.utime(cache._entry_path(rois[1]), (past, past))
+        assert cache.get(rois[0]) is not None
+
+        cache.put(rois[3], predictions)
+        assert cache.get(rois[1]) is None
+        assert cache.get(rois[0]) is not None
+        assert cache.get(rois[3]) is not None
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    sys.exit(nose.run(defaultTest=__file__))
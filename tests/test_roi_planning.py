@@ -0,0 +1,56 @@
+import numpy
+
+from skeleton_synapses.skeleton_utils import roi_around_point
+from skeleton_synapses.roi_planning import coalesce_rois_by_slice, group_overlapping_rois
+
+def test_coalesce_rois_by_slice():
+    rois = [ roi_around_point((100, 100, 5), 10),
+             roi_around_point((102, 101, 5), 10), # Overlaps the first roi almost completely
+             roi_around_point((100, 100, 6), 10), # Different slice
+             roi_around_point((500, 500, 5), 10), # Same slice, but too far away
+             roi_around_point((99, 103, 5), 10) ]
+
+    groups = coalesce_rois_by_slice(rois)
+    assert [indexes for _, indexes in groups] == [ [0, 1, 4], [2], [3] ], groups
+
+    bounding_roi, _ = groups[0]
+    assert (bounding_roi == [(89, 90, 5), (113, 114, 6)]).all(), bounding_roi
+    assert (groups[1][0] == rois[2]).all()
+    assert (groups[2][0] == rois[3]).all()
+
+def test_coalesce_rois_by_slice_ratio():
+    # Two rois side-by-side (no overlap) can be combined for free...
+    rois = [ roi_around_point((100, 100, 5), 10),
+             roi_around_point((121, 100, 5), 10) ]
+    assert len(coalesce_rois_by_slice(rois)) == 1
+    
+    # ... but not if there is a gap between them (unless we allow some waste).
+    rois = [ roi_around_point((100, 100, 5), 10),
+             roi_around_point((130, 110, 5), 10) ]
+    assert len(coalesce_rois_by_slice(rois)) == 2
+    assert len(coalesce_rois_by_slice(rois, max_area_ratio=2.0)) == 1
+
+def test_group_overlapping_rois():
+    rois = [ roi_around_point((100, 100, 5), 10),
+             roi_around_point((102, 101, 5), 10), # Mostly overlaps the first roi
+             roi_around_point((100, 100, 6), 10), # Different slice
+             roi_around_point((115, 100, 5), 10), # Overlaps, but not enough
+             roi_around_point((104, 103, 5), 10) ]
+
+    groups = group_overlapping_rois(rois, 0.75)
+    assert [indexes for _, indexes in groups] == [ [0, 1, 4], [2], [3] ], groups
+
+    tile_roi, _ = groups[0]
+    assert (tile_roi == [(90, 90, 5), (115, 114, 6)]).all(), tile_roi
+
+    # With a low enough threshold, the third roi is also merged in.
+    groups = group_overlapping_rois(rois, 0.2)
+    assert [indexes for _, indexes in groups] == [ [0, 1, 3, 4], [2] ], groups
+
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    sys.exit(nose.run(defaultTest=__file__))
@@ -0,0 +1,88 @@
+import os
+import csv
+import shutil
+import tempfile
+
+import numpy
+import h5py
+
+from skeleton_synapses.skeleton_utils import CSV_FORMAT
+from skeleton_synapses.sharding import shard_branches, merge_shards
+
+def test_shard_branches():
+    branches = [ range(10), range(2), range(3), range(5), range(1), range(9) ]
+    shards = shard_branches(branches, 3)
+    assert len(shards) == 3
+
+    # Order must be preserved
+    assert sum(shards, []) == branches
+    assert map(len, shards) == [1, 3, 2], "Unexpected shards: {}".format( shards )
+
+def test_shard_branches_too_many_shards():
+    branches = [ range(3), range(2) ]
+    shards = shard_branches(branches, 5)
+    assert shards == [ [range(3)], [range(2)] ]
+
+def _write_shard(shard_dir, csv_filename, rows, synapse_cc_slices):
+    os.mkdir(shard_dir)
+    with open(os.path.join(shard_dir, csv_filename), 'w') as f:
+        writer = csv.DictWriter(f, ["synapse_id", "tile_index", "x_px"], **CSV_FORMAT)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+
+    for name in ["raw", "predictions", "synapse_cc", "segmentation"]:
+        data = numpy.concatenate([s[:,:,None,None] for s in synapse_cc_slices], axis=2)
+        with h5py.File(os.path.join(shard_dir, name + ".h5"), 'w') as f:
+            f.create_dataset('data', data=data, maxshape=(4,4,None,1))
+            f['data'].attrs['axistags'] = "{}"
+            f.create_dataset('slice-names', data=["{}: x{}".format(z, z) for z in range(len(synapse_cc_slices))],
+                             dtype=h5py.special_dtype(vlen=str))
+
+def test_merge_shards():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        csv_filename = "skeleton-1-synapses.csv"
+        slice_a = numpy.zeros((4,4), dtype=numpy.uint32)
+        slice_a[0,0] = 1
+        slice_b = numpy.zeros((4,4), dtype=numpy.uint32)
+        slice_b[1,1] = 2
+        slice_c = numpy.zeros((4,4), dtype=numpy.uint32)
+        slice_c[2,2] = 1
+
+        shard_dirs = [ os.path.join(tmpdir, "shard-0"), os.path.join(tmpdir, "shard-1") ]
+        _write_shard( shard_dirs[0], csv_filename,
+                      [ {"synapse_id": 1, "tile_index": 0, "x_px": 10},
+                        {"synapse_id": 2, "tile_index": 1, "x_px": 11} ],
+                      [ slice_a, slice_b ] )
+        _write_shard( shard_dirs[1], csv_filename,
+                      [ {"synapse_id": 1, "tile_index": 0, "x_px": 12} ],
+                      [ slice_c ] )
+
+        merge_shards(shard_dirs, [2, 1], tmpdir, csv_filename)
+
+        with open(os.path.join(tmpdir, csv_filename), 'r') as f:
+            rows = list(csv.DictReader(f, **CSV_FORMAT))
+        assert [ (r["synapse_id"], r["tile_index"], r["x_px"]) for r in rows ] == \
+               [ ("1", "0", "10"), ("2", "1", "11"), ("3", "2", "12") ], rows
+
+        with h5py.File(os.path.join(tmpdir, "synapse_cc.h5"), 'r') as f:
+            merged = f['data'][:]
+            slice_names = list(f['slice-names'][:])
+        assert merged.shape == (4,4,3,1)
+        assert merged[2,2,2,0] == 3
+        assert (merged[...,2,0] != 0).sum() == 1
+        assert slice_names == ["0: x0", "1: x1", "2: x0"], slice_names
+
+        # Non-label stacks are copied verbatim
+        with h5py.File(os.path.join(tmpdir, "raw.h5"), 'r') as f:
+            assert f['data'][2,2,2,0] == 1
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    sys.exit(nose.run(defaultTest=__file__))
@@ -0,0 +1,107 @@
+import os
+import json
+import shutil
+import tempfile
+from StringIO import StringIO
+
+import numpy
+
+import skeleton_synapses
+from skeleton_synapses.json_stream import JsonStream
+from skeleton_synapses.skeleton_utils import iter_skeleton_json, parse_skeleton_json, parse_skeleton_ids, \
+                                             parse_connectors, load_skeletons, roi_around_node, rois_around_nodes, NodeInfo
+
+TEST_SKELETONS_DIR = os.path.join( os.path.dirname(skeleton_synapses.__file__), '../test_skeletons' )
+
+def test_json_stream():
+    document = { 'a' : [1, 2.5, {'b' : None}], 'c' : {'d' : 'e' * 20, 'f' : 123456789}, 'g' : [] }
+    # Use a tiny chunk size, to test values that span several chunks
+    stream = JsonStream(StringIO(json.dumps(document, indent=2)), chunk_size=3)
+    parsed = {}
+    for key in stream.iter_object():
+        if key == 'c':
+            parsed['c'] = { subkey : stream.read_value() for subkey in stream.iter_object() }
+        elif key == 'a':
+            stream.skip_value()
+        else:
+            parsed[key] = stream.read_value()
+    assert parsed == { 'c' : document['c'], 'g' : [] }
+    assert stream.peek() == ''
+
+def test_rois_around_nodes():
+    node_infos = [ NodeInfo(1, 10, 20, 30, -1), NodeInfo(2, 0, 5, 7, 1) ]
+    rois = rois_around_nodes(node_infos, 5)
+    assert rois.shape == (2, 2, 3)
+    for node_info, roi in zip(node_infos, rois):
+        assert (roi == roi_around_node(node_info, 5)).all()
+
+class TestSkeletonJson(object):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.single_path = os.path.join(TEST_SKELETONS_DIR, 'skeleton_18689.json')
+
+        # Combine two exports into a single multi-skeleton export
+        skeletons = {}
+        for name in ('skeleton_18689.json', 'skeleton_94835.json'):
+            with open(os.path.join(TEST_SKELETONS_DIR, name)) as f:
+                skeletons.update( json.load(f)['skeletons'] )
+        self.multi_path = os.path.join(self.tmpdir, 'skeletons.json')
+        with open(self.multi_path, 'w') as f:
+            json.dump({ 'skeletons' : skeletons }, f)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_single_skeleton(self):
+        with open(self.single_path) as f:
+            expected = json.load(f)['skeletons']['18689']
+
+        skeleton_id, node_infos = parse_skeleton_json(self.single_path, 4.0, 4.0, 45.0)
+        assert skeleton_id == '18689'
+        assert len(node_infos) == len(expected['treenodes'])
+
+        # Same order as the (old) json.load()-based parser
+        assert [ node_info.id for node_info in node_infos ] == map(int, expected['treenodes'].keys())
+        node_info = node_infos[0]
+        x_nm, y_nm, z_nm = expected['treenodes'][str(node_info.id)]['location']
+        assert (node_info.x_px, node_info.y_px, node_info.z_px) == ( int(x_nm / 4.0), int(y_nm / 4.0), int(z_nm / 45.0) )
+
+        connector_infos, node_to_connector = parse_connectors(self.single_path)
+        assert [ info.id for info in connector_infos ] == map(int, expected['connectors'].keys())
+        for info in connector_infos:
+            connector_data = expected['connectors'][str(info.id)]
+            assert info.incoming_nodes == connector_data['presynaptic_to']
+            assert info.outgoing_nodes == connector_data['postsynaptic_to']
+            for node in info.incoming_nodes + info.outgoing_nodes:
+                assert info.id in node_to_connector[node]
+
+    def test_multiple_skeletons(self):
+        assert sorted(parse_skeleton_ids(self.multi_path)) == ['18689', '94835']
+
+        skeletons = list( iter_skeleton_json(self.multi_path) )
+        assert sorted( s.skeleton_id for s in skeletons ) == ['18689', '94835']
+
+        # Without a skeleton id, the choice is ambiguous
+        try:
+            parse_skeleton_json(self.multi_path, 4.0, 4.0, 45.0)
+        except Exception:
+            pass
+        else:
+            assert False, "Expected an exception"
+
+        # Selecting one skeleton gives the same result as the single-skeleton file
+        skeleton_id, node_infos = parse_skeleton_json(self.multi_path, 4.0, 4.0, 45.0, skeleton_id=18689)
+        assert skeleton_id == '18689'
+        assert sorted(node_infos) == sorted(parse_skeleton_json(self.single_path, 4.0, 4.0, 45.0)[1])
+
+        loaded = { s.skeleton_id : s for s in load_skeletons(self.multi_path, (4.0, 4.0, 45.0)) }
+        skeleton_data = [ s for s in skeletons if s.skeleton_id == '94835' ][0]
+        assert len(loaded['94835'].connector_infos) == len(skeleton_data.connector_ids)
+        assert numpy.unique(skeleton_data.node_ids).size == skeleton_data.node_ids.size
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    sys.exit(nose.run(defaultTest=__file__))
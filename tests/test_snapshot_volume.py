@@ -0,0 +1,91 @@
+import os
+import shutil
+import tempfile
+import collections
+
+import numpy
+import vigra
+
+from skeleton_synapses.tile_cache import TileCache, TileSource
+from skeleton_synapses.snapshot_volume import footprint_tile_positions, snapshot_tiles, snapshot_description
+
+TileDescription = collections.namedtuple( 'TileDescription', 'format bounds_zyx tile_shape_2d_yx tile_url_format '
+                                                             'output_axes view_origin_zyx extend_slices' )
+NodeInfo = collections.namedtuple('NodeInfo', 'x_px y_px z_px')
+
+class TestSnapshotVolume(object):
+    """
+    Snapshots a small tiled volume (3 slices of 3x3 tiles, the last slice missing).
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.source_dir = os.path.join(self.tmpdir, 'source')
+        os.mkdir(self.source_dir)
+        self.volume = numpy.random.randint(0, 255, size=(3, 30, 30)).astype(numpy.uint8)
+        for z in range(2):
+            for y_index in range(3):
+                for x_index in range(3):
+                    tile = self.volume[z, 10*y_index:10*(y_index+1), 10*x_index:10*(x_index+1)]
+                    path = os.path.join(self.source_dir, "{}-{}-{}.png".format(z, y_index, x_index))
+                    vigra.impex.writeImage(vigra.taggedView(tile, 'yx'), path)
+        self.volume[2] = self.volume[1]
+
+        self.description_fields = dict( format='png',
+                                         bounds_zyx=(3, 30, 30),
+                                         tile_shape_2d_yx=(10, 10),
+                                         tile_url_format="file://" + self.source_dir + "/{z_index}-{y_index}-{x_index}.png",
+                                         output_axes='xyz',
+                                         view_origin_zyx=None,
+                                         extend_slices=[[1, [2]]] )
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_snapshot(self):
+        source = TileSource(TileDescription(**self.description_fields), None)
+
+        # Two nodes, whose rois cover the top-left 2x2 tiles of slices 0 and 2
+        node_infos = [ NodeInfo(4, 4, 0), NodeInfo(12, 12, 2) ]
+        tile_positions = footprint_tile_positions(source, node_infos, 5)
+        assert tile_positions == [ (0, 0, 0),
+                                   (2, 0, 0), (2, 0, 1), (2, 1, 0), (2, 1, 1) ]
+
+        tiles_dir = os.path.join(self.tmpdir, 'snapshot')
+        assert snapshot_tiles(source, tile_positions, tiles_dir, 2) == 5
+        assert os.path.exists(os.path.join(tiles_dir, '2', '1', '0.png'))
+
+        # Already present
+        assert snapshot_tiles(source, tile_positions, tiles_dir, 2) == 0
+
+        # Read the snapshot
+        snapshot_fields = snapshot_description(self.description_fields, tiles_dir)
+        assert 'extend_slices' not in snapshot_fields
+        snapshot_fields = { name : snapshot_fields.get(name) for name in TileDescription._fields }
+        snapshot_source = TileSource(TileDescription(**snapshot_fields), TileCache(10))
+        result = numpy.zeros((13, 13, 1), dtype=numpy.uint8)
+        snapshot_source.read( ((2, 2, 2), (15, 15, 3)), result )
+        assert (result[...,0] == self.volume[2, 2:15, 2:15].transpose()).all()
+
+    def test_missing_tiles(self):
+        os.unlink(os.path.join(self.source_dir, "0-0-1.png"))
+        source = TileSource(TileDescription(**self.description_fields), None)
+
+        tiles_dir = os.path.join(self.tmpdir, 'snapshot')
+        tile_positions = [ (0, 0, 0), (0, 0, 1) ]
+        assert snapshot_tiles(source, tile_positions, tiles_dir, 2) == 2
+
+        # The missing tile is stored (and read) as zeros.
+        snapshot_fields = snapshot_description(self.description_fields, tiles_dir)
+        snapshot_fields = { name : snapshot_fields.get(name) for name in TileDescription._fields }
+        snapshot_source = TileSource(TileDescription(**snapshot_fields), TileCache(10))
+        result = numpy.ones((20, 10, 1), dtype=numpy.uint8)
+        snapshot_source.read( ((0, 0, 0), (20, 10, 1)), result )
+        assert (result[:10, :, 0] == self.volume[0, 0:10, 0:10].transpose()).all()
+        assert (result[10:] == 0).all()
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    sys.exit(nose.run(defaultTest=__file__))
@@ -0,0 +1,197 @@
+import os
+import csv
+import shutil
+import tempfile
+
+import numpy
+import h5py
+
+from skeleton_synapses.skeleton_utils import CSV_FORMAT
+from skeleton_synapses.synapse_identity import UnionFind, GlobalSynapseRelabeler, rewrite_synapse_ids, rewritten_path, \
+                                               replace_rewritten_files
+
+def test_union_find():
+    sets = UnionFind()
+    sets.add(6)
+    sets.union(4, 2)
+    sets.union(5, 4)
+    sets.union(1, 3)
+    assert sets.find(5) == 2
+    assert list(sets.roots()) == [0, 1, 2, 1, 2, 2]
+
+def test_global_relabeler_links_non_consecutive_tiles():
+    relabeler = GlobalSynapseRelabeler()
+
+    # Two tiles in the same slice, with another tile (elsewhere) in between
+    tile_a = numpy.zeros((10,10), dtype=numpy.uint32)
+    tile_a[6:9, 6:9] = 1
+    tile_b = numpy.zeros((10,10), dtype=numpy.uint32)
+    tile_b[2:4, 2:4] = 1
+    tile_c = numpy.zeros((10,10), dtype=numpy.uint32)
+    tile_c[1:4, 1:4] = 1 # Overlaps tile_a's synapse
+    tile_c[8:9, 8:9] = 2 # Doesn't overlap anything
+
+    ids_a = relabeler.normalize_synapse_ids(tile_a, [(0,0,5), (10,10,6)])
+    ids_b = relabeler.normalize_synapse_ids(tile_b, [(100,100,20), (110,110,21)])
+    ids_c = relabeler.normalize_synapse_ids(tile_c, [(5,5,6), (15,15,7)])
+    assert relabeler.max_label == 4
+
+    mapping = relabeler.final_id_mapping()
+    assert mapping[ids_a[7,7]] == mapping[ids_c[2,2]] == 1
+    assert mapping[ids_b[2,2]] == 2
+    assert mapping[ids_c[8,8]] == 3
+
+def test_global_relabeler_min_overlap_fraction():
+    relabeler = GlobalSynapseRelabeler(min_overlap_fraction=0.5)
+    tile_a = numpy.zeros((10,10), dtype=numpy.uint32)
+    tile_a[0:4, 0:4] = 1
+    tile_b = numpy.zeros((10,10), dtype=numpy.uint32)
+    tile_b[3:7, 3:7] = 1 # Only 1/16 of its pixels overlap
+
+    relabeler.normalize_synapse_ids(tile_a, [(0,0,0), (10,10,1)])
+    relabeler.normalize_synapse_ids(tile_b, [(0,0,0), (10,10,1)])
+    assert list(relabeler.final_id_mapping()) == [0, 1, 2]
+
+def random_tiles(num_tiles, seed=0):
+    """
+    Random tiles (with a few blobs each) and their rois, all within a small region,
+    so that many of them overlap.
+    """
+    rng = numpy.random.RandomState(seed)
+    tiles = []
+    for _ in range(num_tiles):
+        tile = numpy.zeros((20,20), dtype=numpy.uint32)
+        for label in range(1, rng.randint(1, 4)):
+            x, y = rng.randint(0, 16, size=2)
+            tile[x:x+4, y:y+4] = label
+        x, y, z = rng.randint(0, 30), rng.randint(0, 30), rng.randint(0, 5)
+        tiles.append( (tile, [(x, y, z), (x+20, y+20, z+1)]) )
+    return tiles
+
+def test_global_relabeler_footprint_runs():
+    """
+    Each slice's footprint is kept in a few sorted runs (rather than re-sorted for every tile),
+    which together hold every recorded pixel exactly once.
+    """
+    relabeler = GlobalSynapseRelabeler()
+    recorded = {}
+    for tile, roi in random_tiles(300, seed=1):
+        relabeled = relabeler.normalize_synapse_ids(tile, roi)
+        (x0, y0, z), _ = roi
+        for x, y in zip(*numpy.nonzero(relabeled)):
+            recorded.setdefault( (x0+x, y0+y, z), relabeled[x, y] )
+
+    for z, runs in relabeler.footprints.items():
+        run_lengths = [ len(run_keys) for run_keys, _ in runs ]
+        assert all( a >= 2*b for a, b in zip(run_lengths[:-1], run_lengths[1:]) ), run_lengths
+        for run_keys, _ in runs:
+            assert (numpy.diff(run_keys) > 0).all()
+
+        keys = numpy.concatenate( [ run_keys for run_keys, _ in runs ] )
+        ids = numpy.concatenate( [ run_ids for _, run_ids in runs ] )
+        expected = dict( ((x, y), pixel_id) for (x, y, pixel_z), pixel_id in recorded.items() if pixel_z == z )
+        assert len(keys) == len(set(keys)) == len(expected)
+        for key, pixel_id in zip(keys, ids):
+            x, y = divmod(int(key), 2**32)
+            assert expected[(x, y - 2**31)] == pixel_id
+
+class TestGlobalRelabelerState(object):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.journal_path = os.path.join(self.tmpdir, 'synapse-ids.journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_resume(self):
+        tiles = random_tiles(60)
+        uninterrupted = GlobalSynapseRelabeler()
+        expected_ids = [ uninterrupted.normalize_synapse_ids(tile, roi) for tile, roi in tiles ]
+
+        # Checkpoint every 10 tiles, and stop (without a checkpoint) after tile 35.
+        relabeler = GlobalSynapseRelabeler(journal_path=self.journal_path)
+        states = []
+        journal_sizes = []
+        for i, (tile, roi) in enumerate(tiles[:35]):
+            relabeler.normalize_synapse_ids(tile, roi)
+            if (i+1) % 10 == 0:
+                states.append( relabeler.state() )
+                journal_sizes.append( os.path.getsize(self.journal_path) )
+
+        # Each checkpoint only appends the new footprints (not all footprints so far).
+        assert max(numpy.diff([0] + journal_sizes)) < 2 * journal_sizes[0]
+
+        # Resume after the first checkpoint, even though more was written to the journal after it.
+        resumed = GlobalSynapseRelabeler(journal_path=self.journal_path)
+        resumed.restore_state(states[0])
+        assert os.path.getsize(self.journal_path) == journal_sizes[0]
+        for i, (tile, roi) in enumerate(tiles[10:], 10):
+            assert (resumed.normalize_synapse_ids(tile, roi) == expected_ids[i]).all()
+            if i == 29:
+                # Resume (again) from a checkpoint written by the resumed run.
+                state = resumed.state()
+                resumed = GlobalSynapseRelabeler(journal_path=self.journal_path)
+                resumed.restore_state(state)
+
+        assert resumed.max_label == uninterrupted.max_label
+        assert (resumed.final_id_mapping() == uninterrupted.final_id_mapping()).all()
+
+    def test_settings_not_restored(self):
+        tile_a = numpy.zeros((10,10), dtype=numpy.uint32)
+        tile_a[0:4, 0:4] = 1
+        tile_b = numpy.zeros((10,10), dtype=numpy.uint32)
+        tile_b[3:7, 3:7] = 1 # Only 1/16 of its pixels overlap tile_a's synapse
+
+        relabeler = GlobalSynapseRelabeler(journal_path=self.journal_path)
+        relabeler.normalize_synapse_ids(tile_a, [(0,0,0), (10,10,1)])
+        state = relabeler.state()
+
+        # The state doesn't include the settings, so a resumed relabeler keeps its own.
+        resumed = GlobalSynapseRelabeler(min_overlap_fraction=0.5, journal_path=self.journal_path)
+        resumed.restore_state(state)
+        assert resumed.min_overlap_fraction == 0.5
+        assert resumed.max_label == 1
+
+        relabeler.normalize_synapse_ids(tile_b, [(0,0,0), (10,10,1)])
+        resumed.normalize_synapse_ids(tile_b, [(0,0,0), (10,10,1)])
+        assert list(relabeler.final_id_mapping()) == [0, 1, 1]
+        assert list(resumed.final_id_mapping()) == [0, 1, 2]
+
+def test_rewrite_synapse_ids():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        csv_path = os.path.join(tmpdir, "synapses.csv")
+        with open(csv_path, 'w') as f:
+            writer = csv.DictWriter(f, ["synapse_id", "x_px"], **CSV_FORMAT)
+            writer.writeheader()
+            writer.writerow({"synapse_id": 1, "x_px": 10})
+            writer.writerow({"synapse_id": 3, "x_px": 11})
+
+        stack_path = os.path.join(tmpdir, "synapse_cc.h5")
+        with h5py.File(stack_path, 'w') as f:
+            f.create_dataset('data', data=numpy.array([0,1,2,3], dtype=numpy.uint32).reshape((2,2,1,1)))
+
+        rewrite_synapse_ids(numpy.array([0,1,2,1], dtype=numpy.uint32), csv_path, stack_path)
+
+        # The originals are only replaced by replace_rewritten_files()
+        with h5py.File(stack_path, 'r') as f:
+            assert list(f['data'][:].flat) == [0,1,2,3]
+        replace_rewritten_files(csv_path, stack_path)
+        assert not os.path.exists(rewritten_path(csv_path))
+
+        # Repeating it (e.g. after a crash in the middle) does nothing.
+        replace_rewritten_files(csv_path, stack_path)
+
+        with open(csv_path, 'r') as f:
+            assert [row["synapse_id"] for row in csv.DictReader(f, **CSV_FORMAT)] == ["1", "1"]
+        with h5py.File(stack_path, 'r') as f:
+            assert list(f['data'][:].flat) == [0,1,2,1]
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    sys.exit(nose.run(defaultTest=__file__))
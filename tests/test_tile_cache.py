@@ -0,0 +1,179 @@
+import os
+import shutil
+import tempfile
+import time
+import threading
+import collections
+import BaseHTTPServer
+import SimpleHTTPServer
+
+import numpy
+import vigra
+
+from skeleton_synapses.tile_cache import TileCache, TileSource, TilePrefetcher, create_session
+
+TileDescription = collections.namedtuple( 'TileDescription', 'format bounds_zyx tile_shape_2d_yx tile_url_format '
+                                                             'output_axes view_origin_zyx extend_slices' )
+
+class TestTileCache(object):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_lru_eviction(self):
+        cache = TileCache(max_size_mb=2500 / float(2**20))
+        tile = numpy.zeros((1000,), dtype=numpy.uint8)
+        cache.put('a', tile)
+        cache.put('b', tile)
+        assert cache.get('a') is tile # 'a' is now the most recently used
+        cache.put('c', tile)
+        assert cache.get('b') is None
+        assert cache.get('a') is tile
+        assert cache.get('c') is tile
+
+    def test_spill(self):
+        spill_dir = os.path.join(self.tmpdir, 'spill')
+        cache = TileCache(max_size_mb=1500 / float(2**20), spill_dir=spill_dir)
+        cache.put('a', numpy.ones((1000,), dtype=numpy.uint8))
+        cache.put('b', numpy.zeros((1000,), dtype=numpy.uint8))
+        assert len(cache) == 1
+        assert (cache.get('a') == 1).all()
+
+class _CountingHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    request_count = 0
+    delay = 0.0
+    def do_GET(self):
+        _CountingHandler.request_count += 1
+        time.sleep(_CountingHandler.delay)
+        SimpleHTTPServer.SimpleHTTPRequestHandler.do_GET(self)
+
+    def log_message(self, *args):
+        pass
+
+class TestTileSource(object):
+    """
+    Serves a small tiled volume (2 slices of 2x2 tiles) from a local directory.
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.volume = numpy.random.randint(0, 255, size=(2, 20, 20)).astype(numpy.uint8)
+        for z in range(2):
+            for y_index in range(2):
+                for x_index in range(2):
+                    tile = self.volume[z, 10*y_index:10*(y_index+1), 10*x_index:10*(x_index+1)]
+                    path = os.path.join(self.tmpdir, "{}-{}-{}.png".format(z, y_index, x_index))
+                    vigra.impex.writeImage(vigra.taggedView(tile, 'yx'), path)
+
+        self.old_cwd = os.getcwd()
+        os.chdir(self.tmpdir)
+        self.server = BaseHTTPServer.HTTPServer(('localhost', 0), _CountingHandler)
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+
+    def tearDown(self):
+        _CountingHandler.delay = 0.0
+        self.server.shutdown()
+        os.chdir(self.old_cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def _description(self, url_prefix, **kwargs):
+        fields = dict( format='png',
+                       bounds_zyx=(2, 20, 20),
+                       tile_shape_2d_yx=(10, 10),
+                       tile_url_format=url_prefix + "/{z_index}-{y_index}-{x_index}.png",
+                       output_axes='xyz',
+                       view_origin_zyx=None,
+                       extend_slices=None )
+        fields.update(kwargs)
+        return TileDescription(**fields)
+
+    def test_read_http(self):
+        url = "http://localhost:{}".format( self.server.server_port )
+        source = TileSource(self._description(url), TileCache(10), create_session(2))
+
+        _CountingHandler.request_count = 0
+        result = numpy.zeros((10, 10, 1), dtype=numpy.uint8)
+        source.read( ((5, 5, 1), (15, 15, 2)), result )
+        assert (result[...,0] == self.volume[1, 5:15, 5:15].transpose()).all()
+        assert _CountingHandler.request_count == 4
+
+        # The second read is served from the cache
+        source.read( ((6, 6, 1), (16, 16, 2)), result )
+        assert (result[...,0] == self.volume[1, 6:16, 6:16].transpose()).all()
+        assert _CountingHandler.request_count == 4
+
+    def test_shared_cache_fetches_once(self):
+        # Two sources (e.g. the prefetcher's and TiledVolume's) with the same cache
+        url = "http://localhost:{}".format( self.server.server_port )
+        cache = TileCache(10)
+        sources = [ TileSource(self._description(url), cache, create_session(4)) for _ in range(2) ]
+
+        _CountingHandler.request_count = 0
+        _CountingHandler.delay = 0.2
+        tiles = []
+        threads = [ threading.Thread(target=lambda source=source: tiles.append(source.tile(0, 1, 1)))
+                    for source in sources * 2 ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert _CountingHandler.request_count == 1
+        assert len(tiles) == 4
+        assert all( (tile[...,0] == self.volume[0, 10:20, 10:20]).all() for tile in tiles )
+
+    def test_missing_tile(self):
+        # The server doesn't have one of the tiles (404)
+        os.unlink(os.path.join(self.tmpdir, "1-1-0.png"))
+        url = "http://localhost:{}".format( self.server.server_port )
+        source = TileSource(self._description(url), TileCache(10), create_session(2))
+
+        # The missing tile is read as zeros.
+        result = numpy.ones((10, 10, 1), dtype=numpy.uint8)
+        source.read( ((5, 5, 1), (15, 15, 2)), result )
+        expected = self.volume[1, 5:15, 5:15].copy()
+        expected[5:, :5] = 0
+        assert (result[...,0] == expected.transpose()).all()
+
+    def test_read_file_with_origin_and_extended_slices(self):
+        description = self._description( "file://" + self.tmpdir,
+                                         view_origin_zyx=(0, 2, 0),
+                                         extend_slices=[[0, [1]]] )
+        source = TileSource(description, TileCache(10))
+
+        result = numpy.zeros((4, 4, 1), dtype=numpy.uint8)
+        source.read( ((0, 0, 1), (4, 4, 2)), result )
+        assert (result[...,0] == self.volume[0, 2:6, 0:4].transpose()).all()
+
+    def test_prefetch(self):
+        cache = TileCache(10)
+        source = TileSource(self._description("file://" + self.tmpdir), cache)
+        view_rois = [ ((0, 0, 0), (5, 5, 1)),
+                      ((12, 12, 1), (15, 15, 2)) ]
+
+        def wait_for_tile(z, y_index, x_index):
+            for _ in range(100):
+                if cache.get(source.tile_url(z, y_index, x_index)) is not None:
+                    return True
+                time.sleep(0.05)
+            return False
+
+        prefetcher = TilePrefetcher(source, view_rois, lookahead=1, num_threads=2)
+        try:
+            assert wait_for_tile(0, 0, 0)
+            # Beyond the lookahead
+            assert cache.get(source.tile_url(1, 1, 1)) is None
+
+            prefetcher.advance(1)
+            assert wait_for_tile(1, 1, 1)
+        finally:
+            prefetcher.close()
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    sys.exit(nose.run(defaultTest=__file__))
@@ -0,0 +1,54 @@
+import random
+
+import numpy
+
+from skeleton_synapses.skeleton_utils import NodeInfo, construct_tree
+from skeleton_synapses.tree_util import partition, edge_count_to_root, ArrayTree, networkx_node_order
+
+def random_skeleton(num_nodes, seed):
+    """
+    Return the node ids and parent ids of a random tree, in random order.
+    """
+    rng = random.Random(seed)
+    node_ids = rng.sample(range(1, 10*num_nodes), num_nodes)
+    parent_ids = [-1] + [ node_ids[rng.randint(0, i-1)] for i in range(1, num_nodes) ]
+    order = range(num_nodes)
+    rng.shuffle(order)
+    return [ node_ids[i] for i in order ], [ parent_ids[i] for i in order ]
+
+def test_children_and_depths():
+    #     1
+    #    / \
+    #   2   3
+    #       |
+    #       4
+    tree = ArrayTree([4, 3, 2, 1], [3, 1, 1, -1])
+    assert tree.parent_indexes.tolist() == [1, 3, 3, -1]
+    assert sorted(tree.children(3).tolist()) == [1, 2]
+    assert tree.children(0).tolist() == []
+    assert tree.depths().tolist() == [2, 1, 1, 0]
+
+def test_partition_matches_networkx():
+    for seed in range(20):
+        node_ids, parent_ids = random_skeleton(200, seed)
+        nx_tree = construct_tree( [ NodeInfo(node_id, 0, 0, 0, parent_id)
+                                    for node_id, parent_id in zip(node_ids, parent_ids) ] )
+        expected = [ filter(lambda node_id: node_id != -1, sequence) for sequence in partition(nx_tree) ]
+
+        tree = ArrayTree(node_ids, parent_ids)
+        sequences = tree.partition( networkx_node_order(node_ids, parent_ids) )
+        assert [ tree.node_ids[sequence].tolist() for sequence in sequences ] == expected
+
+        distances = edge_count_to_root(nx_tree)
+        assert tree.depths().tolist() == [ distances[node_id] - 2 for node_id in node_ids ]
+
+def test_partition_single_node():
+    tree = ArrayTree([7], [-1])
+    assert [ sequence.tolist() for sequence in tree.partition() ] == [[0]]
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    sys.exit(nose.run(defaultTest=__file__))